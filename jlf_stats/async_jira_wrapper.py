@@ -0,0 +1,213 @@
+"""
+Fetch from Jira on a single event loop rather than a pool of threads.
+
+With the threaded JiraWrapper each request in flight ties up a thread.
+Here the search and changelog requests all go out from one Tornado IOLoop
+so we can have hundreds outstanding at once.  We still use jira.client to
+connect, and for its session's authentication, and make the same
+jira.resources.Issue objects it would so we end up with exactly the same
+WorkItems as JiraWrapper does.
+
+Needs Tornado (pip install "tornado<6").  If pycurl is installed we use
+its client, which keeps connections open between requests.
+"""
+
+import itertools
+import json
+import sys
+
+import requests
+
+from jira.exceptions import JIRAError
+from jira.resources import Issue
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+
+from jira_wrapper import JiraWrapper
+
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as _HTTPClient
+except ImportError:
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as _HTTPClient
+
+
+class AsyncJiraWrapper(JiraWrapper):
+    """
+    Wrapper around our JIRA instance, fetching everything asynchronously
+    """
+
+    default_concurrency = 20
+
+    def _fetch(self, jqls):
+        """
+        Pages of issues, with their whole changelogs, for each category
+        in category then page order.
+
+        We ask for the first page of every category at once then, a
+        category at a time, for as many of the rest as we can have in
+        flight, handing each lot on before asking for the next.
+        """
+
+        loop = IOLoop(make_current=False)
+        fetch = _Fetch(self, loop)
+
+        try:
+            categories = list(self.categories)
+
+            first_size = self.scheduler.batch_size
+            first_pages = loop.run_sync(lambda: fetch.pages([(jqls[category], 0, first_size)
+                                                             for category in categories]))
+
+            for i, category in enumerate(categories):
+
+                # Let go of each page as soon as we've handed it on
+                (total, first_batch), first_pages[i] = first_pages[i], None
+
+                yield category, first_batch
+
+                if total is None:
+                    # No total to plan with so we will carry on a page at a time
+                    n, size = first_size, first_size
+                    while len(first_batch) == size:
+                        size = self.scheduler.batch_size
+                        [(total, first_batch)] = loop.run_sync(lambda: fetch.pages([(jqls[category], n, size)]))
+                        yield category, first_batch
+                        n += size
+                    continue
+
+                offsets = self._offsets(jqls[category], first_size, total)
+
+                while True:
+                    window = list(itertools.islice(offsets, self.scheduler.limit))
+                    if not window:
+                        break
+
+                    for total, issue_batch in loop.run_sync(lambda: fetch.pages(window)):
+                        sys.stdout.write('.')
+                        sys.stdout.flush()
+                        yield category, issue_batch
+        finally:
+            fetch.close()
+            loop.close(all_fds=True)
+
+    def _offsets(self, jql, n, total):
+        """
+        (jql, startAt, maxResults) for the rest of a search, at whatever page
+        size the scheduler lets us have when we get to each one
+        """
+
+        while n < total:
+            size = self.scheduler.batch_size
+            yield jql, n, size
+            n += size
+
+
+class _Fetch(object):
+    """
+    Requests on one IOLoop, with no more in flight than the scheduler
+    lets us have, retrying when we're throttled
+    """
+
+    def __init__(self, wrapper, loop):
+
+        self.wrapper = wrapper
+        self.jira = wrapper.jira
+        self.scheduler = wrapper.scheduler
+
+        self.in_flight = 0
+        self.slot_free = Condition()
+
+        loop.make_current()
+        try:
+            self.client = _HTTPClient(force_instance=True, max_clients=self.scheduler.max_concurrency)
+        finally:
+            loop.clear_current()
+
+    @gen.coroutine
+    def pages(self, searches):
+        """
+        (total, issues) for each (jql, startAt, maxResults), with any
+        truncated changelogs filled in
+        """
+
+        responses = yield [self.get('search', {'jql': jql,
+                                               'startAt': n,
+                                               'maxResults': size,
+                                               'fields': self.wrapper.fields,
+                                               'expand': 'changelog'}) for jql, n, size in searches]
+
+        pages = []
+        for response in responses:
+            issues = [Issue(self.jira._options, self.jira._session, raw) for raw in response['issues']]
+            pages.append((response.get('total'), issues))
+
+        truncated = [issue for total, issues in pages for issue in issues
+                     if self.wrapper._changelog_truncated(issue)]
+
+        if truncated:
+            changelog_pages = self.wrapper._changelog_pages(truncated)
+            changelogs = yield [self.get('issue/{0}/changelog'.format(key),
+                                         {'startAt': n,
+                                          'maxResults': self.wrapper.changelog_batch_size})
+                                for key, n in changelog_pages]
+            self.wrapper._replace_changelogs(truncated, changelog_pages, changelogs)
+
+        raise gen.Return(pages)
+
+    @gen.coroutine
+    def get(self, path, params):
+        """
+        JSON from a GET of a Jira REST API resource
+        """
+
+        attempt = 0
+
+        while True:
+
+            while self.in_flight >= self.scheduler.limit:
+                yield self.slot_free.wait()
+
+            self.in_flight += 1
+
+            try:
+                yield gen.sleep(self.scheduler.reserve())
+                response = yield self.client.fetch(self.request(path, params), raise_error=False)
+            finally:
+                self.in_flight -= 1
+                self.slot_free.notify_all()
+
+            self.scheduler.observe(response.headers)
+
+            if response.code == 200:
+                self.scheduler.succeeded()
+                raise gen.Return(json.loads(response.body))
+
+            error = JIRAError(status_code=response.code,
+                              text=response.body,
+                              url=response.effective_url,
+                              response=response)
+
+            if self.scheduler.retry_delay(error, attempt) is None:
+                raise error
+
+            attempt += 1
+
+    def request(self, path, params):
+        """
+        Let the jira.client session put together the URL, headers and
+        authentication for us
+        """
+
+        prepared = self.jira._session.prepare_request(requests.Request('GET',
+                                                                        self.jira._get_url(path),
+                                                                        params=params))
+
+        return HTTPRequest(prepared.url,
+                           headers=dict(prepared.headers),
+                           request_timeout=self.jira._session.timeout or 60)
+
+    def close(self):
+
+        self.client.close()
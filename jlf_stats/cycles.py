@@ -0,0 +1,415 @@
+"""
+Cycle times for a whole batch of issues at once.
+
+history.cycle_time walks an issue's history a day at a time for each
+cycle in turn.  Here we read the cycles in our config once, into
+CycleSpecs, and then work out every cycle for every issue in a batch from
+the runs of days in each state that StateIntervals keep, giving the same
+answers as cycle_time would for their day by day histories.
+
+Cycles can also be timed in hours, or in business hours, rather than
+days.  Those are worked out from each issue's state transitions, to the
+second, rather than from its days in each state.  Hours are real elapsed
+time, in UTC, while business hours go by the clock where each timestamp
+was taken.
+"""
+
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+
+from dateutil.tz import tzutc
+
+from history import CREATED_STATE, END_STATE
+from intervals import known_states
+
+CycleSpec = namedtuple('CycleSpec', ['name',
+                                     'start',
+                                     'after',
+                                     'end',
+                                     'exit',
+                                     'ignore',
+                                     'include',
+                                     'exclude',
+                                     'unit',
+                                     'business_hours'])
+
+# What cycles can be timed in.  Days are counted as cycle_time always
+# has, the others from state transitions.
+UNITS = ['days', 'hours', 'business-hours']
+
+# When the working day starts and ends, unless a cycle says otherwise
+BUSINESS_HOURS = (9, 17)
+
+# Where we count business hours from
+_EPOCH = date(1970, 1, 1)
+
+
+def compile_cycles(cycles):
+    """
+    CycleSpecs for the cycles in our config.  Cycles with no end state
+    end on exiting their exit state, if they have one, and otherwise on
+    history.END_STATE, as cycle_time does by default.
+    """
+
+    specs = []
+
+    if cycles is None:
+        return specs
+
+    for name in cycles:
+
+        cycle = cycles[name]
+
+        if 'end' in cycle:
+            end_state = cycle['end']
+            exit_state = None
+        else:
+            end_state = END_STATE
+            exit_state = cycle.get('exit')
+
+        unit = cycle.get('unit', 'days')
+
+        if unit not in UNITS:
+            raise ValueError("Unknown unit for cycle {0}:{1}".format(name, unit))
+
+        specs.append(CycleSpec(name=name,
+                               start=cycle.get('start'),
+                               after=cycle.get('after'),
+                               end=end_state,
+                               exit=exit_state,
+                               ignore=cycle.get('ignore'),
+                               include=cycle.get('include'),
+                               exclude=cycle.get('exclude'),
+                               unit=unit,
+                               business_hours=tuple(cycle.get('business_hours', BUSINESS_HOURS))))
+
+    return specs
+
+
+def cycle_time_kernel(intervals, specs):
+    """
+    An issues by cycles array of the cycle time of each issue, from its
+    StateIntervals, through each cycle, with NaN where it has none
+    """
+
+    times = np.empty((len(intervals), len(specs)))
+    times.fill(np.nan)
+
+    rows = [n for n, issue_intervals in enumerate(intervals) if issue_intervals is not None]
+
+    if not rows or not specs:
+        return times
+
+    # Every issue's runs one after another
+    runs = np.array([len(intervals[row].codes) for row in rows])
+    issues = np.repeat(np.array(rows), runs)
+    starts = np.concatenate([intervals[row].starts for row in rows])
+    ends = np.concatenate([intervals[row].ends for row in rows])
+    codes = np.concatenate([intervals[row].codes for row in rows])
+
+    lengths = ends - starts
+
+    # How many days each issue's history has
+    days = np.bincount(issues, weights=lengths, minlength=len(intervals))
+
+    states = known_states()
+
+    for column, spec in enumerate(specs):
+
+        if spec.include is not None:
+            included = np.in1d(codes, _codes_in(states, spec.include))
+            times[rows, column] = np.bincount(issues, weights=lengths * included, minlength=len(intervals))[rows]
+            continue
+
+        if spec.exclude is not None:
+            excluded = np.in1d(codes, _codes_in(states, spec.exclude))
+            times[rows, column] = (days - np.bincount(issues, weights=lengths * excluded, minlength=len(intervals)))[rows]
+            continue
+
+        start = np.empty(len(intervals))
+        start.fill(np.nan)
+
+        if spec.after is not None:
+            # The day after we first got to the after state, or the day we
+            # did if that's the last day we have
+            first = _first(issues, codes == _code(states, spec.after))
+            start[issues[first]] = starts[first] + (starts[first] < days[issues[first]] - 1)
+        else:
+            first = _first(issues, codes == _code(states, spec.start))
+            start[issues[first]] = starts[first]
+
+        end = np.empty(len(intervals))
+        end.fill(np.nan)
+
+        if spec.exit is not None:
+            # The day after we last left the exit state, or the last day
+            # we have if we are still in it
+            last = _last(issues, codes == _code(states, spec.exit))
+            end[issues[last]] = ends[last] - (ends[last] >= days[issues[last]])
+            offset = 0
+        else:
+            # We ignore getting to the end state from the state we ignore,
+            # which means never if they're the same state
+            if spec.end != spec.ignore:
+                last = _last(issues, codes == _code(states, spec.end))
+                end[issues[last]] = ends[last] - 1
+            offset = 1
+
+        # If we only ever saw the end state the start was on the same day
+        times[:, column] = np.where(np.isnan(start), 1, end - start + offset)
+        times[np.isnan(end), column] = np.nan
+
+    return times
+
+
+def cycle_times_by_name(times, specs):
+    """
+    A row of cycle_time_kernel's array as a cycle time, or None, for each
+    cycle by name
+    """
+
+    by_name = {}
+
+    for spec, time in zip(specs, times):
+        if np.isnan(time):
+            by_name[spec.name] = None
+        else:
+            by_name[spec.name] = int(time)
+
+    return by_name
+
+
+def transition_cycle_times(specs, state_transitions, created, until):
+    """
+    Cycle times, by name, for the cycles not timed in days, from an issue's
+    state transitions
+    """
+
+    by_name = {}
+
+    timed = [spec for spec in specs if spec.unit != 'days']
+
+    if not timed:
+        return by_name
+
+    # Each unit reads the timestamps by its own clock
+    segments = {}
+
+    for spec in timed:
+        if spec.unit not in segments:
+            segments[spec.unit] = _segments(state_transitions, created, until, _CLOCKS[spec.unit])
+        by_name[spec.name] = transition_cycle_time(spec, segments[spec.unit])
+
+    return by_name
+
+
+def transition_cycle_time(spec, segments):
+    """
+    How long, in the spec's unit, an issue took over a cycle, from the
+    (state, entered, left) segments _segments gives us.
+
+    Cycles start when we first get to the start state, or first leave the
+    after state, and end when we last get to the end state or last leave
+    the exit state.  As with cycle_time, an end state that is also the
+    state we ignore never ends a cycle, and if the end comes before the
+    start the time is negative.  If we never saw the start the cycle took
+    no time at all, and if we never saw the end it isn't over.
+    """
+
+    if spec.include is not None:
+        return _hours(sum(_elapsed(spec, entered, left)
+                          for state, entered, left in segments
+                          if _in(state, spec.include)))
+
+    if spec.exclude is not None:
+        return _hours(sum(_elapsed(spec, entered, left)
+                          for state, entered, left in segments
+                          if not _in(state, spec.exclude)))
+
+    start = None
+
+    for state, entered, left in segments:
+        if spec.after is not None and state == spec.after:
+            start = left
+            break
+        if spec.after is None and state == spec.start:
+            start = entered
+            break
+
+    end = None
+
+    for state, entered, left in reversed(segments):
+        if spec.exit is not None and state == spec.exit:
+            end = left
+            break
+        if spec.exit is None and state == spec.end and spec.end != spec.ignore:
+            end = entered
+            break
+
+    if end is None:
+        return None
+
+    if start is None:
+        return 0
+
+    return _hours(_elapsed(spec, start, end))
+
+
+def _segments(state_transitions, created, until, clock):
+    """
+    (state, entered, left) for each stretch of time an issue spent in one
+    state, from when it was created until until, with times read by clock
+    """
+
+    transitions = sorted((transition for transition in state_transitions if transition is not None),
+                         key=lambda transition: transition['timestamp'])
+
+    state = CREATED_STATE
+    if transitions:
+        state = transitions[0]['from']
+
+    created = clock(created)
+    until = clock(until)
+
+    segments = []
+
+    entered = created
+
+    for transition in transitions:
+
+        timestamp = max(clock(transition['timestamp']), created)
+
+        if timestamp >= until:
+            break
+
+        segments.append((state, entered, timestamp))
+
+        state = transition['to']
+        entered = timestamp
+
+    segments.append((state, entered, max(entered, until)))
+
+    return segments
+
+
+def _wall_clock(moment):
+    """
+    A timestamp as the time on the clock where it was taken, which is what
+    business hours go by
+    """
+
+    if moment.tzinfo is not None:
+        return moment.replace(tzinfo=None)
+
+    return moment
+
+
+def _utc(moment):
+    """
+    A timestamp in UTC, so the time between any two is the time that
+    really passed, whatever their offsets.  Times with no zone are taken
+    to be in UTC already.
+    """
+
+    if moment.tzinfo is not None:
+        return moment.astimezone(tzutc()).replace(tzinfo=None)
+
+    return moment
+
+
+# How each unit reads timestamps
+_CLOCKS = {'hours': _utc,
+           'business-hours': _wall_clock}
+
+
+def _elapsed(spec, start, end):
+    """
+    Seconds from start to end, only counting business hours if that's what
+    the spec is timed in
+    """
+
+    if spec.unit == 'business-hours':
+        return _business_seconds(end, spec.business_hours) - _business_seconds(start, spec.business_hours)
+
+    return (end - start).total_seconds()
+
+
+def _business_seconds(moment, business_hours):
+    """
+    Seconds of business hours on weekdays from _EPOCH until moment
+    """
+
+    opens, closes = business_hours
+    working_day = (closes - opens) * 3600
+
+    day = moment.date()
+
+    seconds = int(np.busday_count(_EPOCH, day)) * working_day
+
+    if np.is_busday(day):
+        time_of_day = (moment - moment.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+        seconds += min(max(time_of_day - opens * 3600, 0), working_day)
+
+    return seconds
+
+
+def _hours(seconds):
+
+    return round(seconds / 3600.0, 2)
+
+
+def _in(state, some_states):
+    """
+    Whether state is 'in' some_states, which, as with cycle_time, can be
+    a single state name
+    """
+
+    if isinstance(some_states, basestring) and not isinstance(state, basestring):
+        return False
+
+    return state in some_states
+
+
+def _code(states, state):
+
+    try:
+        return states.index(state)
+    except ValueError:
+        return -1
+
+
+def _codes_in(states, some_states):
+    """
+    Codes for the states that are 'in' some_states, which cycle_time also
+    lets be a single state name
+    """
+
+    if isinstance(some_states, basestring):
+        return [code for code, state in enumerate(states)
+                if isinstance(state, basestring) and state in some_states]
+
+    return [code for code, state in enumerate(states) if state in some_states]
+
+
+def _first(issues, matches):
+    """
+    Where each issue's first matching run is
+    """
+
+    where = np.flatnonzero(matches)
+    found, first = np.unique(issues[where], return_index=True)
+
+    return where[first]
+
+
+def _last(issues, matches):
+    """
+    Where each issue's last matching run is
+    """
+
+    where = np.flatnonzero(matches)[::-1]
+    found, last = np.unique(issues[where], return_index=True)
+
+    return where[last]
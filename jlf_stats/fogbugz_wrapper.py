@@ -1,101 +1,340 @@
 from work import WorkItem
-import re
+from workers import WorkerPool
+from sync_store import SyncStore
+from local_wrapper import work_item_from_saved
+from transitions import TransitionExtractor
+import json
+import urllib
 import dateutil.parser
 import fogbugz
 
+from datetime import datetime, timedelta
+from xml.etree import cElementTree
+
 # Event codes from http://help.fogcreek.com/8202/xml-api#Event_Codes
 evtResolved = 14
 evtEdited = 2
 evtOpened = 1
 
+# Which events are state transitions, unless the config says otherwise
+DEFAULT_TRANSITIONS = {evtOpened: {'from': 'New', 'to': 'Open'},
+                       evtResolved: ["^[^']+'([^']+)'[^']+'([^']+)'"],
+                       evtEdited: ["^Area changed from '([^']+)' to '([^']+)'"]}
+
+_SEARCH_COLUMNS = "ixBug,dtOpened,dtClosed,sTitle,sStatus,sCategory,minievents"
+
 
 class FogbugzWrapper(object):
     """
     Wrapper around a Fogbugz Instance
     """
 
+    # How far before we last synced we ask for edits from, as FogBugz
+    # reads the day we ask for in its user's time zone, not ours
+    sync_overlap = timedelta(days=1)
+
     def __init__(self, config=None):
 
         self.fb = None
         self.categories = None
+        self.stream_xml = False
+        self.concurrency = 1
+        self.page_size = None
+        self.store = None
+        self.transitions = TransitionExtractor(DEFAULT_TRANSITIONS)
 
         if config:
             self.fb = fogbugz.FogBugz(config['source']['url'], config['source']['token'])
             self.categories = config['categories']
 
+            # Parse search responses as they arrive rather than all at once
+            if 'stream_xml' in config['source']:
+                self.stream_xml = config['source']['stream_xml']
+
+            # How many searches we have running at once
+            if 'concurrency' in config['source']:
+                self.concurrency = config['source']['concurrency']
+
+            # Search for this many cases at a time rather than a whole
+            # category's in one response
+            if 'page_size' in config['source']:
+                self.page_size = config['source']['page_size']
+
+            if 'store' in config['source']:
+                self.store = SyncStore(config['source']['store'])
+
+            # Event codes and the patterns that find the states they
+            # move cases between
+            if 'transitions' in config['source']:
+                self.transitions = TransitionExtractor(config['source']['transitions'])
+
     def work_items(self):
 
-        self.responses = []
-        for cat in self.categories:
-            query = self.categories[cat]
-            self.responses.append(self.fb.search(q=query, cols="ixBug,dtOpened,dtClosed,sTitle,sStatus,sCategory,minievents"))
+        return list(self.iter_work_items())
+
+    def iter_work_items(self):
+        """
+        WorkItems for each category's cases, only keeping hold of a few
+        search responses at a time
+        """
+
+        if self.store is None:
+            return (work_item for category, work_item in self._fetch(self.categories))
+
+        return self._iter_work_items_from_store()
+
+    def _iter_work_items_from_store(self):
+        """
+        Only search for the cases edited since we last synced each category
+        and merge them into our local store, then make WorkItems from the
+        store.
+
+        FogBugz searches by day, in its user's time zone, which we don't
+        know, so we ask again for the whole of the day before we last
+        synced.  Asking for a case again does no harm as merging replaces
+        it.
+        """
+
+        synced_at = datetime.now().replace(second=0, microsecond=0)
+
+        queries = {}
+        for category in self.categories:
+            queries[category] = self.categories[category]
+            last_sync = self.store.last_synced(category, self.categories[category])
+            if last_sync is not None:
+                queries[category] = '({0}) lastedited:"{1}.."'.format(queries[category],
+                                                                      (last_sync - self.sync_overlap).strftime('%m/%d/%Y'))
+
+        updated = {}
+        for category in self.categories:
+            updated[category] = []
+
+        for category, work_item in self._fetch(queries):
+            updated[category].append((work_item.id, json.loads(work_item.to_JSON())))
+
+        for category in self.categories:
+            self.store.merge(category, updated[category], synced_at, self.categories[category])
+
+        self.store.save()
+
+        for category in self.categories:
+            for record in self.store.category_records(category):
+                yield work_item_from_saved(record)
+
+    def _fetch(self, queries):
+        """
+        (category, WorkItem) for each case found by each category's query
+        """
+
+        pool = WorkerPool(self.concurrency)
+
+        try:
+            searches = self._searches(pool, queries)
+            responses = pool.imap(lambda search: (search[0], self._search(search[1])), searches)
+
+            for category, response in responses:
+                for work_item in self._work_items_from_response(response):
+                    yield category, work_item
+        finally:
+            pool.close()
+
+    def _searches(self, pool, queries):
+        """
+        (category, query) for each category or, if we are paging, for each
+        page of each category's cases by their case numbers.  We find out
+        which cases are in each category with a search for just their
+        numbers first.
+        """
+
+        categories = list(self.categories)
+
+        if self.page_size is None:
+            return [(category, queries[category]) for category in categories]
+
+        case_numbers = pool.map(lambda category: self._case_numbers(queries[category]), categories)
+
+        return [(category, ",".join(numbers[n:n + self.page_size]))
+                for category, numbers in zip(categories, case_numbers)
+                for n in range(0, len(numbers), self.page_size)]
+
+    def _case_numbers(self, query):
+
+        response = self.fb.search(q=query, cols="ixBug")
+
+        numbers = [case.ixbug.text for case in response.cases.findAll('case')]
+
+        response.decompose()
+
+        return numbers
+
+    def _search(self, query):
+
+        if self.stream_xml:
+            return self._search_stream(query)
+
+        return self.fb.search(q=query, cols=_SEARCH_COLUMNS)
 
-        self.work_items = []
+    def _work_items_from_response(self, response):
 
-        for response in self.responses:
-            for case in response.cases.findAll('case'):
-                work_item = self.work_item_from_xml(case)
-                self.work_items.append(work_item)
+        if self.stream_xml:
+            try:
+                for work_item in self.work_items_from_stream(response):
+                    yield work_item
+            finally:
+                response.close()
+            return
 
-        return self.work_items
+        for case in response.cases.findAll('case'):
+            yield self.work_item_from_xml(case)
+
+        # The soup is full of parent/sibling reference cycles so break
+        # them up rather than wait for the garbage collector
+        response.decompose()
 
     def work_item_from_xml(self, case):
 
+        events = _transition_events(case.minievents.childGenerator(),
+                                    self.transitions.event_codes,
+                                    lambda event, tag: getattr(event, tag).text)
+
+        return self._work_item(id=case.ixbug.text,
+                               title=case.stitle.string,
+                               state=str(case.sstatus.text),
+                               type=case.scategory.text,
+                               opened=case.dtopened.text,
+                               events=events)
+
+    def work_items_from_stream(self, stream):
+        """
+        WorkItems for each case in a search response as soon as its
+        <case> element closes, after which we throw the element away so
+        we never hold more than one case at a time.
+
+        FogBugz sends us camel case tags e.g. <ixBug> but our test data
+        has been through BeautifulSoup and is all lower case so we match
+        them case insensitively.
+        """
+
+        cases = None
+
+        for event, element in cElementTree.iterparse(stream, events=('start', 'end')):
+
+            tag = element.tag.lower()
+
+            if event == 'start':
+                if tag == 'cases':
+                    cases = element
+                continue
+
+            if tag == 'error':
+                raise fogbugz.FogBugzAPIError('Error Code %s: %s' % (element.get('code'), element.text))
+
+            if tag != 'case':
+                continue
+
+            case = _children(element)
+
+            events = _transition_events((_children(child) for child in case['minievents']),
+                                        self.transitions.event_codes,
+                                        _text)
+
+            yield self._work_item(id=_text(case, 'ixbug'),
+                                  title=_text(case, 'stitle'),
+                                  state=str(_text(case, 'sstatus')),
+                                  type=_text(case, 'scategory'),
+                                  opened=_text(case, 'dtopened'),
+                                  events=events)
+
+            element.clear()
+            if cases is not None:
+                cases.clear()
+
+    def _work_item(self, id, title, state, type, opened, events):
+        """
+        WorkItem from a case's fields and the (dt, sChanges, evt) of its
+        events that might be transitions
+        """
+
         state_history = []
-        date_created = dateutil.parser.parse(case.dtopened.text)
+        date_created = dateutil.parser.parse(opened)
 
         # # store the closed date!
         # closed_date = None
         # if case.dtclosed.text:
         #     closed_date = dateutil.parser.parse(case.dtclosed.text)
 
-        for event in case.minievents.childGenerator():
+        for dt, changes, event_code in events:
 
-            transition = self.state_transition(timestamp=dateutil.parser.parse(event.dt.text),
-                                               changes=event.schanges.text,
-                                               event_code=int(event.evt.text))
+            transition = self.state_transition(timestamp=dateutil.parser.parse(dt),
+                                               changes=changes,
+                                               event_code=event_code)
 
             if transition is not None:
                 state_history.append(transition)
 
-        work_item = WorkItem(id=case.ixbug.text,
-                             title=case.stitle.string,
-                             state=str(case.sstatus.text),
-                             type=case.scategory.text,
+        work_item = WorkItem(id=id,
+                             title=title,
+                             state=state,
+                             type=type,
                              date_created=date_created,
                              category='wat',
                              history=state_history)
 
         return work_item
 
+    def _search_stream(self, query):
+        """
+        The raw response to a search, which the fogbugz client would
+        otherwise read all of into BeautifulSoup
+        """
+
+        params = {'cmd': 'search',
+                  'q': query,
+                  'cols': _SEARCH_COLUMNS}
+
+        if self.fb._token:
+            params['token'] = self.fb._token
+
+        params = dict((name, unicode(value).encode('utf-8')) for name, value in params.items())
+
+        return self.fb._opener.open(self.fb._url, urllib.urlencode(params))
+
     def state_transition(self,
                          changes,
                          timestamp,
                          event_code):
 
-        if event_code == evtOpened:
-            from_state = 'New'  # ???
-            to_state = 'Open'
-
-        elif event_code == evtResolved:
-            m = re.match("^[^\']+\'([^\']+)\'[^\']+\'([^\']+)\'", changes)
-            if m is not None:
-                from_state = m.group(1)
-                to_state = m.group(2)
-            else:
-                return None
-
-        elif event_code == evtEdited:
-            m = re.match("^Area changed from \'([^\']+)\' to \'([^\']+)\'", changes)
-            if m is not None:
-                from_state = m.group(1)
-                to_state = m.group(2)
-            else:
-                return None
-
-        else:
-            return None
-
-        return {'from': from_state,
-                'to': to_state,
-                'timestamp': timestamp}
+        return self.transitions.extract(event_code, changes, timestamp)
+
+
+def _children(element):
+    """
+    An element's children by their lower case tags
+    """
+
+    return dict((child.tag.lower(), child) for child in element)
+
+
+def _transition_events(minievents, event_codes, text):
+    """
+    (dt, sChanges, evt) for each of minievents with one of event_codes,
+    getting a tag's text from a minievent with text.
+
+    Most events aren't transitions so we read each one's code first and
+    only get the text of its date and changes if it might be one.
+    """
+
+    for minievent in minievents:
+
+        event_code = int(text(minievent, 'evt'))
+
+        if event_code in event_codes:
+            yield text(minievent, 'dt'), text(minievent, 'schanges'), event_code
+
+
+def _text(children, tag):
+
+    if tag not in children or children[tag].text is None:
+        return ''
+
+    return children[tag].text
@@ -1,5 +1,7 @@
-from datetime import date, datetime, timedelta
-import pandas as pd
+from datetime import date, datetime
+import dateutil.parser
+
+from intervals import StateIntervals
 
 """States between which we consider an issue to be being worked on
    for the purposes of calculating cycletime"""
@@ -109,6 +111,25 @@ def cycle_time(history,
     return ((end_date - start_date).days) + offset
 
 
+def jira_state_transition(history):
+    """
+    The status change in one of the histories in a Jira changelog, if any
+    """
+
+    timestamp = dateutil.parser.parse(history.created)
+
+    for item in history.items:
+        if item.field == 'status':
+            from_state = item.fromString
+            to_state = item.toString
+
+            return {'from': from_state,
+                    'to': to_state,
+                    'timestamp': timestamp}
+
+    return None
+
+
 def extract_date(created):
     return datetime.strptime(created[:10], '%Y-%m-%d').date()
 
@@ -168,28 +189,22 @@ def history_from_jira_changelog(changelog, created_date, until_date=None):
 
     issue_history = time_in_states(changelog.histories, from_date=created_date, until_date=until_date)
 
-    issue_day_history = []
-    history = None
-    total_days = 0
-
-    for state_days in issue_history:
-
-        state = state_days['state']
-        days = state_days['days']
+    return history_from_runs(issue_history, created_date)
 
-        days_in_state = [state] * days
 
-        issue_day_history += days_in_state
-        total_days += days
+def history_from_runs(issue_history, created_date):
+    """
+    Day by day history from how long an issue spent in each state in turn,
+    as time_in_states gives us
+    """
 
-    dates = [created_date + timedelta(days=x) for x in range(0, total_days)]
+    history = None
 
     try:
-        history = pd.Series(issue_day_history, index=dates)
+        history = StateIntervals.from_runs(issue_history, created_date).series()
     except AssertionError as e:
         print e
-        print dates
-        print issue_day_history
+        print issue_history
 
     return history
 
@@ -222,26 +237,4 @@ def history_from_state_transitions(start_date, state_transitions, end_date):
     Get a daily history of states based on state transitions
     """
 
-    history = []
-
-    to_state = None
-
-    last_date = start_date
-    for state in state_transitions:
-        date = state['timestamp'].date()
-
-        num_days = (date - last_date).days
-        for n in range(0, num_days):
-            history.append(state['from'])
-
-        last_date = date
-        to_state = state['to']
-
-    num_days = (end_date - last_date).days
-
-    for n in range(0, num_days + 1):
-        history.append(to_state)
-
-    dates = [start_date + timedelta(days=x) for x in range(0, (end_date - start_date).days + 1)]
-
-    return pd.Series(history, index=dates)
+    return StateIntervals.from_transitions(start_date, state_transitions, end_date).series()
@@ -1,6 +1,8 @@
 from datetime import date, timedelta, datetime
 from dateutil import rrule
 
+import numpy as np
+
 def week_start_date(year, week):
     """
     Taken from http://stackoverflow.com/a/1287862/1064619
@@ -30,3 +32,15 @@ def fill_date_index_blanks(index):
                                  (start_date + timedelta(weeks=i)).isocalendar()[1]).strftime('%Y-%m-%d') for i in range(0, num_weeks)]
 
     return new_index
+
+
+def week_starts(days):
+    """
+    The Monday each of an array of datetime64[D] days falls in the week
+    of, as week_start_date would give us for its ISO week
+    """
+
+    # 1970-01-01 was a Thursday
+    weekdays = (days.astype(np.int64) + 3) % 7
+
+    return days - weekdays.astype('timedelta64[D]')
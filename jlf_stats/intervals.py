@@ -0,0 +1,236 @@
+"""
+Histories as runs of days in each state rather than a state for every day.
+
+An issue open for three years has more than a thousand days of history
+but usually only a handful of state changes, so rather than a Series
+with a string for every day we keep, for each run of days in one state,
+the day it starts, the day after it ends and a code for its state.  Days
+are counted from the history's origin, usually when the issue was
+created.
+
+The day by day Series is still there for anything that wants it but is
+only made when asked for.
+"""
+
+import threading
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Every state we've seen, by code, and the other way round.  There's one
+# registry for the whole process, shared by every thread, so codes are
+# only good for the life of the process and the registry grows with every
+# new state name any source gives us, which in practice is a handful per
+# workflow.
+_states = []
+_codes = {}
+_lock = threading.Lock()
+
+
+def state_code(state):
+
+    try:
+        return _codes[state]
+    except KeyError:
+        with _lock:
+            # Another thread may have added it while we waited
+            if state not in _codes:
+                _states.append(state)
+                _codes[state] = len(_states) - 1
+            return _codes[state]
+
+
+def state_name(code):
+
+    return _states[code]
+
+
+def known_states():
+    """
+    Every state we've seen so far, in code order
+    """
+
+    return list(_states)
+
+
+class StateIntervals(object):
+
+    def __init__(self, origin, starts, ends, codes, days):
+
+        self.origin = origin
+        self.starts = starts
+        self.ends = ends
+        self.codes = codes
+        # How many days the history covers, which is usually, but not
+        # always, where the last run ends
+        self.days = days
+
+    @classmethod
+    def from_runs(cls, runs, origin):
+        """
+        From how many days in turn an issue spent in each state, as
+        time_in_states gives us
+        """
+
+        return cls._from_runs([(run['state'], run['days']) for run in runs],
+                              origin,
+                              sum(run['days'] for run in runs))
+
+    @classmethod
+    def from_transitions(cls, start_date, state_transitions, end_date):
+        """
+        From state transitions, as FogBugz gives us, counting the state
+        we end up in until end_date
+        """
+
+        runs = []
+
+        to_state = None
+        last_date = start_date
+
+        for transition in state_transitions:
+            date = transition['timestamp'].date()
+
+            runs.append((transition['from'], (date - last_date).days))
+
+            last_date = date
+            to_state = transition['to']
+
+        runs.append((to_state, (end_date - last_date).days + 1))
+
+        return cls._from_runs(runs, start_date, (end_date - start_date).days + 1)
+
+    @classmethod
+    def from_series(cls, history):
+        """
+        From a day by day history Series
+        """
+
+        if len(history) == 0:
+            return cls._from_runs([], None, 0)
+
+        runs = []
+
+        for state in history:
+            if runs and runs[-1][0] == state:
+                runs[-1][1] += 1
+            else:
+                runs.append([state, 1])
+
+        return cls._from_runs(runs, history.index[0], len(history))
+
+    @classmethod
+    def _from_runs(cls, runs, origin, days):
+
+        starts = []
+        ends = []
+        codes = []
+
+        day = 0
+
+        for state, run_days in runs:
+
+            # Runs with no days, or fewer than none, don't add to the history
+            if run_days <= 0:
+                continue
+
+            if codes and codes[-1] == state_code(state):
+                ends[-1] += run_days
+            else:
+                starts.append(day)
+                ends.append(day + run_days)
+                codes.append(state_code(state))
+
+            day += run_days
+
+        return cls(origin,
+                   np.array(starts, dtype=np.int32),
+                   np.array(ends, dtype=np.int32),
+                   np.array(codes, dtype=np.int32),
+                   days)
+
+    def __len__(self):
+
+        return self.days
+
+    def __iter__(self):
+        """
+        (start, end, state) for each run of days
+        """
+
+        for start, end, code in zip(self.starts, self.ends, self.codes):
+            yield int(start), int(end), state_name(code)
+
+    def date(self, day):
+
+        return self.origin + timedelta(days=day)
+
+    def day_codes(self):
+        """
+        The state code for every day, in one go
+        """
+
+        return np.repeat(self.codes, self.ends - self.starts)
+
+    def day_index(self):
+        """
+        Every day's date, as dates if our origin is a date and as a
+        DatetimeIndex if it's a datetime
+        """
+
+        offsets = np.arange(self.days).astype('timedelta64[D]')
+
+        if isinstance(self.origin, datetime):
+            return pd.DatetimeIndex(np.datetime64(self.origin) + offsets)
+
+        return (np.datetime64(self.origin, 'D') + offsets).astype(object)
+
+    def series(self, categorical=False):
+        """
+        The day by day history, with its states as a Categorical if asked
+        """
+
+        if self.days == 0:
+            return pd.Series([], index=[])
+
+        codes = self.day_codes()
+
+        if categorical:
+            used = np.unique(self.codes)
+            codes = np.searchsorted(used, codes)
+            names = [state_name(code) for code in used]
+
+            # Categoricals have no None category, just missing values
+            if None in names:
+                none = names.index(None)
+                codes[codes == none] = -1
+                codes[codes > none] -= 1
+                del names[none]
+
+            states = pd.Categorical.from_codes(codes, names)
+        else:
+            states = np.array(_states, dtype=object)[codes]
+
+        return pd.Series(states, index=self.day_index())
+
+    def dates_in(self, states, weekday=None):
+        """
+        Each date we were in one of states, only those on weekday if given
+        """
+
+        for start, end, state in self:
+
+            if state not in states:
+                continue
+
+            first = start
+            step = 1
+
+            if weekday is not None:
+                first += (weekday - self.date(start).weekday()) % 7
+                step = 7
+
+            for day in range(first, min(end, self.days), step):
+                yield self.date(day)
@@ -13,16 +13,29 @@ Also abstracts away from batch searching and other implementation
 details we don't want to present to the user.
 """
 
+import dateutil.parser
 import jira.client
+import multiprocessing
 import sys
 
-from datetime import date, datetime
+from datetime import date, datetime, time, timedelta
+from dateutil.tz import tzlocal
 
 from index import week_start_date
-from history import time_in_states, cycle_time, history_from_jira_changelog
+from history import time_in_states, jira_state_transition
+from intervals import StateIntervals
+from parsing import parse_issue, parse_record, init_worker, created_date
+from cycles import compile_cycles, cycle_time_kernel, cycle_times_by_name, transition_cycle_times
 from exceptions import MissingConfigItem
 from work import WorkItem
-import dateutil.parser
+from workers import WorkerPool
+from scheduler import RequestScheduler
+from records import issue_record, history_record, field_value, Record
+from sync_store import SyncStore
+
+
+# The Jira fields every WorkItem is made from.  Changelogs come via expand.
+_WORK_ITEM_FIELDS = ['summary', 'status', 'issuetype', 'created']
 
 
 class JiraWrapper(object):
@@ -30,6 +43,13 @@ class JiraWrapper(object):
     Wrapper around our JIRA instance
     """
 
+    # How many requests we have in flight unless told otherwise
+    default_concurrency = 1
+
+    # How far before we last synced we ask for updates from, to allow for
+    # Jira's user being in any time zone from ours or its server's
+    sync_overlap = timedelta(days=1)
+
     def __init__(self, config):
 
         authentication = None
@@ -70,6 +90,35 @@ class JiraWrapper(object):
         self.cycles = None
         self.types = None
         self.until_date = None
+        self.batch_size = 100
+        self.changelog_batch_size = 100
+        self.concurrency = self.default_concurrency
+        self.store = None
+
+        if 'concurrency' in source:
+            self.concurrency = source['concurrency']
+
+        if 'store' in source:
+            self.store = SyncStore(source['store'])
+
+        # Parse changelogs in this many processes
+        self.parse_processes = 1
+
+        if 'parse_processes' in source:
+            self.parse_processes = source['parse_processes']
+
+        # Pace our requests to whatever rate the server will let us have.
+        # It tells us in its response headers if it can.
+
+        self.scheduler = RequestScheduler(concurrency=self.concurrency,
+                                          batch_size=self.batch_size)
+
+        if 'requests_per_second' in source:
+            self.scheduler.rate = source['requests_per_second']
+
+        session = getattr(self.jira, '_session', None)
+        if session is not None:
+            session.hooks['response'].append(lambda response, *args, **kwargs: self.scheduler.observe(response.headers))
 
         if 'until_date' in config:
             self.until_date = datetime.strptime(config['until_date'], '%Y-%m-%d').date()
@@ -80,6 +129,28 @@ class JiraWrapper(object):
         except KeyError as e:
             raise MissingConfigItem(e.message, "Missing Config Item:{0}".format(e.message))
 
+        self.cycle_specs = compile_cycles(self.cycles)
+
+        # Are any cycles timed from state transitions rather than in days
+        self.timed_cycles = any(spec.unit != 'days' for spec in self.cycle_specs)
+
+        # Only ask Jira for the fields we actually use.  As well as the
+        # ones every WorkItem needs, detail reports can ask for any other
+        # Jira field by its id e.g. customfield_10002
+
+        self.extra_fields = []
+
+        if 'reports' in config:
+            for report in config['reports']:
+                if report['metric'] == 'detail' and 'fields' in report:
+                    for field in report['fields']:
+                        if (field not in WorkItem.detail_fields and
+                                field not in self.cycles and
+                                field not in self.extra_fields):
+                            self.extra_fields.append(field)
+
+        self.fields = ','.join(_WORK_ITEM_FIELDS + self.extra_fields)
+
         self.all_issues = None
 
     def work_items(self):
@@ -87,10 +158,26 @@ class JiraWrapper(object):
         All issues
         """
         if self.all_issues is None:
-            self.all_issues = self._issues_from_jira()
+            self.all_issues = list(self.iter_work_items())
 
         return self.all_issues
 
+    def iter_work_items(self):
+        """
+        All issues, a page at a time.
+
+        Unlike work_items() we don't hold on to anything, so each page of
+        issues and their changelogs can go as soon as we have made
+        WorkItems out of it.
+        """
+        if self.all_issues is not None:
+            return iter(self.all_issues)
+
+        if self.store is None:
+            return self._iter_issues_from_jira()
+
+        return self._iter_issues_from_store()
+
 
     def totals(self):
         """
@@ -112,133 +199,439 @@ class JiraWrapper(object):
         Get the actual issues from Jira itself via the Jira REST API
         """
 
-        batch_size = 100
-        work_items = []
+        return list(self._iter_issues_from_jira(filter))
+
+    def _iter_issues_from_jira(self, filter=None):
+        """
+        WorkItems for each page of issues as we get it
+        """
+
+        jqls = {}
+        for category in self.categories:
+            jqls[category] = self.categories[category]
+            if filter is not None:
+                jqls[category] = jqls[category] + filter
+
+        for work_item in self._work_items(self._fetch(jqls)):
+            yield work_item
+
+    def _iter_issues_from_store(self):
+        """
+        Only get the issues updated since we last synced each category and
+        merge them into our local store, then make WorkItems from the store.
+
+        Unchanged issues are rebuilt from their stored records rather than
+        from Jira as their histories still need to run up to until_date.
+
+        Jira reads the time we ask for updates since in its user's time
+        zone, which we don't know, so we ask for them since a little
+        before we last synced.  Asking for an issue again does no harm as
+        merging replaces it.
+
+        Issues that no longer match a category's query, or have gone, don't
+        show up as updated so first we ask for just the keys of those that
+        still match and drop the rest from the store.
+        """
+
+        synced_at = self._server_time().replace(second=0, microsecond=0)
 
+        jqls = {}
         for category in self.categories:
+            jqls[category] = self.categories[category]
+            last_sync = self.store.last_synced(category, self.categories[category], self.extra_fields)
+            if last_sync is not None:
+                self.store.prune(category, self._matching_keys(self.categories[category]))
+                jqls[category] = '({0}) AND updated >= "{1}"'.format(jqls[category],
+                                                                      (last_sync - self.sync_overlap).strftime('%Y-%m-%d %H:%M'))
+
+        updated = {}
+        for category in self.categories:
+            updated[category] = []
+
+        for category, issue_batch in self._fetch(jqls):
+            for issue in issue_batch:
+                updated[category].append((issue.key, issue_record(issue, self.extra_fields)))
+
+        for category in self.categories:
+            self.store.merge(category, updated[category], synced_at, self.categories[category], self.extra_fields)
+
+        self.store.save()
+
+        for work_item in self._work_items(self._stored_batches()):
+            yield work_item
+
+    def _server_time(self):
+        """
+        The time on Jira's clock, as it gives it, if it will tell us, and
+        otherwise on ours
+        """
+
+        try:
+            server_time = self.scheduler.call(self.jira.server_info)['serverTime']
+            return dateutil.parser.parse(server_time).replace(tzinfo=None)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return datetime.now()
+
+    def _matching_keys(self, jql):
+        """
+        The keys of every issue a search finds, without their fields or
+        changelogs
+        """
+
+        keys = set()
+        n = 0
+
+        while 1:
+
+            size = self.scheduler.batch_size
+            issue_batch = self.scheduler.call(self.jira.search_issues,
+                                              jql,
+                                              startAt=n,
+                                              maxResults=size,
+                                              fields='key')
+
+            keys.update(issue.key for issue in issue_batch)
+
+            if len(issue_batch) < size:
+                return keys
+            n += size
+
+    def _stored_batches(self):
+        """
+        Stored records for each category, a page's worth at a time
+        """
+
+        for category in self.categories:
+            records = self.store.category_records(category)
+            for n in range(0, len(records), self.batch_size):
+                yield category, [Record(record) for record in records[n:n + self.batch_size]]
+
+    def _fetch(self, jqls):
+        """
+        Pages of issues, with their whole changelogs, for each category
+        in category then page order
+        """
+
+        pool = WorkerPool(self.concurrency)
+
+        try:
+            for category, issue_batch in self._issue_batches(pool, jqls):
+                self._complete_changelogs(pool, issue_batch)
+                yield category, issue_batch
+        finally:
+            pool.close()
+
+    def _issue_batches(self, pool, jqls):
+        """
+        Pages of issues for each category, in category then page order.
+
+        Serially we keep asking for pages until we get a short one.  With more
+        than one worker we ask for the first page of every category at once,
+        use its total to work out the rest of the startAt offsets and then
+        keep all our workers busy asking for those, staying only a few
+        pages ahead of whoever is using them.
+
+        The scheduler can change the page size as we go so each offset is
+        worked out, with the page size at the time, just before we ask for it.
+        """
+
+        if pool.size == 1:
+            for category in self.categories:
+                for issue_batch in self._remaining_batches(jqls[category], 0):
+                    yield category, issue_batch
+            return
+
+        categories = list(self.categories)
+
+        first_size = self.scheduler.batch_size
+        first_batches = pool.map(lambda category: self._search_page(jqls[category], 0, first_size),
+                                 categories)
+
+        totals = {}
+        for category, first_batch in zip(categories, first_batches):
+            totals[category] = len(first_batch)
+            if len(first_batch) == first_size:
+                # No total to plan with so we will carry on the slow way
+                totals[category] = getattr(first_batch, 'total', None)
+
+        def offsets():
+            for category in categories:
+                n = first_size
+                while totals[category] is not None and n < totals[category]:
+                    size = self.scheduler.batch_size
+                    yield category, n, size
+                    n += size
+
+        pages = pool.imap(lambda offset: (offset[1] + offset[2], self._search_page(jqls[offset[0]], offset[1], offset[2])),
+                          offsets())
+
+        for i, category in enumerate(categories):
 
-            n = 0
-            while 1:
-
-                jql = self.categories[category]
-                if filter is not None:
-                    jql = jql + filter
-
-                issue_batch = self.jira.search_issues(jql,
-                                                      startAt=n,
-                                                      maxResults=batch_size,
-                                                      expand='changelog')
-
-                if issue_batch is None:
-                    #TODO: Fix mocking so we can get rid of this.
-                    # 'expand' seems to have some magic meaning in Mockito...
-                    issue_batch = self.jira.search_issues(jql,
-                                                          startAt=n,
-                                                          maxResults=batch_size)
-
-                for issue in issue_batch:
-
-                    issue.category = category
-                    issue_history = None
-                    cycles = {}
-
-                    date_created = datetime.strptime(issue.fields.created[:10], '%Y-%m-%d')
-
-                    if issue.changelog is not None:
-                        issue_history = history_from_jira_changelog(issue.changelog, date_created, self.until_date)
-
-                        try:
-
-                            for cycle in self.cycles:
-                                reopened_state = None
-                                after_state = None
-                                start_state = None
-                                exit_state = None
-                                end_state = None
-                                include_states = None
-                                exclude_states = None
-
-                                if 'ignore' in self.cycles[cycle]:
-                                    reopened_state = self.cycles[cycle]['ignore']
-
-                                if 'after' in self.cycles[cycle]:
-                                    after_state = self.cycles[cycle]['after']
-
-                                if 'start' in self.cycles[cycle]:
-                                    start_state = self.cycles[cycle]['start']
-
-                                if 'exit' in self.cycles[cycle]:
-                                    exit_state = self.cycles[cycle]['exit']
-
-                                if 'include' in self.cycles[cycle]:
-                                    include_states = self.cycles[cycle]['include']
-
-                                if 'exclude' in self.cycles[cycle]:
-                                    exclude_states = self.cycles[cycle]['exclude']
-
-                                if 'end' in self.cycles[cycle]:
-                                    end_state = self.cycles[cycle]['end']
-
-                                    cycles[cycle] = cycle_time(issue_history,
-                                                               start_state=start_state,
-                                                               after_state=after_state,
-                                                               include_states=include_states,
-                                                               exclude_states=exclude_states,
-                                                               end_state=end_state,
-                                                               reopened_state=reopened_state)
-
-                                else:
-
-                                    cycles[cycle] = cycle_time(issue_history,
-                                                               start_state=start_state,
-                                                               after_state=after_state,
-                                                               include_states=include_states,
-                                                               exclude_states=exclude_states,
-                                                               exit_state=exit_state,
-                                                               reopened_state=reopened_state)
-
-                        except AttributeError:
-
-                            pass
-
-                    state_transitions = []
-                    if issue.changelog is not None:
-                        for change in issue.changelog.histories:
-                            st = self.state_transition(change)
-                            state_transitions.append(st)
-
-                    work_items.append(WorkItem(id=issue.key,
-                                               title=issue.fields.summary,
-                                               state=issue.fields.status.name,
-                                               type=issue.fields.issuetype.name,
-                                               history=issue_history,
-                                               state_transitions=state_transitions,
-                                               date_created=date_created,
-                                               cycles=cycles,
-                                               category=category))
-
-                if len(issue_batch) < batch_size:
-                    break
-                n += batch_size
+            # Let go of each page as soon as we've handed it on
+            first_batch, first_batches[i] = first_batches[i], None
+
+            yield category, first_batch
+
+            if totals[category] is None:
+                for issue_batch in self._remaining_batches(jqls[category], first_size):
+                    yield category, issue_batch
+                continue
+
+            n = first_size
+            while n < totals[category]:
                 sys.stdout.write('.')
                 sys.stdout.flush()
+                n, issue_batch = next(pages)
+                yield category, issue_batch
+
+    def _remaining_batches(self, jql, n):
+        """
+        Pages of issues for a search from startAt n until we get a short one
+        """
 
-        return work_items
+        while 1:
 
-    def state_transition(self, history):
+            size = self.scheduler.batch_size
+            issue_batch = self._search_page(jql, n, size)
 
-        timestamp = dateutil.parser.parse(history.created)
+            yield issue_batch
 
-        for item in history.items:
-            if item.field == 'status':
-                from_state = item.fromString
-                to_state = item.toString
+            if len(issue_batch) < size:
+                break
+            n += size
+            sys.stdout.write('.')
+            sys.stdout.flush()
 
-                return {'from': from_state,
-                        'to': to_state,
-                        'timestamp': timestamp}
+    def _search_page(self, jql, n, size):
+        """
+        One page of issues for a search starting at n
+        """
 
-        return None
+        issue_batch = self.scheduler.call(self.jira.search_issues,
+                                          jql,
+                                          startAt=n,
+                                          maxResults=size,
+                                          fields=self.fields,
+                                          expand='changelog')
+
+        if issue_batch is None:
+            #TODO: Fix mocking so we can get rid of this.
+            # 'expand' seems to have some magic meaning in Mockito...
+            issue_batch = self.scheduler.call(self.jira.search_issues,
+                                              jql,
+                                              startAt=n,
+                                              maxResults=size,
+                                              fields=self.fields)
+
+        return issue_batch
+
+    def _complete_changelogs(self, pool, issue_batch):
+        """
+        Jira only embeds so many histories in each issue's changelog so for
+        any issue that has more we get the whole changelog from the issue's
+        own changelog resource, all the pages for all the issues at once.
+        """
+
+        truncated = [issue for issue in issue_batch if self._changelog_truncated(issue)]
+
+        if not truncated:
+            return
+
+        pages = self._changelog_pages(truncated)
+
+        self._replace_changelogs(truncated, pages, pool.map(lambda page: self._changelog_page(*page), pages))
+
+    def _changelog_pages(self, truncated):
+        """
+        (key, startAt) of every page of the changelogs of truncated issues
+        """
+
+        pages = []
+        keys = set()
+        for issue in truncated:
+            # The same issue can turn up in more than one category's page
+            if issue.key in keys:
+                continue
+            keys.add(issue.key)
+            for n in range(0, issue.changelog.total, self.changelog_batch_size):
+                pages.append((issue.key, n))
+
+        return pages
+
+    def _replace_changelogs(self, truncated, pages, responses):
+
+        histories = {}
+        for (key, n), page in zip(pages, responses):
+            histories.setdefault(key, []).extend(page['values'])
+
+        for issue in truncated:
+            # Keep the histories in whatever order Jira embedded them in
+
+            # Timestamps can be in different UTC offsets, either side of a
+            # change to daylight saving say, so we compare them as times
+            # rather than as strings
+
+            embedded = issue.changelog.histories
+            newest_first = not (len(embedded) > 1 and
+                                dateutil.parser.parse(embedded[0].created) < dateutil.parser.parse(embedded[-1].created))
+
+            complete = sorted(histories.get(issue.key, []),
+                              key=lambda history: dateutil.parser.parse(history['created']),
+                              reverse=newest_first)
+
+            issue.changelog = Record({'histories': [history_record(Record(history)) for history in complete],
+                                      'total': len(complete)})
+
+    def _changelog_truncated(self, issue):
+
+        if issue.changelog is None:
+            return False
+
+        total = getattr(issue.changelog, 'total', None)
+
+        return total is not None and len(issue.changelog.histories) < total
+
+    def _changelog_page(self, key, n):
+        """
+        One page of an issue's changelog starting at n
+        """
+
+        # The jira client has no public call for an issue's changelog
+        # resource, so this is the one place we use its _get_json, which
+        # GETs any REST path with the client's own server, session and
+        # authentication.
+        return self.scheduler.call(self.jira._get_json,
+                                   'issue/{0}/changelog'.format(key),
+                                   params={'startAt': n,
+                                           'maxResults': self.changelog_batch_size})
+
+    def _work_items(self, batches):
+        """
+        WorkItems for each (category, issues) batch.
+
+        With more than one parse process we send each batch off to be parsed
+        and make WorkItems out of the last one while we wait.
+        """
+
+        if self.parse_processes == 1:
+            for category, issue_batch in batches:
+                parsed = [(issue,) + parse_issue(issue, self.until_date) for issue in issue_batch]
+                for work_item in self._parsed_work_items(category, parsed):
+                    yield work_item
+            return
+
+        # Start our workers before we've got any fetching threads to fork
+        processes = multiprocessing.Pool(self.parse_processes,
+                                         initializer=init_worker,
+                                         initargs=(self.until_date,))
+
+        try:
+            parsing = None
+
+            for category, issue_batch in batches:
+
+                records = [issue_record(issue, self.extra_fields) for issue in issue_batch]
+                chunksize = max(1, len(records) // (self.parse_processes * 4))
+
+                parsed = (category, records, processes.map_async(parse_record, records, chunksize))
+
+                if parsing is not None:
+                    for work_item in self._parsed_records(*parsing):
+                        yield work_item
+
+                parsing = parsed
+
+            if parsing is not None:
+                for work_item in self._parsed_records(*parsing):
+                    yield work_item
+        finally:
+            processes.terminate()
+            processes.join()
+
+    def _parsed_records(self, category, records, parsing):
+
+        parsed = [(Record(record), runs, state_transitions)
+                  for record, (runs, state_transitions) in zip(records, parsing.get())]
+
+        return self._parsed_work_items(category, parsed)
+
+    def _parsed_work_items(self, category, parsed):
+        """
+        WorkItems for a batch of (issue, runs, state transitions), working
+        out every issue's cycle times together
+        """
+
+        intervals = []
+        for issue, runs, state_transitions in parsed:
+            if runs is None:
+                intervals.append(None)
+            else:
+                intervals.append(StateIntervals.from_runs(runs, created_date(issue)))
+
+        times = cycle_time_kernel(intervals, self.cycle_specs)
+
+        # Only cycles timed from state transitions need timestamps parsed
+        if self.timed_cycles:
+            until = self._until_time()
+
+        for (issue, runs, state_transitions), issue_intervals, issue_times in zip(parsed, intervals, times):
+
+            cycles = {}
+            if issue_intervals is not None:
+                cycles = cycle_times_by_name(issue_times, self.cycle_specs)
+                if self.timed_cycles:
+                    cycles.update(transition_cycle_times(self.cycle_specs,
+                                                         state_transitions,
+                                                         dateutil.parser.parse(issue.fields.created),
+                                                         until))
+
+            yield self._work_item(issue, category, issue_intervals, cycles, state_transitions)
+
+    def _until_time(self):
+        """
+        When cycles timed from state transitions run until, the end of
+        until_date if we have one and otherwise now, in our time zone
+        """
+
+        if self.until_date is None:
+            return datetime.now(tzlocal())
+
+        return datetime.combine(self.until_date + timedelta(days=1), time()).replace(tzinfo=tzlocal())
+
+    def _work_item_from_issue(self, issue, category):
+        """
+        Turn a Jira issue, with its changelog, into one of our WorkItems
+        """
+
+        parsed = [(issue,) + parse_issue(issue, self.until_date)]
+
+        return next(self._parsed_work_items(category, parsed))
+
+    def _work_item(self, issue, category, intervals, cycles, state_transitions):
+
+        issue.category = category
+
+        fields = None
+        if self.extra_fields:
+            fields = {}
+            for field in self.extra_fields:
+                fields[field] = field_value(getattr(issue.fields, field, None))
+
+        return WorkItem(id=issue.key,
+                        title=issue.fields.summary,
+                        state=issue.fields.status.name,
+                        type=issue.fields.issuetype.name,
+                        history=None,  # Made from the intervals if anyone wants it
+                        intervals=intervals,
+                        state_transitions=state_transitions,
+                        date_created=created_date(issue),
+                        cycles=cycles,
+                        category=category,
+                        fields=fields)
+
+    def state_transition(self, history):
+
+        return jira_state_transition(history)
 
     # This is on its way out
 
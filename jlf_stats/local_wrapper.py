@@ -0,0 +1,107 @@
+"""
+Work items saved by Metrics.save_work_items, read back in.
+
+Lets us rerun reports, e.g. to try out a new layout, without going back
+to Jira or FogBugz for everything again.
+"""
+
+import json
+import dateutil.parser
+import pandas as pd
+
+from exceptions import MissingConfigItem
+from work import WorkItem
+from intervals import StateIntervals
+
+
+class LocalWrapper(object):
+    """
+    Wrapper around a file of saved work items
+    """
+
+    def __init__(self, config):
+
+        try:
+            source = config['source']
+        except KeyError as e:
+            raise MissingConfigItem(e, "Missing Config Item:{0}".format(e))
+
+        if 'filename' in source:
+            self.filename = source['filename']
+        elif 'name' in config:
+            self.filename = config['name'] + '.json'
+        else:
+            self.filename = 'local.json'
+
+        self.all_issues = None
+
+    def work_items(self):
+        """
+        All the saved work items
+        """
+
+        if self.all_issues is None:
+            self.all_issues = list(self.iter_work_items())
+
+        return self.all_issues
+
+    def iter_work_items(self):
+
+        if self.all_issues is not None:
+            return iter(self.all_issues)
+
+        try:
+            with open(self.filename, 'r') as saved_file:
+                saved = json.load(saved_file)
+        except IOError:
+            raise MissingConfigItem('filename', "Saved work items not found:{0}".format(self.filename))
+
+        return (work_item_from_saved(item) for item in saved)
+
+
+def work_item_from_saved(item):
+    """
+    Rebuild a WorkItem from what WorkItem.to_JSON gave us
+    """
+
+    history = item['history']
+    intervals = None
+
+    if isinstance(history, list):
+        # State transitions, as FogBugz gives us
+        history = [transition_from_saved(transition) for transition in history]
+    elif history is not None:
+        # A day by day Series, as Jira gives us, saved by Pandas
+        # with its dates as milliseconds since the epoch
+        days = sorted((int(day), state) for day, state in json.loads(history).items())
+        history = pd.Series([state for day, state in days],
+                            index=pd.to_datetime([day for day, state in days], unit='ms'))
+        intervals = StateIntervals.from_series(history)
+        history = None
+
+    state_transitions = item.get('state_transitions')
+
+    if state_transitions is not None:
+        state_transitions = [transition_from_saved(transition) for transition in state_transitions]
+
+    return WorkItem(id=item['id'],
+                    title=item['title'],
+                    state=item['state'],
+                    type=item['type'],
+                    history=history,
+                    intervals=intervals,
+                    date_created=dateutil.parser.parse(item['date_created']),
+                    state_transitions=state_transitions,
+                    category=item.get('category'),
+                    cycles=item.get('cycles'),
+                    fields=item.get('fields'))
+
+
+def transition_from_saved(transition):
+
+    if transition is None:
+        return None
+
+    return {'from': transition['from'],
+            'to': transition['to'],
+            'timestamp': dateutil.parser.parse(transition['timestamp'])}
@@ -3,6 +3,7 @@ Metrics
 """
 from jlf_stats.fogbugz_wrapper import FogbugzWrapper
 from jlf_stats.jira_wrapper import JiraWrapper
+from jlf_stats.local_wrapper import LocalWrapper
 
 import pandas as pd
 import numpy as np
@@ -10,12 +11,17 @@ import math
 
 import exceptions
 from bucket import bucket_labels
-from index import fill_date_index_blanks, week_start_date
-from history import arrivals, history_from_state_transitions
+from index import week_starts
+from history import arrivals
+from intervals import StateIntervals
+from work import WorkItemStore, day_created
+from state_matrix import StateMatrix
+from sketch import QuantileSketch, DEFAULT_ACCURACY, percentiles_frame
 
 import re
 import os
 import json
+import hashlib
 
 class Metrics(object):
 
@@ -34,7 +40,31 @@ class Metrics(object):
             if m is not None:
                 self.config['source']['authentication']['password'] = os.environ.get(m.group(1), 'undefined')
 
-            self.source = JiraWrapper(self.config)
+            if 'engine' in self.config['source'] and self.config['source']['engine'] == 'async':
+                # Only needs Tornado if we use it
+                from jlf_stats.async_jira_wrapper import AsyncJiraWrapper
+                self.source = AsyncJiraWrapper(self.config)
+            else:
+                self.source = JiraWrapper(self.config)
+        elif config['source']['type'] == 'local':
+            self.source = LocalWrapper(self.config)
+
+        # Stream work items from the source for every metric rather than
+        # holding them all in memory
+
+        self.streaming = False
+
+        if 'streaming' in config:
+            self.streaming = config['streaming']
+
+        # Keep every item's daily states in a file we can map into memory,
+        # and reuse it on later runs
+
+        self.state_matrix_file = None
+        self._state_matrix = None
+
+        if 'state_matrix' in config:
+            self.state_matrix_file = config['state_matrix']
 
         if 'throughput_dow' in config:
             self.throughput_dow = config['throughput_dow']
@@ -62,19 +92,45 @@ class Metrics(object):
         This is a case in FogBugz or an Issue in Jira.
         """
         if self.work_items is None:
-            self.work_items = self.source.work_items()
+            self.load_work_items()
 
-        matches = [work_item for work_item in self.work_items if work_item.id == id]
-        return matches[0]
+        return self.work_items.get(id)
 
-    def details(self, fields=None):
+    def load_work_items(self):
+
+        self.work_items = WorkItemStore(self.source.work_items(), self.types)
+
+    def iter_work_items(self, types=None):
+        """
+        Go through the work items, optionally only those of some types, one
+        at a time.
+
+        If we are streaming we get them from the source afresh each time and
+        don't keep them, so memory only grows with the source's page size.
+        """
 
         if self.work_items is None:
-            self.work_items = self.source.work_items()
+            if self.streaming:
+                work_items = self.source.iter_work_items()
+
+                if types is None:
+                    return work_items
+
+                return (work_item for work_item in work_items
+                        if any(work_item.type in self.types[type_grouping] for type_grouping in types))
+
+            self.load_work_items()
+
+        if types is None:
+            return iter(self.work_items)
+
+        return iter(self.work_items.of_types(types))
+
+    def details(self, fields=None):
 
         details = []
 
-        for work_item in self.work_items:
+        for work_item in self.iter_work_items():
             details.append(work_item.detail())
 
         df = pd.DataFrame(details)
@@ -86,31 +142,152 @@ class Metrics(object):
 
     def history(self, from_date=None, until_date=None, types=None):
 
-        if self.work_items is None:
-            self.work_items = self.source.work_items()
+        return self.state_matrix(until_date, types).frame()
 
-        history = {}
+    def state_matrix(self, until_date=None, types=None):
+        """
+        Every work item's state on every day, optionally only those of
+        some types
+        """
 
-        for work_item in self.work_items:
+        matrix = self.all_states(until_date)
 
-            if types is None:
-                # HACK HACK HACK
-                # Also need some consistency around thing_date and date_thing
-                if isinstance(self.source, JiraWrapper):
-                    history[work_item.id] = work_item.history
-                else:
-                    history[work_item.id] = history_from_state_transitions(work_item.date_created.date(), work_item.history, until_date)
-            else:
-                for type_grouping in types:
-                    if work_item.type in self.types[type_grouping]: 
-                        if isinstance(self.source, JiraWrapper):
-                            history[work_item.id] = work_item.history
-                        else:
-                            history[work_item.id] = history_from_state_transitions(work_item.date_created.date(), work_item.history, until_date)
-
-        if history is not None:
-            df = pd.DataFrame(history)
-            return df
+        if types is not None:
+            matrix = matrix.select([any(work_type in self.types[type_grouping] for type_grouping in types)
+                                    for work_type in matrix.types])
+
+        return matrix
+
+    def all_states(self, until_date=None):
+        """
+        Every work item's state on every day, with codes for our configured
+        states coming first.
+
+        We only make this once for each until_date.  If we have a state
+        matrix file we save it there and work from the file.  If the file
+        is already there from an earlier run we use that instead, as long
+        as it was made from the same config and the same work items.  We
+        always go through the work items first, which syncs any store, so
+        we never reuse one made before the source changed.
+        """
+
+        until = None
+        if until_date is not None:
+            until = str(until_date)
+
+        if self._state_matrix is not None and self._state_matrix.until_date == until:
+            return self._state_matrix
+
+        filename = self.state_matrix_file
+
+        intervals = {}
+        categories = {}
+        types = {}
+
+        for work_item in self.iter_work_items():
+
+            # Each work item goes in the first category we find it in
+            if work_item.id in intervals:
+                continue
+
+            intervals[work_item.id] = self.state_intervals(work_item, until_date)
+            categories[work_item.id] = work_item.category
+            types[work_item.id] = work_item.type
+
+        fingerprint = self.state_matrix_fingerprint(until, intervals, categories, types)
+
+        if filename is not None:
+            matrix = self._saved_state_matrix(filename, fingerprint)
+            if matrix is not None:
+                self._state_matrix = matrix
+                return matrix
+
+        matrix = StateMatrix.from_intervals(intervals, self.states, categories, types, filename)
+        matrix.until_date = until
+        matrix.fingerprint = fingerprint
+
+        if filename is not None:
+            matrix.save(filename)
+            matrix = StateMatrix.load(filename)
+
+        self._state_matrix = matrix
+
+        return matrix
+
+    def state_matrix_fingerprint(self, until, intervals, categories, types):
+        """
+        What a state matrix depends on: the date it goes up to, where we
+        get work items from and how we group them, and the work items
+        themselves.
+        """
+
+        source = self.config['source']
+
+        fingerprint = {'until_date': until,
+                       'source': dict((key, source[key]) for key in ['type', 'server', 'url', 'filename']
+                                      if key in source),
+                       'states': [state for state in self.states if state is not None],
+                       'types': self.types}
+
+        if 'name' in self.config:
+            fingerprint['name'] = self.config['name']
+
+        if 'categories' in self.config:
+            fingerprint['categories'] = self.config['categories']
+
+        # Rather than when a store last synced, which moves on every run
+        # whether anything changed or not
+        digest = hashlib.sha1()
+
+        for key in sorted(intervals):
+
+            if intervals[key] is None:
+                continue
+
+            digest.update(json.dumps([key,
+                                      categories[key],
+                                      types[key],
+                                      str(intervals[key].origin),
+                                      [[int(start), int(end), state] for start, end, state in intervals[key]]]))
+
+        fingerprint['work_items'] = {'count': len(intervals),
+                                     'digest': digest.hexdigest()}
+
+        # As it would come back from the file
+        return json.loads(json.dumps(fingerprint))
+
+    def _saved_state_matrix(self, filename, fingerprint):
+        """
+        The state matrix saved in filename, if there is one and it has
+        the fingerprint we'd give it
+        """
+
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            matrix = StateMatrix.load(filename)
+        except (IOError, ValueError, KeyError):
+            return None
+
+        if matrix.fingerprint != fingerprint:
+            return None
+
+        return matrix
+
+    def state_intervals(self, work_item, until_date=None):
+        """
+        A work item's history as runs of days in each state
+        """
+
+        if work_item.intervals is not None:
+            return work_item.intervals
+
+        if isinstance(work_item.history, list):
+            return StateIntervals.from_transitions(work_item.date_created.date(), work_item.history, until_date)
+
+        if work_item.history is not None:
+            return StateIntervals.from_series(work_item.history)
 
         return None
 
@@ -128,99 +305,137 @@ class Metrics(object):
         allows us the most options as to where to place the 'finishing line'
         """
 
-        work_item_history = self.history(from_date, to_date)
+        matrix = self.all_states(to_date)
 
-        work_item_rows = []
+        swimlanes = []
 
-        for work_item_key in work_item_history:
+        for work_category, work_type in zip(matrix.categories, matrix.types):
 
-            work_item = self.work_item(work_item_key)
+            swimlanes.append(None)
 
             if category is not None:
 
-                if category != work_item.category:
+                if category != work_category:
                     continue
 
-            swimlane = work_item.category
+            swimlane = work_category
 
             # Are we grouping by work type?
 
             if types is not None:
                 for type_grouping in types:
-                    if work_item.type in self.types[type_grouping]:
+                    if work_type in self.types[type_grouping]:
                         swimlane = swimlane + '-' + type_grouping
                     else:
                         continue
                         # print "Not counting " + f.work_itemtype.name
-                if swimlane == work_item.category:
+                if swimlane == work_category:
                     continue
 
-            for day, state in work_item_history[work_item_key].iteritems():
-                if day.weekday() == self.throughput_dow:
+            swimlanes[-1] = swimlane
 
-                    if state in self.counts_towards_throughput:
+        table = matrix.counts_on(self.counts_towards_throughput, self.throughput_dow, swimlanes)
 
-                        work_item_row = {'swimlane': swimlane,
-                                         'id':       work_item_key,
-                                         'week':     day,
-                                         'count':    1}
-                        work_item_rows.append(work_item_row)
+        if len(table.index) == 0:
+            return None
 
-        df = pd.DataFrame(work_item_rows)
+        table.index.name = 'week'
+        table.columns.name = 'swimlane'
 
-        if len(df.index) > 0:
+        if cumulative:
+            return table
 
-            table = pd.pivot_table(df, index=['week'], columns=['swimlane'], values='count', aggfunc=np.count_nonzero)
+        counts = table.values.copy()
+        counts[1:] = table.values[1:] - table.values[:-1]
 
-            if cumulative:
-                return table
+        return pd.DataFrame(counts, index=table.index, columns=table.columns)
 
-            else:
+    def cfd(self, from_date=None, until_date=None, types=None):
+        """
+        Cumulative Flow Diagram
+        """
 
-                def de_cumulative(x):
-                    for i in range(x.size-1, 0, -1):
-                        x[i] = x[i] - x[i-1]
-                    return x
+        matrix = self.state_matrix(until_date, types)
+        counts = self.state_counts(matrix)
 
-                table = table.apply(de_cumulative)
+        # Lay each day's work items out in state order, those with no
+        # history that day first as NaN, by repeating each state as many
+        # times as there are items in it
+        names = np.array([np.nan] + self.states, dtype=object)
+        order = np.tile(np.arange(len(names)), counts.shape[0])
 
-                return table
+        layout = names[np.repeat(order, counts.ravel())].reshape(counts.shape[0], len(matrix.keys))
 
-        else:
+        return pd.DataFrame(layout.T, columns=matrix.day_index())
 
-            return None
+    def cfd_counts(self, from_date=None, until_date=None, types=None):
+        """
+        How many work items were in each of our states on each day
+        """
 
-    def cfd(self, from_date=None, until_date=None, types=None):
+        matrix = self.state_matrix(until_date, types)
+        counts = self.state_counts(matrix)
+
+        # Only FogBugz cases with no transitions are ever in the None state
+        columns = [n for n, state in enumerate(self.states)
+                   if state is not None or counts[:, n + 1].any()]
+
+        cfd_counts = pd.DataFrame(counts[:, 1:][:, columns],
+                                  index=matrix.day_index(),
+                                  columns=[self.states[n] for n in columns])
+
+        cfd_counts.index.name = 'day'
+        cfd_counts.columns.name = 'state'
+
+        return cfd_counts
+
+    def state_counts(self, matrix):
         """
-        Cumulative Flow Diagram
+        How many of a state matrix's items there are in each of our states
+        on each day, as a days by states array, with the number with no
+        history that day first
         """
 
-        cfd = self.history(from_date, until_date, types)
+        # Where each of the matrix's states comes in our order of states,
+        # and the codes for any states we don't have
+        order = []
+        unknown = []
 
-        days = {}
+        for code, state in enumerate(matrix.states):
+            try:
+                order.append(self.states.index(state))
+            except ValueError:
+                order.append(-1)
+                if not (isinstance(state, float) and math.isnan(state)):
+                    unknown.append(code)
 
-        for day in cfd.index:
-            tickets = []
-            for ticket in cfd.ix[day]:
-                tickets.append(ticket)
+        # MISSING is -1 so picks out the -1 on the end.  Then everything
+        # moves up one so days with no history are counted first.
+        ranks_of = np.array(order + [-1], dtype=np.int64) + 1
 
-            def state_order(state):
+        width = len(self.states) + 1
 
-                try:
-                    return self.states.index(state)
-                except ValueError:
-                    if type(state) == float:
-                        if math.isnan(state):
-                            return -1
-                    if type(state) == np.float64:
-                        if math.isnan(state):
-                            return -1
+        # A block of days at a time, so only one block of a mapped matrix
+        # is read in, and our temporaries are only as big as a block
+        counts = [np.zeros((0, width), dtype=np.int64)]
+
+        for start, block in matrix.column_blocks():
 
+            if unknown:
+                found = np.in1d(block, unknown)
+                if found.any():
+                    state = matrix.states[block.ravel()[found][0]]
                     raise exceptions.MissingState(state, "Missing state:{0}".format(state))
 
-            days[day] = sorted(tickets, key=state_order)
+            days = block.shape[1]
+
+            # Count every day's states in one go by giving each day its
+            # own range of bins
+            bins = ranks_of[block] + width * np.arange(days)
 
-        return pd.DataFrame(days)
+            counts.append(np.bincount(bins.ravel(), minlength=width * days).reshape(days, width))
+
+        return np.concatenate(counts)
 
     def cycle_time_histogram(self,
                              cycle,
@@ -230,29 +445,11 @@ class Metrics(object):
         Time taken for work to complete one or more 'cycles' - i.e. transitions from a start state to an end state
         """
 
-        if self.work_items is None:
-            self.work_items = self.source.work_items()
-
         cycle_time_data = {}
 
-        for work_item in self.work_items:
-
-            if types is not None:
+        for work_item in self.iter_work_items(types):
 
-                include = False
-
-                for type_grouping in types:
-
-                    if work_item.type in self.types[type_grouping]:
-                        include = True
-                        key = "{0}-{1}".format(type_grouping, cycle)
-                        break
-
-                if not include:
-                    continue
-
-            else:
-                key = cycle
+            key = self._cycle_key(work_item, cycle, types)
 
             try:
                 if work_item.cycles[cycle] is not None:
@@ -293,6 +490,57 @@ class Metrics(object):
 
         return histogram
 
+    def cycle_time_sketches(self,
+                            cycle,
+                            types=None,
+                            accuracy=DEFAULT_ACCURACY):
+        """
+        A QuantileSketch of the times work took to complete a cycle, for
+        each type grouping if we're given types, filled in as work items
+        stream past
+        """
+
+        sketches = {}
+
+        for work_item in self.iter_work_items(types):
+
+            if work_item.cycles is None or work_item.cycles.get(cycle) is None:
+                continue
+
+            key = self._cycle_key(work_item, cycle, types)
+
+            if key not in sketches:
+                sketches[key] = QuantileSketch(accuracy)
+
+            sketches[key].add(work_item.cycles[cycle])
+
+        return sketches
+
+    def cycle_time_percentiles(self,
+                               cycle,
+                               types=None,
+                               percentiles=None,
+                               accuracy=DEFAULT_ACCURACY):
+        """
+        Service level percentiles of the time taken to complete a cycle,
+        p50, p85 and p95 unless told otherwise, each within accuracy of the
+        real figure
+        """
+
+        return percentiles_frame(self.cycle_time_sketches(cycle, types, accuracy), percentiles)
+
+    def _cycle_key(self, work_item, cycle, types):
+        """
+        What we report a work item's time for a cycle under
+        """
+
+        if types is not None:
+            for type_grouping in types:
+                if work_item.type in self.types[type_grouping]:
+                    return "{0}-{1}".format(type_grouping, cycle)
+
+        return cycle
+
     def demand(self,
                from_date,
                to_date,
@@ -301,54 +549,91 @@ class Metrics(object):
         Return the number of issues created each week - i.e. the demand on the system
         """
 
-        if self.work_items is None:
-            self.work_items = self.source.work_items()
+        created, categories, work_types = self._demand_columns(types)
 
-        details = []
+        # Each distinct category and type only needs its swimlane working
+        # out once
+        category_names, category_codes = np.unique(categories, return_inverse=True)
+        type_names, type_codes = np.unique(work_types, return_inverse=True)
 
-        for work_item in self.work_items:
-            detail = work_item.detail()
-            detail['count'] = 1  # Need to figure out where to put this
+        pairs, pair_codes = np.unique(category_codes * len(type_names) + type_codes, return_inverse=True)
 
-            # resolution_date_str = f.resolutiondate
+        pair_swimlanes = [self._demand_swimlane(category_names[pair // len(type_names)],
+                                                type_names[pair % len(type_names)],
+                                                types) for pair in pairs]
 
-            # if resolution_date_str is not None:
-            #     resolution_date = datetime.strptime(resolution_date_str[:10],
-            #                                         '%Y-%m-%d')
+        swimlanes, swimlane_of_pair = np.unique(np.array(pair_swimlanes, dtype=object), return_inverse=True)
+        swimlane_codes = swimlane_of_pair[pair_codes]
 
-            #     week = week_start_date(resolution_date.isocalendar()[0],
-            #                            resolution_date.isocalendar()[1]).strftime('%Y-%m-%d')
+        weeks = week_starts(created)
 
-            # else:
+        if len(weeks) == 0:
+            table = pd.DataFrame(index=pd.DatetimeIndex([]), columns=[])
+        else:
+            first = weeks.min()
+            week_codes = (weeks - first).astype(np.int64) // 7
+            num_weeks = week_codes.max() + 1
 
-            #     week = None
+            counts = np.bincount(week_codes * len(swimlanes) + swimlane_codes,
+                                 minlength=num_weeks * len(swimlanes)).reshape(num_weeks, len(swimlanes))
 
-            detail['week_created'] = week_start_date(detail['date_created'].isocalendar()[0],
-                                                     detail['date_created'].isocalendar()[1]).strftime('%Y-%m-%d')
+            table = pd.DataFrame(counts.astype(np.int64),
+                                 index=pd.DatetimeIndex(first + 7 * np.arange(num_weeks)),
+                                 columns=list(swimlanes))
 
-            include = True
+        table.index.name = 'week'
+        table.columns.name = 'swimlane'
 
-            swimlane = work_item.category
+        return table
 
-            if types is not None and self.types is not None:
-                include = False
-                for type_grouping in types:
-                    if work_item.type in self.types[type_grouping]:
-                        swimlane = swimlane + '-' + type_grouping
-                        include = True
+    def _demand_columns(self, types):
+        """
+        When each work item, optionally only those of some types, was
+        created, as a datetime64[D] array, and arrays of their categories
+        and types.
 
-            detail['swimlane'] = swimlane
+        From a store of work items we take its columns as they are, and
+        otherwise we collect them as work items stream past.
+        """
 
-            if include:
-                details.append(detail)
+        if self.work_items is None and self.streaming:
 
-        df = pd.DataFrame(details)
+            created = []
+            categories = []
+            work_types = []
+
+            for work_item in self.iter_work_items(types):
+                created.append(day_created(work_item))
+                categories.append(work_item.category)
+                work_types.append(work_item.type)
+
+            return (np.array(created, dtype='datetime64[D]'),
+                    np.array(categories, dtype=object),
+                    np.array(work_types, dtype=object))
+
+        if self.work_items is None:
+            self.load_work_items()
 
-        table = pd.pivot_table(df, index=['week_created'], columns=['swimlane'], values='count', aggfunc=np.count_nonzero)
+        created = self.work_items.created_dates()
+        categories = self.work_items.column('category')
+        work_types = self.work_items.column('type')
 
-        reindexed = table.reindex(index=fill_date_index_blanks(table.index), fill_value=np.int64(0))
-        reindexed.index.name = "week"
-        return reindexed
+        if types is not None:
+            positions = self.work_items.positions_of_types(types)
+            return created[positions], categories[positions], work_types[positions]
+
+        return created, categories, work_types
+
+    def _demand_swimlane(self, category, work_type, types):
+
+        swimlane = category
+
+        if types is not None:
+            for type_grouping in types:
+                if work_type in self.types[type_grouping]:
+                    swimlane = swimlane + '-' + type_grouping
+
+        return swimlane
 
     def arrival_rate(self,
                      from_date,
@@ -359,12 +644,9 @@ class Metrics(object):
         value chain?
         """
 
-        if self.work_items is None:
-            self.work_items = self.source.work_items()
-
         arrivals_count = {}
 
-        for work_item in self.work_items:
+        for work_item in self.iter_work_items():
             try:
                 arrivals_count = arrivals(work_item.history, arrivals_count)
             except AttributeError as e:
@@ -379,17 +661,14 @@ class Metrics(object):
     def save_work_items(self, filename=None):
 
         if filename is None:
-            if 'name' in self.config['name']:
+            if 'name' in self.config:
                 filename = self.config['name'] + '.json'
             else:
                 filename = 'local.json'
 
-        if self.work_items is None:
-            self.work_items = self.source.work_items()
-
         output = []
 
-        for item in self.work_items:
+        for item in self.iter_work_items():
             # This is so wrong.  We are decoding then encoding then decoding again...
             output.append(json.loads(item.to_JSON()))
 
@@ -0,0 +1,56 @@
+"""
+Turning issues' changelogs into how long they spent in each state and
+their state transitions.
+
+This is where the time goes once we've fetched everything, so as well as
+parsing issues as we go we can hand plain records of them to a pool of
+processes.  Workers send back how many days each issue spent in each
+state in turn rather than its whole day by day history, and we work out
+cycle times from those a batch at a time.
+"""
+
+from datetime import datetime
+
+from history import time_in_states, jira_state_transition
+from records import Record
+
+# Set in each worker process by init_worker
+_until_date = None
+
+
+def created_date(issue):
+
+    return datetime.strptime(issue.fields.created[:10], '%Y-%m-%d')
+
+
+def parse_issue(issue, until_date):
+    """
+    (runs, state transitions) for an issue, where runs are how many days
+    in turn it spent in each state
+    """
+
+    runs = None
+    state_transitions = []
+
+    if issue.changelog is not None:
+        runs = time_in_states(issue.changelog.histories, from_date=created_date(issue), until_date=until_date)
+
+        for change in issue.changelog.histories:
+            state_transitions.append(jira_state_transition(change))
+
+    return runs, state_transitions
+
+
+def init_worker(until_date):
+
+    global _until_date
+
+    _until_date = until_date
+
+
+def parse_record(record):
+    """
+    What a worker sends back for an issue record
+    """
+
+    return parse_issue(Record(record), _until_date)
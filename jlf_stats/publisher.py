@@ -10,6 +10,8 @@ import pandas as pd
 
 from xlsxwriter.utility import xl_rowcol_to_cell
 
+from sketch import DEFAULT_ACCURACY, load_sketches, merge_sketches, percentiles_frame, save_sketches
+
 _state_default_colours = ['#8dd3c7',
                           '#ffffb3',
                           '#bebada',
@@ -63,6 +65,9 @@ def publish(config, jira, from_date, to_date):
         if report['metric'] == 'cfd':
             data = jira.cfd(from_date, to_date, types=types)
 
+        if report['metric'] == 'cfd-counts':
+            data = jira.cfd_counts(from_date, to_date, types=types)
+
         if report['metric'] == 'demand':
             types = None
             if 'types' in report:
@@ -89,6 +94,30 @@ def publish(config, jira, from_date, to_date):
                 buckets = report['buckets']
             data = jira.cycle_time_histogram(report['cycles'][0], types=types, buckets=buckets)
 
+        if report['metric'] == 'cycle-time-percentiles':
+            types = None
+            if 'types' in report:
+                types = report['types']
+
+            accuracy = DEFAULT_ACCURACY
+            if 'accuracy' in report:
+                accuracy = report['accuracy']
+
+            sketches = jira.cycle_time_sketches(report['cycles'][0], types=types, accuracy=accuracy)
+
+            # Only save our own, so runs that merge in each other's
+            # sketches don't count the same work items again and again
+            if 'save' in report:
+                save_sketches(sketches, report['save'])
+
+            # Sketches saved by other runs, say for other parts of the
+            # portfolio, count towards our percentiles too
+            if 'merge' in report:
+                for filename in report['merge']:
+                    merge_sketches(sketches, load_sketches(filename))
+
+            data = percentiles_frame(sketches, report.get('percentiles'))
+
         if report['metric'] == 'arrival-rate':
             data = jira.arrival_rate(from_date, to_date)
 
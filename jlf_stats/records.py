@@ -0,0 +1,77 @@
+"""
+Plain records of Jira issues.
+
+A record is a dict holding just the parts of an issue we build WorkItems
+from, laid out the same way as the JSON the Jira REST API sends us.  They
+can be written to disk and read back as Records, which look enough like
+the issues jira.client gives us for JiraWrapper not to care which it has.
+"""
+
+
+def issue_record(issue, extra_fields=None):
+    """
+    Record of the parts of an issue we need to make a WorkItem, plus the
+    plain values of any extra fields
+    """
+
+    record = {'key': issue.key,
+              'fields': {'summary': issue.fields.summary,
+                         'status': {'name': issue.fields.status.name},
+                         'issuetype': {'name': issue.fields.issuetype.name},
+                         'created': issue.fields.created},
+              'changelog': None}
+
+    if extra_fields is not None:
+        for field in extra_fields:
+            record['fields'][field] = field_value(getattr(issue.fields, field, None))
+
+    if issue.changelog is not None:
+        record['changelog'] = {'histories': [history_record(history) for history in issue.changelog.histories]}
+
+    return record
+
+
+def history_record(history):
+
+    return {'created': history.created,
+            'items': [{'field': item.field,
+                       'fromString': item.fromString,
+                       'toString': item.toString} for item in history.items]}
+
+
+def field_value(value):
+    """
+    Plain value of a Jira field e.g. the name of a component or the value
+    of a select list.  Lists of them are joined with commas.
+    """
+
+    if isinstance(value, list):
+        return ",".join(unicode(field_value(item)) for item in value)
+
+    for attribute in ['value', 'name']:
+        if hasattr(value, attribute):
+            return getattr(value, attribute)
+
+    return value
+
+
+class Record(object):
+    """
+    Attribute access to a record, e.g. record.fields.status.name
+    """
+
+    def __init__(self, raw):
+
+        for name, value in raw.items():
+            setattr(self, name, _wrap(value))
+
+
+def _wrap(value):
+
+    if isinstance(value, dict):
+        return Record(value)
+
+    if isinstance(value, list):
+        return [_wrap(item) for item in value]
+
+    return value
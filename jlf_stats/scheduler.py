@@ -0,0 +1,268 @@
+"""
+Paces and retries the requests we make of a source.
+
+Hosted instances like Jira Cloud rate limit us and answer with a 429 when
+we ask for too much too quickly.  Rather than failing the whole run we
+wait as long as we are told to, back off, and ask with fewer requests in
+flight.  Where the server tells us its rate limits in response headers we
+pace ourselves to those so we don't get throttled in the first place.
+"""
+
+import random
+import threading
+import time
+
+from email.utils import parsedate_tz, mktime_tz
+
+# Too many requests
+_THROTTLED = [429]
+
+# The server is struggling, so ask for less at a time
+_OVERLOADED = [502, 503, 504]
+
+
+class RequestScheduler(object):
+    """
+    Run requests through a token bucket, at most `limit` at a time,
+    retrying with jittered backoff when we are throttled.
+
+    Both the limit on requests in flight and the page size we ask for
+    halve when we are throttled, or the server is overloaded, and creep
+    back up to where they started as requests succeed.
+    """
+
+    def __init__(self,
+                 concurrency=1,
+                 batch_size=100,
+                 rate=None,
+                 burst=None,
+                 max_retries=5,
+                 backoff=1.0,
+                 max_backoff=60.0,
+                 min_batch_size=10,
+                 clock=time.time,
+                 sleep=time.sleep):
+
+        self.max_concurrency = max(1, int(concurrency))
+        self.limit = self.max_concurrency
+
+        self.max_batch_size = batch_size
+        self.min_batch_size = min(min_batch_size, batch_size)
+        self.batch_size = batch_size
+
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.clock = clock
+        self.sleep = sleep
+
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._successes = 0
+        self._resume_at = 0
+        self._tokens = None
+        self._refilled_at = None
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func with args, retrying if we are throttled
+        """
+
+        attempt = 0
+
+        while True:
+
+            self._acquire()
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if self.retry_delay(e, attempt) is None:
+                    raise
+                attempt += 1
+            else:
+                self.succeeded()
+                return result
+            finally:
+                self._release()
+
+    def retry_delay(self, e, attempt):
+        """
+        How long to wait before trying again after the error e on our
+        attempt'th retry, or None if we shouldn't
+        """
+
+        status_code = getattr(e, 'status_code', None)
+
+        if status_code not in _THROTTLED + _OVERLOADED or attempt >= self.max_retries:
+            return None
+
+        delay = self._delay(e, attempt + 1)
+        self._throttled(status_code, delay)
+
+        return delay
+
+    def observe(self, headers):
+        """
+        Pace ourselves to the rate limits the server tells us about, e.g.
+
+            X-RateLimit-Limit:            size of the bucket
+            X-RateLimit-Remaining:        tokens left in it
+            X-RateLimit-FillRate:         tokens added each interval
+            X-RateLimit-Interval-Seconds: length of an interval
+            X-RateLimit-NearLimit:        true when we are close to running out
+        """
+
+        limit = _number(headers.get('X-RateLimit-Limit'))
+        remaining = _number(headers.get('X-RateLimit-Remaining'))
+        fill_rate = _number(headers.get('X-RateLimit-FillRate'))
+        interval = _number(headers.get('X-RateLimit-Interval-Seconds')) or 1
+
+        with self._condition:
+
+            if fill_rate:
+                self.rate = fill_rate / interval
+
+            if limit:
+                self.burst = limit
+
+            if remaining is not None and self._tokens is not None:
+                self._tokens = min(self._tokens, remaining)
+
+            if headers.get('X-RateLimit-NearLimit', '').lower() == 'true':
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+
+    def _acquire(self):
+        """
+        Wait for a slot, any pause we've been told to take and a token
+        """
+
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+        self.sleep(self.reserve())
+
+    def _release(self):
+
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def reserve(self):
+        """
+        Take a token and say how long until we can make our request.
+
+        We take our token straight away, even if the bucket is empty, so
+        everyone waiting gets their turn in the order they asked.
+        """
+
+        with self._condition:
+
+            now = self.clock()
+            wait = max(0, self._resume_at - now)
+
+            if self.rate is None:
+                return wait
+
+            burst = self.burst or max(1, self.rate)
+
+            if self._tokens is None:
+                self._tokens = burst
+            else:
+                self._tokens = min(burst, self._tokens + (now - self._refilled_at) * self.rate)
+
+            self._refilled_at = now
+            self._tokens -= 1
+
+            if self._tokens < 0:
+                wait = max(wait, -self._tokens / self.rate)
+
+            return wait
+
+    def _delay(self, e, attempt):
+        """
+        How long to wait before we try again: what the server told us,
+        or exponential backoff with full jitter if it didn't.
+        """
+
+        response = getattr(e, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+
+        retry_after = _retry_after(headers.get('Retry-After'), self.clock())
+
+        if retry_after is not None:
+            # A little jitter so our workers don't all come back at once
+            return retry_after + random.uniform(0, self.backoff)
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _throttled(self, status_code, delay):
+
+        with self._condition:
+
+            self._resume_at = max(self._resume_at, self.clock() + delay)
+            self._successes = 0
+
+            if status_code in _THROTTLED:
+                self.limit = max(1, self.limit // 2)
+            else:
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+
+    def succeeded(self):
+        """
+        Let us ask for more, and bigger pages, as requests keep succeeding
+        """
+
+        with self._condition:
+
+            self._successes += 1
+
+            if self._successes < self.limit * 2:
+                return
+
+            self._successes = 0
+
+            if self.limit < self.max_concurrency:
+                self.limit += 1
+                self._condition.notify_all()
+            elif self.batch_size < self.max_batch_size:
+                self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+
+
+def _number(value):
+
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _retry_after(value, now):
+    """
+    Seconds to wait from a Retry-After header, which can be either a number
+    of seconds or an HTTP date
+    """
+
+    if value is None:
+        return None
+
+    seconds = _number(value)
+
+    if seconds is not None:
+        return max(0, seconds)
+
+    parsed = parsedate_tz(value)
+
+    if parsed is None:
+        return None
+
+    return max(0, mktime_tz(parsed) - now)
@@ -0,0 +1,266 @@
+"""
+Quantile sketches, for percentiles of cycle times without keeping them all.
+
+A sketch counts values in buckets whose edges grow geometrically, so any
+quantile it gives us is within a set relative accuracy of the real one,
+e.g. within 1% for an accuracy of 0.01, however many values we add.
+Negative values, which a cycle that ends before it starts can have, go
+in buckets of their own, mirroring the positive ones.  We
+can add values one at a time as work items stream past, or an array of
+them at once, and two sketches with the same accuracy merge into one
+just as if every value had been added to it, so sketches from different
+runs or different parts of a portfolio can be combined.
+
+Sketches save to, and load from, plain JSON.
+"""
+
+import json
+import math
+
+import numpy as np
+import pandas as pd
+
+# How close to the real quantiles we get unless told otherwise
+DEFAULT_ACCURACY = 0.01
+
+# The service levels we report on unless told otherwise
+DEFAULT_PERCENTILES = [50, 85, 95]
+
+
+class QuantileSketch(object):
+
+    def __init__(self, accuracy=DEFAULT_ACCURACY):
+
+        if not 0 < accuracy < 1:
+            raise ValueError("Sketch accuracy must be between 0 and 1:{0}".format(accuracy))
+
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+        # How many values in each bucket, by bucket index.  Bucket i holds
+        # values greater than gamma ** (i - 1) and up to gamma ** i.
+        self.buckets = {}
+        # The same for negative values, by the bucket their size would go in
+        self.negatives = {}
+        # Values of nothing at all, which no bucket holds
+        self.zeros = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+
+        return self.count
+
+    def add(self, value, count=1):
+        """
+        Count a value, count times
+        """
+
+        if value == 0:
+            self.zeros += count
+        elif value > 0:
+            index = self._index(value)
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        else:
+            index = self._index(-value)
+            self.negatives[index] = self.negatives.get(index, 0) + count
+
+        self._extend(value, value, count)
+
+    def update(self, values):
+        """
+        Count an array of values in one go
+        """
+
+        values = np.asarray(values, dtype=float)
+
+        if len(values) == 0:
+            return
+
+        self.zeros += int((values == 0).sum())
+
+        self._count_into(self.buckets, values[values > 0])
+        self._count_into(self.negatives, -values[values < 0])
+
+        self._extend(float(values.min()), float(values.max()), len(values))
+
+    def merge(self, other):
+        """
+        Count every value other has counted too
+        """
+
+        if other.accuracy != self.accuracy:
+            raise ValueError("Can't merge sketches with different accuracies:{0} {1}".format(self.accuracy,
+                                                                                           other.accuracy))
+
+        if other.count == 0:
+            return
+
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+        for index, count in other.negatives.items():
+            self.negatives[index] = self.negatives.get(index, 0) + count
+
+        self.zeros += other.zeros
+
+        self._extend(other.min, other.max, other.count)
+
+    def quantile(self, q):
+        """
+        The value q of the way through everything we've counted, q being
+        between 0 and 1, or None if we haven't counted anything
+        """
+
+        if self.count == 0:
+            return None
+
+        # We know the ends exactly
+        if q <= 0:
+            return self.min
+
+        if q >= 1:
+            return self.max
+
+        rank = q * (self.count - 1)
+
+        # Negative values, the biggest first, then zeros, then positive
+        # values, the smallest first
+        seen = 0
+
+        for index in sorted(self.negatives, reverse=True):
+            seen += self.negatives[index]
+            if seen > rank:
+                return self._clamp(-self._value(index))
+
+        seen += self.zeros
+        if seen > rank:
+            return self._clamp(0)
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+
+        return self._clamp(self._value(index))
+
+    def percentile(self, p):
+
+        return self.quantile(p / 100.0)
+
+    def to_dict(self):
+
+        return {'accuracy': self.accuracy,
+                'buckets': dict((str(index), count) for index, count in self.buckets.items()),
+                'negatives': dict((str(index), count) for index, count in self.negatives.items()),
+                'zeros': self.zeros,
+                'count': self.count,
+                'min': self.min,
+                'max': self.max}
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+
+        sketch = cls(sketch_dict['accuracy'])
+
+        sketch.buckets = dict((int(index), count) for index, count in sketch_dict['buckets'].items())
+        sketch.negatives = dict((int(index), count) for index, count in sketch_dict.get('negatives', {}).items())
+        sketch.zeros = sketch_dict['zeros']
+        sketch.count = sketch_dict['count']
+        sketch.min = sketch_dict['min']
+        sketch.max = sketch_dict['max']
+
+        return sketch
+
+    def _index(self, value):
+
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _count_into(self, buckets, values):
+        """
+        Count an array of positive values into buckets
+        """
+
+        if len(values) == 0:
+            return
+
+        indexes, counts = np.unique(np.ceil(np.log(values) / self._log_gamma).astype(int),
+                                    return_counts=True)
+
+        for index, count in zip(indexes, counts):
+            buckets[int(index)] = buckets.get(int(index), 0) + int(count)
+
+    def _value(self, index):
+        """
+        Halfway, relatively, between a bucket's edges
+        """
+
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def _clamp(self, value):
+        """
+        Never outside the values we've actually seen
+        """
+
+        return min(max(value, self.min), self.max)
+
+    def _extend(self, low, high, count):
+
+        if self.min is None or low < self.min:
+            self.min = low
+
+        if self.max is None or high > self.max:
+            self.max = high
+
+        self.count += count
+
+
+def merge_sketches(sketches, more_sketches):
+    """
+    Merge more_sketches into sketches, both by name, adding copies of any
+    we don't already have so later merges leave more_sketches alone
+    """
+
+    for name, sketch in more_sketches.items():
+        if name in sketches:
+            sketches[name].merge(sketch)
+        else:
+            sketches[name] = QuantileSketch.from_dict(sketch.to_dict())
+
+    return sketches
+
+
+def save_sketches(sketches, filename):
+
+    with open(filename, 'w') as sketch_file:
+        json.dump(dict((name, sketch.to_dict()) for name, sketch in sketches.items()), sketch_file)
+
+
+def load_sketches(filename):
+
+    with open(filename) as sketch_file:
+        sketch_dicts = json.load(sketch_file)
+
+    return dict((name, QuantileSketch.from_dict(sketch_dict)) for name, sketch_dict in sketch_dicts.items())
+
+
+def percentiles_frame(sketches, percentiles=None):
+    """
+    Each sketch's percentiles, as a percentiles by sketch name frame
+    """
+
+    if percentiles is None:
+        percentiles = DEFAULT_PERCENTILES
+
+    names = sorted(sketches)
+
+    frame = pd.DataFrame([[sketches[name].percentile(p) for name in names] for p in percentiles],
+                         index=['p{0}'.format(p) for p in percentiles],
+                         columns=names,
+                         dtype=float)
+
+    frame.index.name = 'percentile'
+
+    return frame
@@ -0,0 +1,371 @@
+"""
+Every work item's state on every day, as one grid of state codes.
+
+A DataFrame of each item's daily history holds a Python string for every
+item on every day.  Here we hold a 16 bit code instead, with a row for
+each item and a column for each day, and one list of the states the
+codes stand for.  That list starts with the states in our config, in
+their order, so comparing codes compares states the way the CFD does.
+"""
+
+import json
+import os
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Where an item has no history, before it was created say
+MISSING = -1
+
+# How many codes we read in at once when we go through a matrix a block
+# of days at a time
+BLOCK_CELLS = 1 << 20
+
+
+class StateMatrix(object):
+
+    def __init__(self, codes, days, keys, states, as_dates=False, categories=None, types=None):
+
+        self.codes = codes
+        self.days = days
+        self.keys = keys
+        self.states = states
+        # Were we given days as dates rather than datetimes, as FogBugz
+        # histories are, and so should hand them back that way
+        self.as_dates = as_dates
+        # Each row's category and type, if we know them
+        self.categories = categories
+        self.types = types
+        # What the histories were counted until, if we were told
+        self.until_date = None
+        # What we were made from, so a saved matrix is only used again for
+        # the same
+        self.fingerprint = None
+
+    @classmethod
+    def from_intervals(cls, intervals, states=None, categories=None, types=None, filename=None):
+        """
+        From each key's StateIntervals, in key order, with the codes for
+        states coming first.  Categories and types are by key.
+
+        Given a filename we fill in the codes one row at a time in a file
+        mapped into memory, alongside filename, so we never hold the whole
+        grid in memory.  Saving it to filename moves it into place.
+        """
+
+        if states is None:
+            states = []
+
+        keys = sorted(key for key in intervals if intervals[key] is not None
+                      and len(intervals[key]) > 0)
+
+        states = list(states)
+        codes_by_state = dict((state, code) for code, state in enumerate(states))
+
+        origins = [np.datetime64(intervals[key].origin, 'D') for key in keys]
+
+        if not keys:
+            return cls(np.zeros((0, 0), dtype=np.int16),
+                       np.array([], dtype='datetime64[D]'),
+                       keys,
+                       states,
+                       categories=[],
+                       types=[])
+
+        first = min(origins)
+        last = max(origin + np.timedelta64(len(intervals[key]), 'D')
+                   for key, origin in zip(keys, origins))
+
+        width = (last - first).astype(int)
+        offsets = [(origin - first).astype(int) for origin in origins]
+
+        # Only keep the days some item has a history for, which we find
+        # from where every run starts and ends
+
+        edges = np.zeros(width + 1, dtype=np.int64)
+
+        for key, offset in zip(keys, offsets):
+            for start, end, state in intervals[key]:
+                end = min(end, len(intervals[key]))
+                if end > start:
+                    edges[offset + start] += 1
+                    edges[offset + end] -= 1
+
+        covered = np.cumsum(edges[:-1]) > 0
+        # Each day's column, which for the days in a run are one after another
+        columns = np.cumsum(covered) - 1
+
+        days = (first + np.arange(width))[covered]
+
+        shape = (len(keys), len(days))
+
+        if filename is None:
+            codes = np.empty(shape, dtype=np.int16)
+        else:
+            codes = np.lib.format.open_memmap(_partial(filename), mode='w+', dtype=np.int16, shape=shape)
+
+        row_codes = np.empty(shape[1], dtype=np.int16)
+
+        for row, (key, offset) in enumerate(zip(keys, offsets)):
+
+            row_codes.fill(MISSING)
+
+            for start, end, state in intervals[key]:
+
+                end = min(end, len(intervals[key]))
+
+                if state not in codes_by_state:
+                    codes_by_state[state] = len(states)
+                    states.append(state)
+
+                if end <= start:
+                    continue
+
+                column = columns[offset + start]
+                row_codes[column:column + end - start] = codes_by_state[state]
+
+            codes[row] = row_codes
+
+        if filename is not None:
+            codes.flush()
+
+        as_dates = not any(isinstance(intervals[key].origin, datetime) for key in keys)
+
+        if categories is not None:
+            categories = [categories[key] for key in keys]
+
+        if types is not None:
+            types = [types[key] for key in keys]
+
+        return cls(codes, days, keys, states, as_dates, categories, types)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        A matrix we saved, with its codes mapped from the file rather than
+        read in, so we only read the parts of it we use
+        """
+
+        with open(filename + '.json') as labels_file:
+            labels = json.load(labels_file)
+
+        matrix = cls(np.load(filename, mmap_mode='r'),
+                     np.array(labels['days'], dtype='datetime64[D]'),
+                     labels['keys'],
+                     labels['states'],
+                     labels['as_dates'],
+                     labels['categories'],
+                     labels['types'])
+
+        if matrix.codes.shape != (len(matrix.keys), len(matrix.days)):
+            raise ValueError("State matrix doesn't match its labels:{0}".format(filename))
+
+        matrix.until_date = labels['until_date']
+        matrix.fingerprint = labels.get('fingerprint')
+
+        return matrix
+
+    def save(self, filename):
+        """
+        Save our codes as a .npy file we can map back into memory, and
+        everything else alongside it in filename.json.
+
+        We write both alongside and move them into place, so anything
+        still mapping an older file keeps its own copy and a failed run
+        never leaves us with half a file.
+        """
+
+        partial = _partial(filename)
+
+        if not (isinstance(self.codes, np.memmap) and
+                os.path.abspath(self.codes.filename) == os.path.abspath(partial)):
+            codes = np.lib.format.open_memmap(partial, mode='w+', dtype=np.int16, shape=self.codes.shape)
+            codes[:] = self.codes
+            codes.flush()
+            del codes
+
+        labels = {'days': [str(day) for day in self.days],
+                  'keys': self.keys,
+                  'states': self.states,
+                  'as_dates': self.as_dates,
+                  'categories': self.categories,
+                  'types': self.types,
+                  'until_date': self.until_date,
+                  'fingerprint': self.fingerprint}
+
+        with open(_partial(filename + '.json'), 'w') as labels_file:
+            json.dump(labels, labels_file)
+
+        os.rename(partial, filename)
+        os.rename(_partial(filename + '.json'), filename + '.json')
+
+    def select(self, rows):
+        """
+        A matrix of just some rows, picked by a list of booleans, and the
+        days they have histories for.
+
+        We copy the rows we keep a block of days at a time, so a matrix
+        mapped from a file only ever has one block of it read in at once.
+        """
+
+        rows = np.array(rows, dtype=bool).reshape(len(self.keys))
+
+        if rows.all():
+            return self
+
+        covered = np.zeros(len(self.days), dtype=bool)
+
+        for start, block in self.column_blocks(rows):
+            covered[start:start + block.shape[1]] = (block != MISSING).any(axis=0)
+
+        codes = np.empty((rows.sum(), covered.sum()), dtype=np.int16)
+        column = 0
+
+        for start, block in self.column_blocks(rows):
+            keep = covered[start:start + block.shape[1]]
+            codes[:, column:column + keep.sum()] = block[:, keep]
+            column += keep.sum()
+
+        def pick(labels):
+            if labels is None:
+                return None
+            return [label for label, keep in zip(labels, rows) if keep]
+
+        matrix = StateMatrix(codes,
+                             self.days[covered],
+                             pick(self.keys),
+                             self.states,
+                             self.as_dates,
+                             pick(self.categories),
+                             pick(self.types))
+
+        matrix.until_date = self.until_date
+        matrix.fingerprint = self.fingerprint
+
+        return matrix
+
+    def column_blocks(self, rows=None):
+        """
+        Our codes a block of days at a time, as the day each block starts
+        on and the codes for those days, only for rows if we're given a
+        list of booleans
+        """
+
+        if rows is None:
+            height = len(self.keys)
+        else:
+            height = np.count_nonzero(rows)
+
+        width = max(1, BLOCK_CELLS // max(1, height))
+
+        for start in range(0, self.codes.shape[1], width):
+
+            block = self.codes[:, start:start + width]
+
+            if rows is not None:
+                block = block[rows]
+
+            yield start, block
+
+    def day_index(self):
+        """
+        The day axis the way the histories we were made from had it
+        """
+
+        if self.as_dates:
+            return pd.Index(self.days.astype(object))
+
+        return pd.DatetimeIndex(self.days)
+
+    def state_codes(self, states):
+        """
+        Our codes for those of states we have
+        """
+
+        if isinstance(states, basestring):
+            states = [states]
+
+        return [code for code, state in enumerate(self.states) if state in states]
+
+    def in_states(self, states):
+        """
+        Which items were in one of states on which days
+        """
+
+        return np.in1d(self.codes, self.state_codes(states)).reshape(self.codes.shape)
+
+    def values(self, codes):
+        """
+        States for an array of our codes, with NaN where they're missing
+        """
+
+        # MISSING is -1 so picks out the NaN on the end
+        lookup = np.array(self.states + [np.nan], dtype=object)
+
+        return lookup[codes]
+
+    def frame(self):
+        """
+        Each item's day by day history, as Metrics.history has always
+        given it
+        """
+
+        return pd.DataFrame(self.values(self.codes.T),
+                            index=self.day_index(),
+                            columns=self.keys)
+
+    def weekdays(self):
+        """
+        The day of the week of each day, Monday being 0
+        """
+
+        # 1970-01-01 was a Thursday
+        return (self.days.astype(np.int64) + 3) % 7
+
+    def counts_on(self, states, weekday, groups):
+        """
+        How many items in each group were in one of states on each of the
+        days that fall on weekday, as a days by groups frame.  Items whose
+        group is None aren't counted.
+
+        As with a pivot table, we only have the days and groups with any
+        items in states, and where a group has none on a day it's NaN.
+        """
+
+        rows = np.array([group is not None for group in groups], dtype=bool)
+        groups = [group for group in groups if group is not None]
+
+        on_day = self.weekdays() == weekday
+        codes = self.state_codes(states)
+
+        names = sorted(set(groups))
+        group_rows = np.zeros((len(names), len(groups)), dtype=np.int64)
+        group_rows[[names.index(group) for group in groups], np.arange(len(groups))] = 1
+
+        # Days by groups, a block of days at a time
+        counts = [np.zeros((0, len(names)), dtype=np.int64)]
+
+        for start, block in self.column_blocks(rows):
+            block = block[:, on_day[start:start + block.shape[1]]]
+            in_states = np.in1d(block, codes).reshape(block.shape)
+            counts.append(in_states.T.astype(np.int64).dot(group_rows.T))
+
+        counts = np.concatenate(counts)
+
+        days = counts.any(axis=1)
+        some = counts.any(axis=0)
+        counts = counts[days][:, some]
+
+        if not counts.all():
+            counts = np.where(counts == 0, np.nan, counts)
+
+        return pd.DataFrame(counts,
+                            index=self.day_index()[on_day][days],
+                            columns=[name for name, keep in zip(names, some) if keep])
+
+
+def _partial(filename):
+
+    return filename + '.partial'
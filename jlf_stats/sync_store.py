@@ -0,0 +1,119 @@
+"""
+Local store of work item records kept between runs.
+
+For each category we keep the records we have seen so far along with when
+we last synced it, so the next run only needs to ask for what has been
+updated since.
+
+We also keep the query, and the fields, each category was synced with.
+If either changes the records we have are no good any more, they may be
+missing fields or be for issues the query no longer finds, so we sync
+that category again from scratch.
+"""
+
+import json
+import os
+
+from collections import OrderedDict
+from datetime import datetime
+
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class SyncStore(object):
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.last_sync = {}
+        self.records = {}
+        # The query and fields each category was synced with
+        self.synced_with = {}
+
+        if os.path.isfile(filename):
+            with open(filename, 'r') as store_file:
+                stored = json.load(store_file)
+
+            for category, timestamp in stored['last_sync'].items():
+                self.last_sync[category] = datetime.strptime(timestamp, _TIMESTAMP_FORMAT)
+
+            for category, records in stored['records'].items():
+                self.records[category] = OrderedDict((record['id'], record['record']) for record in records)
+
+            # Stores from before we kept these get synced again in full
+            self.synced_with = stored.get('synced_with', {})
+
+    def last_synced(self, category, query=None, fields=None):
+        """
+        When we last synced the category, or None if we never have or we
+        did with a different query or fields
+        """
+
+        if not self._same_sync(category, query, fields):
+            return None
+
+        return self.last_sync.get(category)
+
+    def category_records(self, category):
+
+        if category not in self.records:
+            return []
+
+        return self.records[category].values()
+
+    def merge(self, category, records, synced_at, query=None, fields=None):
+        """
+        Add new records to a category, replacing any we already have with
+        the same id.  If the category was last synced with a different
+        query or fields these replace all the records we had.
+        """
+
+        if category not in self.records or not self._same_sync(category, query, fields):
+            self.records[category] = OrderedDict()
+
+        for id, record in records:
+            self.records[category][id] = record
+
+        self.last_sync[category] = synced_at
+        self.synced_with[category] = {'query': query,
+                                      'fields': sorted(fields or [])}
+
+    def prune(self, category, ids):
+        """
+        Drop any of a category's records whose ids aren't in ids, for
+        those that have gone or moved out of the category
+        """
+
+        if category not in self.records:
+            return
+
+        for id in list(self.records[category]):
+            if id not in ids:
+                del self.records[category][id]
+
+    def _same_sync(self, category, query, fields):
+
+        return self.synced_with.get(category) == {'query': query,
+                                                  'fields': sorted(fields or [])}
+
+    def save(self):
+
+        stored = {'last_sync': {},
+                  'records': {},
+                  'synced_with': self.synced_with}
+
+        for category, timestamp in self.last_sync.items():
+            stored['last_sync'][category] = timestamp.strftime(_TIMESTAMP_FORMAT)
+
+        for category, records in self.records.items():
+            stored['records'][category] = [{'id': id, 'record': record} for id, record in records.items()]
+
+        # Write it alongside and move it into place so a failed run
+        # never leaves us with half a store
+
+        partial_filename = self.filename + '.partial'
+
+        with open(partial_filename, 'w') as store_file:
+            json.dump(stored, store_file)
+
+        os.rename(partial_filename, self.filename)
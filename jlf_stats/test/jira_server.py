@@ -0,0 +1,288 @@
+"""
+A stand-in for the parts of the Jira REST API we use.
+
+Serves made up issues, with changelogs, so we can run JLF end to end
+without a real Jira instance, e.g. to see how fast we fetch.  It can be
+slow to answer, like a real instance over the network, and can throttle
+us with 429s like Jira Cloud does.
+
+Run it on its own with:
+
+    python -m jlf_stats.test.jira_server --issues 10000 --latency 0.05
+
+or start one in a test or benchmark with StandInJira(...).start()
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import date, timedelta
+from urlparse import urlparse, parse_qs
+
+WORKFLOW = ['Open', 'In Progress', 'Resolved', 'Closed']
+
+ISSUE_TYPES = ['Bug', 'New Feature', 'Task']
+
+# How many histories Jira embeds in an issue's changelog
+EMBEDDED_HISTORIES = 100
+
+
+class StandInJira(object):
+    """
+    `issues` made up issues created over the `days` before today, each
+    moving some of the way through WORKFLOW.  Every `long_every`th issue
+    bounces back and forth `long_changelog` more times so its embedded
+    changelog gets truncated.
+    """
+
+    def __init__(self,
+                 issues=1000,
+                 days=365,
+                 latency=0,
+                 throttle_every=None,
+                 retry_after=1,
+                 long_every=None,
+                 long_changelog=150,
+                 port=0):
+
+        self.issues = issues
+        self.days = days
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.long_every = long_every
+        self.long_changelog = long_changelog
+        self.port = port
+
+        self.first_created = date.today() - timedelta(days=days)
+
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+
+        return 'http://127.0.0.1:{0}'.format(self._server.server_address[1])
+
+    def start(self):
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', self.port), _Handler)
+        self._server.stand_in = self
+
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', self.port), _Handler)
+        self._server.stand_in = self
+        self._server.serve_forever()
+
+    def respond(self, path, params):
+        """
+        Status, headers and body for a request
+        """
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.requests += 1
+            count = self.requests
+
+        if path.endswith('/serverInfo'):
+            return 200, {}, {'baseUrl': self.url,
+                             'version': '1000.0.0',
+                             'versionNumbers': [1000, 0, 0],
+                             'deploymentType': 'Cloud'}
+
+        if path.endswith('/field'):
+            return 200, {}, [{'id': field, 'name': field, 'clauseNames': [field]}
+                             for field in ['summary', 'status', 'issuetype', 'created']]
+
+        # Only throttle the requests we page through, not those the
+        # client makes when we connect
+
+        if self.throttle_every and count % self.throttle_every == 0:
+            with self._lock:
+                self.throttled += 1
+            return 429, {'Retry-After': str(self.retry_after)}, {'errorMessages': ['Rate limit exceeded']}
+
+        if path.endswith('/search'):
+            return 200, {}, self.search(params)
+
+        if path.endswith('/changelog'):
+            key = path.split('/')[-2]
+            return 200, {}, self.changelog(key, params)
+
+        return 404, {}, {'errorMessages': ['Not found: {0}'.format(path)]}
+
+    def search(self, params):
+
+        start_at = int(params.get('startAt', 0))
+        max_results = int(params.get('maxResults', 50))
+        fields = None
+        if params.get('fields'):
+            fields = params['fields'].split(',')
+        expand = params.get('expand', '')
+
+        issues = [self.issue(n, fields, 'changelog' in expand)
+                  for n in range(start_at, min(start_at + max_results, self.issues))]
+
+        return {'startAt': start_at,
+                'maxResults': max_results,
+                'total': self.issues,
+                'issues': issues}
+
+    def changelog(self, key, params):
+        """
+        The whole changelog for an issue, oldest first as Jira gives it us
+        """
+
+        start_at = int(params.get('startAt', 0))
+        max_results = int(params.get('maxResults', 100))
+
+        histories = self.histories(int(key.split('-')[1]) - 1)
+
+        return {'startAt': start_at,
+                'maxResults': max_results,
+                'total': len(histories),
+                'isLast': start_at + max_results >= len(histories),
+                'values': histories[start_at:start_at + max_results]}
+
+    def issue(self, n, fields=None, changelog=False):
+
+        created, transitions = self.workflow(n)
+
+        all_fields = {'summary': u'Made up issue {0}'.format(n + 1),
+                      'status': {'name': transitions[-1][1] if transitions else WORKFLOW[0]},
+                      'issuetype': {'name': ISSUE_TYPES[n % len(ISSUE_TYPES)]},
+                      'created': created.strftime('%Y-%m-%dT09:00:00.000+0000')}
+
+        issue = {'id': str(10000 + n),
+                 'key': 'JLF-{0}'.format(n + 1),
+                 'self': '{0}/rest/api/2/issue/{1}'.format(self.url, 10000 + n),
+                 'fields': dict((field, all_fields.get(field)) for field in fields or all_fields)}
+
+        if changelog:
+            histories = self.histories(n)
+            # Jira embeds the most recent histories, newest first
+            issue['changelog'] = {'startAt': 0,
+                                  'maxResults': EMBEDDED_HISTORIES,
+                                  'total': len(histories),
+                                  'histories': histories[::-1][:EMBEDDED_HISTORIES]}
+
+        return issue
+
+    def histories(self, n):
+
+        created, transitions = self.workflow(n)
+
+        return [{'id': str(n * 1000 + i),
+                 'created': day.strftime('%Y-%m-%dT10:00:00.000+0000'),
+                 'items': [{'field': 'status',
+                            'fieldtype': 'jira',
+                            'fromString': from_state,
+                            'toString': to_state}]}
+                for i, (from_state, to_state, day) in enumerate(transitions)]
+
+    def workflow(self, n):
+        """
+        When issue n was created and its (from, to, day) status transitions,
+        made up the same way every time
+        """
+
+        made_up = random.Random(n)
+
+        day = self.first_created + timedelta(days=made_up.randint(0, self.days - 1))
+        created = day
+
+        transitions = []
+
+        def move(from_state, to_state):
+            transitions.append((from_state, to_state, min(day, date.today())))
+
+        for from_state, to_state in zip(WORKFLOW, WORKFLOW[1:made_up.randint(1, len(WORKFLOW))]):
+            day += timedelta(days=made_up.randint(0, 14))
+            move(from_state, to_state)
+
+        if self.long_every and n % self.long_every == 0:
+            for i in range(self.long_changelog):
+                from_state, to_state = WORKFLOW[1:3] if i % 2 == 0 else WORKFLOW[2:0:-1]
+                move(from_state, to_state)
+
+        return created, transitions
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        url = urlparse(self.path)
+        params = dict((name, ','.join(values)) for name, values in parse_qs(url.query).items())
+
+        status, headers, body = self.server.stand_in.respond(url.path, params)
+
+        content = json.dumps(body)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Stand-in Jira REST API serving made up issues')
+
+    parser.add_argument('--issues', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--throttle-every', type=int, default=None)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--long-every', type=int, default=None)
+    parser.add_argument('--port', type=int, default=8080)
+
+    args = parser.parse_args()
+
+    stand_in = StandInJira(issues=args.issues,
+                           days=args.days,
+                           latency=args.latency,
+                           throttle_every=args.throttle_every,
+                           retry_after=args.retry_after,
+                           long_every=args.long_every,
+                           port=args.port)
+
+    print "Serving {0} issues on port {1}".format(args.issues, args.port)
+
+    stand_in.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import unittest
+
+from datetime import date
+
+from jlf_stats.jira_wrapper import JiraWrapper
+from jlf_stats.metrics import Metrics
+from jlf_stats.test.jira_server import StandInJira
+
+try:
+    from jlf_stats.async_jira_wrapper import AsyncJiraWrapper
+except ImportError:
+    AsyncJiraWrapper = None
+
+
+@unittest.skipIf(AsyncJiraWrapper is None, "Needs Tornado")
+class TestAsyncJiraWrapper(unittest.TestCase):
+
+    def setUp(self):
+
+        self.stand_in = StandInJira(issues=250,
+                                    days=90,
+                                    throttle_every=7,
+                                    retry_after=0,
+                                    long_every=100).start()
+
+        self.config = {'source': {'type': 'jira',
+                                  'engine': 'async',
+                                  'server': self.stand_in.url,
+                                  'authentication': {'username': 'test',
+                                                     'password': 'test'}},
+                       'categories': {'All': "(project = 'JLF')",
+                                      'Also': "(project = 'JLF') AND 1 = 1"},
+                       'cycles': {'develop': {'start': 'In Progress',
+                                              'end': 'Closed'}},
+                       'types': {'value': ['New Feature']},
+                       'counts_towards_throughput': ['Closed'],
+                       'until_date': date.today().strftime('%Y-%m-%d')}
+
+    def tearDown(self):
+
+        self.stand_in.stop()
+
+    def testSameWorkItemsAsThreaded(self):
+
+        threaded = JiraWrapper(config=self.config)
+        threaded.scheduler.sleep = lambda seconds: None
+        expected = [work_item.to_JSON() for work_item in threaded.work_items()]
+
+        our_jira = Metrics(config=self.config)
+        self.assertIsInstance(our_jira.source, AsyncJiraWrapper)
+
+        # Don't wait about when we're throttled
+        our_jira.source.scheduler.backoff = 0
+
+        actual = [work_item.to_JSON() for work_item in our_jira.source.work_items()]
+
+        self.assertEqual(actual, expected)
+        self.assertTrue(self.stand_in.throttled > 0)
@@ -0,0 +1,185 @@
+import unittest
+
+from datetime import datetime
+
+import dateutil.parser
+
+import numpy as np
+
+from jlf_stats.cycles import compile_cycles, cycle_time_kernel, cycle_times_by_name, transition_cycle_times
+from jlf_stats.history import cycle_time, END_STATE
+from jlf_stats.intervals import StateIntervals
+
+
+class TestCycleTimeKernel(unittest.TestCase):
+
+    def setUp(self):
+
+        def intervals(*runs):
+            return StateIntervals.from_runs([{'state': state, 'days': days} for state, days in runs],
+                                            datetime(2012, 1, 1))
+
+        self.intervals = [intervals(('Open', 2), ('In Progress', 3), ('pending', 2), ('Closed', 1)),
+                          intervals(('Open', 1), ('In Progress', 2), ('Reopened', 1), ('In Progress', 2)),
+                          intervals(('Closed', 4)),
+                          None,
+                          intervals(('In Progress', 2), ('pending', 1), ('In Progress', 1), ('pending', 3))]
+
+        self.cycles = {'develop': {'start': 'In Progress',
+                                   'end': 'Closed',
+                                   'ignore': 'Reopened'},
+                       'wait': {'after': 'Open',
+                                'exit': 'pending'},
+                       'busy': {'include': ['In Progress']},
+                       'idle': {'exclude': ['In Progress', 'Closed']},
+                       'approve': {'start': 'In Progress'}}
+
+    def testCompileCycles(self):
+
+        specs = dict((spec.name, spec) for spec in compile_cycles(self.cycles))
+
+        self.assertEqual(specs['develop'].end, 'Closed')
+        self.assertEqual(specs['develop'].ignore, 'Reopened')
+        self.assertEqual(specs['wait'].exit, 'pending')
+        self.assertEqual(specs['approve'].end, END_STATE)
+        self.assertEqual(compile_cycles(None), [])
+
+    def testSameAsCycleTime(self):
+
+        specs = compile_cycles(self.cycles)
+
+        times = cycle_time_kernel(self.intervals, specs)
+
+        self.assertEqual(times.shape, (5, 5))
+        self.assertTrue(np.isnan(times[3]).all())
+
+        for issue_intervals, issue_times in zip(self.intervals, times):
+
+            if issue_intervals is None:
+                continue
+
+            history = issue_intervals.series()
+
+            expected = {}
+            for name, cycle in self.cycles.items():
+                expected[name] = cycle_time(history,
+                                            start_state=cycle.get('start'),
+                                            after_state=cycle.get('after'),
+                                            end_state=cycle.get('end', END_STATE),
+                                            exit_state=cycle.get('exit'),
+                                            reopened_state=cycle.get('ignore'),
+                                            include_states=cycle.get('include'),
+                                            exclude_states=cycle.get('exclude'))
+
+            self.assertEqual(cycle_times_by_name(issue_times, specs), expected)
+
+
+class TestTransitionCycleTimes(unittest.TestCase):
+
+    def setUp(self):
+
+        def transition(from_state, to_state, timestamp):
+            return {'from': from_state,
+                    'to': to_state,
+                    'timestamp': dateutil.parser.parse(timestamp)}
+
+        # Friday afternoon to the following Tuesday, newest first as Jira
+        # gives them, with a change that isn't a transition
+        self.state_transitions = [transition('Reopened', 'Closed', '2012-01-10T10:00:00.000+0000'),
+                                  transition('Closed', 'Reopened', '2012-01-10T09:30:00.000+0000'),
+                                  transition('In Progress', 'Closed', '2012-01-09T11:00:00.000+0000'),
+                                  None,
+                                  transition('Open', 'In Progress', '2012-01-06T15:00:00.000+0000')]
+
+        self.created = datetime(2012, 1, 6, 12)
+        self.until = datetime(2012, 1, 11)
+
+    def cycle_times(self, cycles):
+
+        return transition_cycle_times(compile_cycles(cycles), self.state_transitions, self.created, self.until)
+
+    def testHours(self):
+
+        times = self.cycle_times({'develop': {'start': 'In Progress',
+                                              'end': 'Closed',
+                                              'ignore': 'Reopened',
+                                              'unit': 'hours'},
+                                  'wait': {'after': 'Open',
+                                           'exit': 'In Progress',
+                                           'unit': 'hours'},
+                                  'open': {'include': ['Open', 'In Progress'],
+                                           'unit': 'hours'},
+                                  'unfinished': {'start': 'In Progress',
+                                                 'end': 'Customer Approval',
+                                                 'unit': 'hours'}})
+
+        self.assertEqual(times, {'develop': 91.0,
+                                 'wait': 68.0,
+                                 'open': 71.0,
+                                 'unfinished': None})
+
+    def testBusinessHours(self):
+
+        times = self.cycle_times({'develop': {'start': 'In Progress',
+                                              'end': 'Closed',
+                                              'ignore': 'Reopened',
+                                              'unit': 'business-hours'},
+                                  'early': {'start': 'In Progress',
+                                            'end': 'Closed',
+                                            'ignore': 'Reopened',
+                                            'unit': 'business-hours',
+                                            'business_hours': [8, 16]}})
+
+        # 15:00 to 17:00 on the Friday, all Monday and 9:00 to 10:00 on
+        # the Tuesday, or an hour earlier
+        self.assertEqual(times, {'develop': 11.0,
+                                 'early': 11.0})
+
+    def testSameMeaningAsDays(self):
+
+        times = self.cycle_times({'develop': {'start': 'In Progress',
+                                              'end': 'Closed',
+                                              'unit': 'hours'},
+                                  'never': {'start': 'In Progress',
+                                            'end': 'Reopened',
+                                            'ignore': 'Reopened',
+                                            'unit': 'hours'},
+                                  'backwards': {'start': 'Reopened',
+                                                'end': 'In Progress',
+                                                'unit': 'hours'}})
+
+        # As with days, ignoring Reopened only stops it ending a cycle
+        # itself, and an end before the start is a negative time
+        self.assertEqual(times, {'develop': 91.0,
+                                 'never': None,
+                                 'backwards': -90.5})
+
+    def testHoursAcrossAChangeOfOffset(self):
+
+        # 01:00 UTC both, an hour apart on the clock either side of the
+        # clocks going forward
+        self.state_transitions = [{'from': 'Open',
+                                   'to': 'In Progress',
+                                   'timestamp': dateutil.parser.parse('2012-03-24T01:00:00.000+0000')},
+                                  {'from': 'In Progress',
+                                   'to': 'Closed',
+                                   'timestamp': dateutil.parser.parse('2012-03-25T02:00:00.000+0100')}]
+        self.created = datetime(2012, 3, 23)
+        self.until = datetime(2012, 3, 26)
+
+        times = self.cycle_times({'develop': {'start': 'In Progress',
+                                              'end': 'Closed',
+                                              'unit': 'hours'}})
+
+        self.assertEqual(times, {'develop': 24.0})
+
+    def testDaysAreLeftToTheKernel(self):
+
+        self.assertEqual(self.cycle_times({'develop': {'start': 'In Progress',
+                                                       'end': 'Closed'}}), {})
+
+    def testUnknownUnit(self):
+
+        self.assertRaises(ValueError, compile_cycles, {'develop': {'start': 'In Progress',
+                                                                          'end': 'Closed',
+                                                                          'unit': 'fortnights'}})
@@ -9,6 +9,9 @@ from datetime import datetime
 from dateutil.tz import tzutc
 import mock
 import os
+import tempfile
+import re
+import types
 
 
 class TestGetMetrics(unittest.TestCase):
@@ -81,6 +84,56 @@ class TestGetMetrics(unittest.TestCase):
 
         self.assertEqual(actual, expected)
 
+    def testConfigureStateTransitions(self):
+
+        patcher = mock.patch('fogbugz.FogBugz')
+        patcher.start()
+
+        config = {'source': {'type': 'fogbugz',
+                             'url': 'https://worldofchris.fogbugz.com',
+                             'token': '33vvjghjeis7439a29qqg29azqq8q1',
+                             'transitions': {'2': ["^Milestone changed from '(?P<from>[^']+)' to '(?P<to>[^']+)'",
+                                                   "^Area changed from '([^']+)' to '([^']+)'"],
+                                             '3': {'from': 'Open', 'to': 'Assigned'}}},
+                  'categories': None}
+
+        our_fogbugz = FogbugzWrapper(config)
+
+        timestamp = datetime(2015, 03, 07, 13, 10, 20)
+
+        actual = our_fogbugz.state_transition(timestamp=timestamp,
+                                              event_code=evtEdited,
+                                              changes="Milestone changed from '1.0 Megatron' to '0.9 Ready for UAT'.")
+
+        self.assertEqual(actual, {'from': '1.0 Megatron',
+                                  'to': '0.9 Ready for UAT',
+                                  'timestamp': timestamp})
+
+        actual = our_fogbugz.state_transition(timestamp=timestamp,
+                                              event_code=evtEdited,
+                                              changes="Area changed from 'In Progress' to 'Not Started'.")
+
+        self.assertEqual(actual, {'from': 'In Progress',
+                                  'to': 'Not Started',
+                                  'timestamp': timestamp})
+
+        actual = our_fogbugz.state_transition(timestamp=timestamp,
+                                              event_code=3,
+                                              changes="")
+
+        self.assertEqual(actual, {'from': 'Open',
+                                  'to': 'Assigned',
+                                  'timestamp': timestamp})
+
+        # Only the events we've configured are transitions
+        actual = our_fogbugz.state_transition(timestamp=timestamp,
+                                              event_code=evtResolved,
+                                              changes="Resolved Status changed from 'Open' to 'Closed'")
+
+        self.assertIsNone(actual)
+
+        patcher.stop()
+
     def testConnectToFogBugz(self):
 
         patcher = mock.patch('fogbugz.FogBugz')
@@ -117,6 +170,147 @@ class TestGetMetrics(unittest.TestCase):
 
         self.assertEqual(len(actual), 3)
 
+    def testStreamCasesFromFogBugz(self):
+
+        mock_fogbugz_client = mock.Mock()
+        mock_fogbugz_client.search.side_effect = self.serve_dummy_cases
+
+        patcher = mock.patch('fogbugz.FogBugz')
+        mock_fogbugz = patcher.start()
+
+        mock_fogbugz.return_value = mock_fogbugz_client
+
+        config = {'source':     {'type': 'fogbugz',
+                                 'url': 'https://worldofchris.fogbugz.com',
+                                 'token': '33vvjghjeis7439a29qqg29azqq8q1'},
+                  'categories': {'all': '*'}}
+
+        our_fogbugz = FogbugzWrapper(config)
+        actual = our_fogbugz.iter_work_items()
+
+        self.assertIsInstance(actual, types.GeneratorType)
+        self.assertEqual([work_item.id for work_item in actual], ['1781', '1786', '1840'])
+
+        patcher.stop()
+
+    def testStreamSearchResponseXML(self):
+        """
+        Parsing the response a case at a time gives us the same work items as BeautifulSoup
+        """
+
+        filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/cases.xml")
+
+        mock_fogbugz_client = mock.Mock()
+        mock_fogbugz_client.search.side_effect = self.serve_dummy_cases
+        mock_fogbugz_client._url = 'https://worldofchris.fogbugz.com/api.asp?'
+        mock_fogbugz_client._token = '33vvjghjeis7439a29qqg29azqq8q1'
+        mock_fogbugz_client._opener.open.side_effect = lambda url, data: open(filename, 'r')
+
+        patcher = mock.patch('fogbugz.FogBugz')
+        mock_fogbugz = patcher.start()
+
+        mock_fogbugz.return_value = mock_fogbugz_client
+
+        config = {'source':     {'type': 'fogbugz',
+                                 'url': 'https://worldofchris.fogbugz.com',
+                                 'token': '33vvjghjeis7439a29qqg29azqq8q1'},
+                  'categories': {'all': '*'}}
+
+        expected = [work_item.to_JSON() for work_item in FogbugzWrapper(config).work_items()]
+
+        config['source']['stream_xml'] = True
+
+        actual = [work_item.to_JSON() for work_item in FogbugzWrapper(config).work_items()]
+
+        self.assertEqual(actual, expected)
+
+        url, data = mock_fogbugz_client._opener.open.call_args[0]
+        self.assertEqual(url, 'https://worldofchris.fogbugz.com/api.asp?')
+        self.assertIn('cmd=search', data)
+
+        patcher.stop()
+
+    def testPagedConcurrentSearches(self):
+        """
+        Searching for a page of cases at a time, a few pages at once, gives us the same work items
+        """
+
+        mock_fogbugz_client = mock.Mock()
+        mock_fogbugz_client.search.side_effect = self.serve_dummy_cases
+
+        patcher = mock.patch('fogbugz.FogBugz')
+        mock_fogbugz = patcher.start()
+
+        mock_fogbugz.return_value = mock_fogbugz_client
+
+        config = {'source':     {'type': 'fogbugz',
+                                 'url': 'https://worldofchris.fogbugz.com',
+                                 'token': '33vvjghjeis7439a29qqg29azqq8q1'},
+                  'categories': {'all': '*'}}
+
+        expected = [work_item.to_JSON() for work_item in FogbugzWrapper(config).work_items()]
+
+        config['source']['concurrency'] = 3
+        config['source']['page_size'] = 2
+
+        actual = [work_item.to_JSON() for work_item in FogbugzWrapper(config).work_items()]
+
+        self.assertEqual(actual, expected)
+
+        mock_fogbugz_client.search.assert_any_call(q='*', cols='ixBug')
+        mock_fogbugz_client.search.assert_any_call(q='1781,1786', cols='ixBug,dtOpened,dtClosed,sTitle,sStatus,sCategory,minievents')
+        mock_fogbugz_client.search.assert_any_call(q='1840', cols='ixBug,dtOpened,dtClosed,sTitle,sStatus,sCategory,minievents')
+
+        patcher.stop()
+
+    def testIncrementalSyncWithLocalStore(self):
+        """
+        With a store we only search for cases edited since we last synced
+        """
+
+        mock_fogbugz_client = mock.Mock()
+        mock_fogbugz_client.search.side_effect = self.serve_dummy_cases
+
+        patcher = mock.patch('fogbugz.FogBugz')
+        mock_fogbugz = patcher.start()
+
+        mock_fogbugz.return_value = mock_fogbugz_client
+
+        config = {'source':     {'type': 'fogbugz',
+                                 'url': 'https://worldofchris.fogbugz.com',
+                                 'token': '33vvjghjeis7439a29qqg29azqq8q1'},
+                  'categories': {'all': '*'}}
+
+        expected = [work_item.to_JSON() for work_item in FogbugzWrapper(config).work_items()]
+
+        config['source']['store'] = os.path.join(tempfile.mkdtemp(), 'store.json')
+
+        actual = [work_item.to_JSON() for work_item in FogbugzWrapper(config).work_items()]
+
+        self.assertEqual(actual, expected)
+
+        def serve_edited_case(q=None, cols=None):
+            soup = self.serve_dummy_cases(q='1786', cols=cols)
+            soup.case.sstatus.string.replaceWith('Closed (Fixed)')
+            return soup
+
+        mock_fogbugz_client.search.side_effect = serve_edited_case
+
+        resync = FogbugzWrapper(config)
+        resync.store.last_sync['all'] = datetime(2015, 3, 2, 1, 30)
+
+        actual = resync.work_items()
+
+        # From the day before, in case FogBugz's user is a day behind us
+        query = mock_fogbugz_client.search.call_args[1]['q']
+        self.assertEqual(query, '(*) lastedited:"03/01/2015.."')
+
+        self.assertEqual([work_item.id for work_item in actual], ['1781', '1786', '1840'])
+        self.assertEqual(actual[1].state, 'Closed (Fixed)')
+        self.assertEqual(actual[2].to_JSON(), expected[2])
+
+        patcher.stop()
+
     def testCaseWithNoTransitions(self):
 
         source = """
@@ -141,6 +335,22 @@ Parent changed from (None) to Case 1789.
 
         self.assertEqual(actual.to_JSON(), expected.to_JSON())
 
+    def testOnlyReadTransitionEvents(self):
+        """
+        We go by an event's code before reading anything else of it, so
+        events that aren't transitions needn't even have a date
+        """
+
+        source = """
+        <case ixbug="1823"><ixbug>1823</ixbug><dtopened>2015-02-24T09:48:31Z</dtopened><stitle><![CDATA[Should work with Windows ME]]></stitle><sstatus><![CDATA[Active]]></sstatus><scategory><![CDATA[Feature]]></scategory><minievents><event><evt>1</evt><dt>2015-02-24T09:48:31Z</dt><schanges></schanges></event><event><evt>3</evt></event></minievents></case>
+        """
+
+        soup = BeautifulSoup.BeautifulSoup(source)
+
+        actual = FogbugzWrapper().work_item_from_xml(soup.case)
+
+        self.assertEqual(actual.history, [{'to': 'Open', 'from': 'New', 'timestamp': datetime(2015, 2, 24, 9, 48, 31, tzinfo=tzutc())}])
+
 ##############################################################################################
 
     def serve_dummy_cases(self, q=None, cols=None):
@@ -150,4 +360,12 @@ Parent changed from (None) to Case 1789.
         with open(filename, "r") as xml:
             source = xml.read()
 
-            return BeautifulSoup.BeautifulSoup(source)
+        soup = BeautifulSoup.BeautifulSoup(source)
+
+        # Searching for case numbers gets us just those cases
+        if q is not None and re.match(r'^[0-9,]+$', q):
+            for case in soup.cases.findAll('case'):
+                if case.ixbug.text not in q.split(','):
+                    case.extract()
+
+        return soup
@@ -0,0 +1,102 @@
+import unittest
+
+from datetime import date, datetime
+
+import pandas as pd
+from pandas.util.testing import assert_series_equal
+
+from jlf_stats.intervals import StateIntervals
+from jlf_stats.work import WorkItem
+
+
+class TestStateIntervals(unittest.TestCase):
+
+    def setUp(self):
+
+        self.runs = [{'state': 'Open', 'days': 2},
+                     {'state': 'In Progress', 'days': 0},
+                     {'state': 'In Progress', 'days': 10},
+                     {'state': 'Closed', 'days': 3}]
+
+    def testRunsOfDaysInEachState(self):
+
+        intervals = StateIntervals.from_runs(self.runs, date(2012, 11, 16))
+
+        self.assertEqual(list(intervals), [(0, 2, 'Open'),
+                                           (2, 12, 'In Progress'),
+                                           (12, 15, 'Closed')])
+        self.assertEqual(len(intervals), 15)
+
+        expected = pd.Series(['Open'] * 2 + ['In Progress'] * 10 + ['Closed'] * 3,
+                             index=[date(2012, 11, 16 + n) for n in range(0, 15)])
+
+        assert_series_equal(intervals.series(), expected)
+
+    def testCategoricalHistory(self):
+
+        state_transitions = [{'from': None,
+                              'to': 'Open',
+                              'timestamp': datetime(2015, 2, 26, 10, 2, 6)}]
+
+        intervals = StateIntervals.from_transitions(date(2015, 2, 25), state_transitions, date(2015, 2, 28))
+
+        actual = intervals.series(categorical=True)
+
+        self.assertEqual(list(actual.cat.categories), ['Open'])
+        self.assertTrue(pd.isnull(actual[0]))
+        self.assertEqual(list(actual[1:]), ['Open'] * 3)
+        self.assertEqual(list(actual.index), [date(2015, 2, 25 + n) for n in range(0, 4)])
+
+        self.assertEqual(len(intervals.day_codes()), 4)
+
+    def testSameRunsFromSeries(self):
+
+        history = StateIntervals.from_runs(self.runs, datetime(2012, 11, 16)).series()
+
+        intervals = StateIntervals.from_series(history)
+
+        self.assertEqual(list(intervals), [(0, 2, 'Open'),
+                                           (2, 12, 'In Progress'),
+                                           (12, 15, 'Closed')])
+
+        assert_series_equal(intervals.series(), history)
+
+    def testDatesInStatesOnAWeekday(self):
+
+        # 2012-11-16 was a Friday
+        intervals = StateIntervals.from_runs(self.runs, date(2012, 11, 16))
+
+        self.assertEqual(list(intervals.dates_in(['In Progress'], weekday=4)),
+                         [date(2012, 11, 23)])
+
+        self.assertEqual(list(intervals.dates_in(['Open', 'Closed'])),
+                         [date(2012, 11, 16),
+                          date(2012, 11, 17),
+                          date(2012, 11, 28),
+                          date(2012, 11, 29),
+                          date(2012, 11, 30)])
+
+    def testWorkItemHistoryFromIntervals(self):
+
+        intervals = StateIntervals.from_runs(self.runs, datetime(2012, 11, 16))
+
+        work_item = WorkItem(id='one',
+                             title='one',
+                             state='Closed',
+                             type='Bug',
+                             history=None,
+                             intervals=intervals,
+                             date_created=datetime(2012, 11, 16))
+
+        expected = WorkItem(id='one',
+                            title='one',
+                            state='Closed',
+                            type='Bug',
+                            history=intervals.series(),
+                            date_created=datetime(2012, 11, 16))
+
+        assert_series_equal(work_item.history, expected.history)
+        self.assertEqual(work_item.to_JSON(), expected.to_JSON())
+
+        # Made once and kept
+        self.assertIs(work_item.history, work_item.history)
@@ -0,0 +1,61 @@
+import unittest
+
+from datetime import date
+
+from jlf_stats.jira_wrapper import JiraWrapper
+from jlf_stats.test.jira_server import StandInJira
+
+
+class TestAgainstStandInJira(unittest.TestCase):
+    """
+    Fetch from a stand-in Jira over HTTP rather than a mocked client
+    """
+
+    def setUp(self):
+
+        self.stand_in = StandInJira(issues=250,
+                                    days=90,
+                                    throttle_every=5,
+                                    retry_after=0,
+                                    long_every=100).start()
+
+        self.config = {'source': {'type': 'jira',
+                                  'server': self.stand_in.url,
+                                  'authentication': {'username': 'test',
+                                                     'password': 'test'}},
+                       'categories': {'All': "(project = 'JLF')"},
+                       'cycles': {'develop': {'start': 'In Progress',
+                                              'end': 'Closed'}},
+                       'until_date': date.today().strftime('%Y-%m-%d')}
+
+    def tearDown(self):
+
+        self.stand_in.stop()
+
+    def fetch(self, concurrency):
+
+        self.config['source']['concurrency'] = concurrency
+
+        our_jira = JiraWrapper(config=self.config)
+        our_jira.scheduler.sleep = lambda seconds: None
+
+        return our_jira.work_items()
+
+    def testFetchEverythingDespiteThrottling(self):
+
+        work_items = self.fetch(concurrency=4)
+
+        self.assertEqual([work_item.id for work_item in work_items],
+                         ['JLF-{0}'.format(n + 1) for n in range(250)])
+        self.assertTrue(self.stand_in.throttled > 0)
+
+        # Every 100th issue has more history than Jira will embed
+        self.assertEqual(len(work_items[100].state_transitions),
+                         len(self.stand_in.histories(100)))
+
+    def testConcurrentMatchesSerial(self):
+
+        expected = [work_item.to_JSON() for work_item in self.fetch(concurrency=1)]
+        actual = [work_item.to_JSON() for work_item in self.fetch(concurrency=4)]
+
+        self.assertEqual(actual, expected)
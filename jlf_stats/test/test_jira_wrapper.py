@@ -18,13 +18,15 @@ from pandas.util.testing import assert_frame_equal
 import mock
 from jlf_stats.test.jira_mocks import mockHistory, mockItem, mockChangelog, START_STATE, END_STATE, CREATED_STATE
 import copy
+import types
 
 import jira.client
+from jira.exceptions import JIRAError
 
 import os
 
 import tempfile
-from dateutil.tz import tzutc
+from dateutil.tz import tzlocal, tzutc
 
 # Shell Mocks to deal with the indirection needed to get us down to the
 # things we actually want to mock
@@ -85,6 +87,13 @@ class MockIssue(object):
         self.created = created
 
 
+class MockResultList(list):
+
+    def __init__(self, issues, total):
+        list.__init__(self, issues)
+        self.total = total
+
+
 class TestGetMetrics(unittest.TestCase):
 
     categories = {
@@ -245,6 +254,19 @@ class TestGetMetrics(unittest.TestCase):
 
         return self.dummy_issues[category]
 
+    def serve_updated_issues(self, updated_issues):
+        """
+        Serve updated_issues for every search bar those for just the keys
+        of what a category still finds, which we serve as usual
+        """
+
+        def serve(*args, **kwargs):
+            if kwargs.get('fields') == 'key':
+                return self.serve_dummy_issues(*args, **kwargs)
+            return updated_issues
+
+        return serve
+
     def setUp(self):
 
         mock_jira_client = mock.Mock(spec=jira.client.JIRA)
@@ -547,7 +569,7 @@ class TestGetMetrics(unittest.TestCase):
 
         expected = {'Demand Test-failure': pd.Series([np.int64(1),
                                                       np.int64(1)],
-                                                     index=['2011-12-26', '2012-01-02'])}
+                                                     index=pd.to_datetime(['2011-12-26', '2012-01-02']))}
 
         expected_frame = pd.DataFrame(expected)
         expected_frame.index.name = 'week'
@@ -563,6 +585,38 @@ class TestGetMetrics(unittest.TestCase):
 
         # needs to deal with blanks!
 
+    def testDemandFillsInWeeksWithNothingCreated(self):
+        """
+        Weeks in between with nothing created count as nothing, streaming or not
+        """
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['categories'] = {'Demand Test': 'project = PORTAL-FAIL'}
+
+        dummy_issues = {'Demand Test': [MockIssue(key='PORTAL-1', resolution_date='2012-11-10', project_name='Portal', issuetype_name='Defect', created='2011-12-31'),
+                                        MockIssue(key='PORTAL-2', resolution_date='2012-11-12', project_name='Portal', issuetype_name='Task', created='2012-01-17'),
+                                        MockIssue(key='PORTAL-3', resolution_date='2012-11-12', project_name='Portal', issuetype_name='Defect', created='2012-01-16')]}
+
+        self.set_dummy_issues(issues=dummy_issues, config=jira_config)
+
+        expected_frame = pd.DataFrame({'Demand Test-failure': [1, 0, 0, 1],
+                                       'Demand Test-overhead': [0, 0, 0, 1]},
+                                      index=pd.to_datetime(['2011-12-26', '2012-01-02', '2012-01-09', '2012-01-16']))
+        expected_frame.index.name = 'week'
+        expected_frame.columns.name = 'swimlane'
+
+        for streaming in [False, True]:
+
+            jira_config['streaming'] = streaming
+
+            our_jira = Metrics(config=jira_config)
+
+            actual_frame = our_jira.demand(from_date=date(2012, 01, 01),
+                                           to_date=date(2012, 12, 31),
+                                           types=["failure", "overhead"])
+
+            assert_frame_equal(actual_frame, expected_frame), actual_frame
+
     def testGetHistory(self):
 
         """
@@ -800,6 +854,60 @@ class TestGetMetrics(unittest.TestCase):
 
         assert_frame_equal(actual_frame, expected_frame), actual_frame
 
+    def testCountStatesForCFD(self):
+        """
+        A more compact CFD: how many issues were in each state each day
+        """
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['until_date'] = '2012-01-05'
+        jira_config['categories'] = {'Reports': 'Reports'}
+
+        dummy_issues = {'Reports': [MockIssue(key='REPORTS-1',
+                                              resolution_date='2012-11-10',
+                                              project_name='Portal',
+                                              issuetype_name='Data Request',
+                                              created='2012-01-01'),
+                                    MockIssue(key='REPORTS-2',
+                                              resolution_date='2012-11-12',
+                                              project_name='Portal',
+                                              issuetype_name='Improve Feature',
+                                              created='2012-01-02')]}
+
+        dummy_issues['Reports'][0].changelog = mockChangelog([mockHistory(u'2012-01-01T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)]),
+                                                              mockHistory(u'2012-01-03T09:54:29.284+0000', [mockItem('status', START_STATE, 'pending')])])
+
+        dummy_issues['Reports'][1].changelog = mockChangelog([mockHistory(u'2012-01-02T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)]),
+                                                              mockHistory(u'2012-01-04T09:54:29.284+0000', [mockItem('status', START_STATE, END_STATE)])])
+
+        self.set_dummy_issues(issues=dummy_issues, queries={}, config=jira_config)
+
+        our_jira = Metrics(config=jira_config)
+
+        expected = pd.DataFrame({START_STATE: [1, 2, 1, 0],
+                                 'pending': [0, 0, 1, 1],
+                                 END_STATE: [0, 0, 0, 1]},
+                                index=pd.to_datetime(['2012-01-01', '2012-01-02', '2012-01-03', '2012-01-04']),
+                                columns=[START_STATE, 'pending', END_STATE])
+        expected.index.name = 'day'
+        expected.columns.name = 'state'
+
+        actual = our_jira.cfd_counts(until_date=date(2012, 1, 5))
+
+        assert_frame_equal(actual, expected)
+
+        # Counting a day at a time makes no difference
+        with mock.patch('jlf_stats.state_matrix.BLOCK_CELLS', 1):
+            assert_frame_equal(our_jira.cfd_counts(until_date=date(2012, 1, 5)), expected)
+
+        # The same as the CFD we would have made from them
+        expected = pd.DataFrame({pd.to_datetime('2012-01-01'): [np.nan, START_STATE],
+                                 pd.to_datetime('2012-01-02'): [START_STATE, START_STATE],
+                                 pd.to_datetime('2012-01-03'): [START_STATE, 'pending'],
+                                 pd.to_datetime('2012-01-04'): ['pending', END_STATE]})
+
+        assert_frame_equal(our_jira.cfd(until_date=date(2012, 1, 5)), expected)
+
     @unittest.skip("WIP - Come back to this after I've refactored the tests.  Not sure this metric is actually useful.")
     def testGetArrivalRate(self):
         """
@@ -1006,6 +1114,99 @@ class TestGetMetrics(unittest.TestCase):
 
         assert_frame_equal(actual_frame, expected_frame, check_dtype=False), actual_frame
 
+    def testCycleTimeInHours(self):
+        """
+        Cycles can be timed in hours from state transitions as well as in days
+        """
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['categories'] = {'Ops Tools': 'Ops Tools'}
+        jira_config['cycles'] = {'develop': {'start': START_STATE,
+                                             'end': 'Customer Approval'},
+                                 'develop-hours': {'start': START_STATE,
+                                                   'end': 'Customer Approval',
+                                                   'unit': 'hours'}}
+
+        dummy_issues = {
+            'Ops Tools':   [MockIssue(key='OPSTOOLS-1',
+                                      resolution_date='2012-11-10',
+                                      project_name='Portal',
+                                      issuetype_name='Defect',
+                                      created='2012-01-01')]}
+
+        dummy_issues['Ops Tools'][0].changelog = mockChangelog([mockHistory(u'2012-01-01T09:54:29.284+0000', [mockItem('status', 'queued', 'In Progress')]),
+                                                                mockHistory(u'2012-01-02T15:24:29.284+0000', [mockItem('status', 'In Progress', 'Customer Approval')])])
+
+        self.set_dummy_issues(issues=dummy_issues, queries=jira_config['categories'], config=jira_config)
+
+        our_jira = Metrics(config=jira_config)
+        work_item = our_jira.work_item('OPSTOOLS-1')
+
+        self.assertEqual(work_item.cycles['develop-hours'], 29.5)
+        self.assertEqual(work_item.cycles['develop'], 2)
+
+        # The end of until_date in our time zone
+        jira_config['until_date'] = '2012-01-05'
+        until = JiraWrapper(config=jira_config)._until_time()
+        self.assertEqual(until, datetime(2012, 1, 6, tzinfo=tzlocal()))
+
+    def testNoTransitionTimesForCyclesInDays(self):
+        """
+        Only cycles timed in hours need times from state transitions, so
+        with none we don't work any out
+        """
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['categories'] = {'Reports': 'component = Report'}
+
+        our_jira = JiraWrapper(config=jira_config)
+
+        self.assertFalse(our_jira.timed_cycles)
+
+        with mock.patch('jlf_stats.jira_wrapper.transition_cycle_times') as transition_cycle_times:
+            with mock.patch.object(JiraWrapper, '_until_time') as until_time:
+                work_items = our_jira.work_items()
+
+        self.assertEqual([work_item.id for work_item in work_items], ['REPORTS-1', 'REPORTS-2', 'REPORTS-3'])
+        self.assertFalse(transition_cycle_times.called)
+        self.assertFalse(until_time.called)
+
+    def testGetCycleTimePercentiles(self):
+        """
+        Service level percentiles of cycle time for each type of work
+        """
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['categories'] = {'Reports': 'Reports'}
+        jira_config['cycles'] = {'develop': {'start': START_STATE,
+                                             'end': 'Customer Approval'}}
+
+        dummy_issues = {
+            'Reports':     [MockIssue(key='REPORTS-{0}'.format(n),
+                                      resolution_date='2012-11-10',
+                                      project_name='Portal',
+                                      issuetype_name=issuetype_name,
+                                      created='2012-01-01')
+                            for n, issuetype_name in enumerate(['Defect', 'Defect', 'Data Request', 'Data Request'])]}
+
+        for issue, end in zip(dummy_issues['Reports'], ['02', '04', '10', '20']):
+            issue.changelog = mockChangelog([mockHistory(u'2012-01-01T09:54:29.284+0000', [mockItem('status', 'queued', 'In Progress')]),
+                                             mockHistory(u'2012-01-{0}T09:54:29.284+0000'.format(end), [mockItem('status', 'In Progress', 'Customer Approval')])])
+
+        self.set_dummy_issues(issues=dummy_issues, queries=jira_config['categories'], config=jira_config)
+
+        our_jira = Metrics(config=jira_config)
+        actual_frame = our_jira.cycle_time_percentiles(cycle='develop', types=['failure', 'value'], percentiles=[0, 100])
+
+        expected = [
+            {'percentile': 'p0',   'failure-develop': 2, 'value-develop': 10},
+            {'percentile': 'p100', 'failure-develop': 4, 'value-develop': 20}
+        ]
+
+        expected_frame = pd.DataFrame(expected).set_index('percentile')
+
+        assert_frame_equal(actual_frame, expected_frame, check_dtype=False), actual_frame
+
     def testGetMultipleTypesCycleTime(self):
         """
         Get histogram for multiple types.
@@ -1274,6 +1475,130 @@ class TestGetMetrics(unittest.TestCase):
         our_jira = Metrics(config=self.jira_config)
         our_jira.save_work_items(save_path)
 
+    def testReloadSavedWorkItems(self):
+        """
+        A local source gives us back the work items we saved, without going to Jira
+        """
+
+        workspace = tempfile.mkdtemp()
+
+        save_path = os.path.join(workspace, "local.json")
+
+        our_jira = Metrics(config=self.jira_config)
+        our_jira.save_work_items(save_path)
+
+        local_config = copy.copy(self.jira_config)
+        local_config['source'] = {'type': 'local',
+                                  'filename': save_path}
+
+        our_local = Metrics(config=local_config)
+
+        self.assertEqual([work_item.to_JSON() for work_item in our_local.source.work_items()],
+                         [work_item.to_JSON() for work_item in our_jira.source.work_items()])
+
+        # Reading them back gives us unicode ids and cycle names, as Jira
+        # and our config file would, but the mocks here give us str
+        assert_frame_equal(our_local.history(), our_jira.history(), check_column_type=False)
+        assert_frame_equal(our_local.details(), our_jira.details(), check_column_type=False)
+
+    def testReuseSavedStateMatrix(self):
+        """
+        With a state matrix file we work from the file, and a rerun syncs
+        the store and opens the file rather than make it again if nothing
+        has changed
+        """
+
+        workspace = tempfile.mkdtemp()
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['source'] = dict(self.jira_config['source'], store=os.path.join(workspace, 'store.json'))
+        jira_config['until_date'] = '2012-11-13'
+        jira_config['state_matrix'] = os.path.join(workspace, "states.npy")
+
+        our_jira = Metrics(config=jira_config)
+
+        expected_history = our_jira.history(until_date=date(2012, 11, 13))
+        expected_throughput = our_jira.throughput(cumulative=True,
+                                                  from_date=date(2012, 01, 01),
+                                                  to_date=date(2012, 11, 13))
+
+        self.assertIsInstance(our_jira.all_states(date(2012, 11, 13)).codes, np.memmap)
+
+        saved = os.stat(jira_config['state_matrix']).st_ino
+
+        rerun = Metrics(config=jira_config)
+
+        # Nothing updated since
+        rerun.source.jira.search_issues.side_effect = self.serve_updated_issues([])
+
+        assert_frame_equal(rerun.history(until_date=date(2012, 11, 13)), expected_history, check_column_type=False)
+        assert_frame_equal(rerun.throughput(cumulative=True,
+                                            from_date=date(2012, 01, 01),
+                                            to_date=date(2012, 11, 13)),
+                           expected_throughput)
+
+        # We synced, but used the file as it was
+        self.assertIn('updated >=', rerun.source.jira.search_issues.call_args[0][0])
+        self.assertEqual(os.stat(jira_config['state_matrix']).st_ino, saved)
+
+        # An issue updated since has to be in it
+        moved_issue = MockIssue(key='OPSTOOLS-9',
+                                resolution_date='2012-11-12',
+                                project_name='Portal',
+                                issuetype_name='Defect',
+                                created='2012-01-01',
+                                change_log=mockChangelog([mockHistory(u'2012-11-04T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)])]))
+
+        rerun = Metrics(config=jira_config)
+        rerun.source.jira.search_issues.side_effect = self.serve_updated_issues([moved_issue])
+
+        self.assertIn('OPSTOOLS-9', rerun.all_states(date(2012, 11, 13)).keys)
+        self.assertNotEqual(os.stat(jira_config['state_matrix']).st_ino, saved)
+
+        # As do different states
+        rerun.source.jira.search_issues.side_effect = self.serve_updated_issues([])
+
+        jira_config['states'] = [state for state in jira_config['states'] if state not in [None, START_STATE]]
+        states = list(jira_config['states'])
+
+        rerun = Metrics(config=jira_config)
+
+        self.assertEqual(rerun.all_states(date(2012, 11, 13)).states[:len(states)], states)
+
+    def testRemakeStateMatrixForChangedWorkItems(self):
+        """
+        We only reuse a saved state matrix for the same work items
+        """
+
+        workspace = tempfile.mkdtemp()
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['until_date'] = '2012-11-13'
+        jira_config['state_matrix'] = os.path.join(workspace, "states.npy")
+
+        expected = Metrics(config=jira_config).all_states(date(2012, 11, 13))
+
+        rerun = Metrics(config=jira_config)
+
+        np.testing.assert_array_equal(rerun.all_states(date(2012, 11, 13)).codes, expected.codes)
+
+        moved_issue = MockIssue(key='OPERATIONS-1',
+                                resolution_date='2012-11-12',
+                                project_name='Portal',
+                                issuetype_name='Improve Feature',
+                                created='2012-01-01',
+                                change_log=mockChangelog([mockHistory(u'2012-11-04T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)])]))
+
+        ops_tools = self.default_dummy_issues['Ops Tools'] + [moved_issue]
+        self.set_dummy_issues(issues=dict(self.default_dummy_issues, **{'Ops Tools': ops_tools}))
+
+        rerun = Metrics(config=jira_config)
+
+        actual = rerun.all_states(date(2012, 11, 13))
+
+        self.assertNotEqual(actual.fingerprint, expected.fingerprint)
+        self.assertEqual(actual.keys, sorted(set(expected.keys) | set(['OPERATIONS-1'])))
+
     def testGetStateTransitionFromJiraHistory(self):
 
         dummy_history = mockHistory(u'2012-01-01T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)])
@@ -1285,3 +1610,348 @@ class TestGetMetrics(unittest.TestCase):
         actual = our_metrics.source.state_transition(dummy_history)
 
         self.assertEqual(actual, expected)
+
+    def testConcurrentFetchMatchesSerial(self):
+        """
+        Fetching with a pool of workers should give us exactly what we get
+        when we fetch one page at a time
+        """
+
+        serial = Metrics(config=self.jira_config)
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['source'] = dict(self.jira_config['source'], concurrency=4)
+
+        concurrent = Metrics(config=jira_config)
+
+        self.assertEqual(concurrent.source.concurrency, 4)
+
+        expected = [work_item.to_JSON() for work_item in serial.source.work_items()]
+        actual = [work_item.to_JSON() for work_item in concurrent.source.work_items()]
+
+        self.assertEqual(actual, expected)
+
+    def testConcurrentFetchPlansPagesFromTotal(self):
+        """
+        Once we know the total from the first page we can ask for all the rest at once
+        """
+
+        created = '2012-01-01'
+        change_log = mockChangelog([mockHistory(u'2012-01-01T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)])])
+
+        issues = [MockIssue(key='PORTAL-{0}'.format(n),
+                            resolution_date=None,
+                            project_name='Portal',
+                            issuetype_name='Defect',
+                            created=created,
+                            change_log=change_log) for n in range(250)]
+
+        def serve_pages(jql, startAt=0, maxResults=50, **kwargs):
+            return MockResultList(issues[startAt:startAt + maxResults], total=len(issues))
+
+        jira_config = copy.deepcopy(self.jira_config)
+        jira_config['categories'] = {'Portal': 'project = Portal'}
+        jira_config['source']['concurrency'] = 3
+
+        our_jira = JiraWrapper(config=jira_config)
+        our_jira.jira.search_issues.side_effect = serve_pages
+
+        actual = [work_item.id for work_item in our_jira.work_items()]
+
+        self.assertEqual(actual, [issue.key for issue in issues])
+
+        offsets = sorted([kwargs['startAt'] for args, kwargs in our_jira.jira.search_issues.call_args_list])
+        self.assertEqual(offsets, [0, 100, 200])
+
+    def testIncrementalSyncWithLocalStore(self):
+        """
+        With a store we only ask Jira for what has been updated since we last synced
+        """
+
+        workspace = tempfile.mkdtemp()
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['source'] = dict(self.jira_config['source'], store=os.path.join(workspace, 'store.json'))
+        jira_config['categories'] = {'Reports': 'component = Report'}
+        jira_config['until_date'] = '2012-11-13'
+
+        expected = [work_item.to_JSON() for work_item in JiraWrapper(config=jira_config)._issues_from_jira()]
+
+        first_sync = JiraWrapper(config=jira_config)
+        actual = [work_item.to_JSON() for work_item in first_sync.work_items()]
+
+        self.assertEqual(actual, expected)
+        first_sync.jira.search_issues.assert_called_with('component = Report',
+                                                         startAt=0,
+                                                         maxResults=100,
+                                                         fields='summary,status,issuetype,created',
+                                                         expand='changelog')
+
+        updated_issue = MockIssue(key='REPORTS-2',
+                                  resolution_date='2012-11-12',
+                                  project_name='Portal',
+                                  issuetype_name='Improve Feature',
+                                  created='2012-01-01',
+                                  change_log=mockChangelog([mockHistory(u'2012-11-04T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)])]))
+
+        second_sync = JiraWrapper(config=jira_config)
+        second_sync.jira.search_issues.side_effect = self.serve_updated_issues([updated_issue])
+
+        actual = second_sync.work_items()
+
+        jql = second_sync.jira.search_issues.call_args[0][0]
+        self.assertRegexpMatches(jql, r'^\(component = Report\) AND updated >= "\d{4}-\d{2}-\d{2} \d{2}:\d{2}"$')
+
+        self.assertEqual([work_item.id for work_item in actual], ['REPORTS-1', 'REPORTS-2', 'REPORTS-3'])
+        self.assertEqual(actual[1].history[-1], START_STATE)
+        self.assertEqual(actual[2].to_JSON(), expected[2])
+
+    def testDropIssuesThatNoLongerMatch(self):
+        """
+        Issues a category's query no longer finds go from the store
+        """
+
+        workspace = tempfile.mkdtemp()
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['source'] = dict(self.jira_config['source'], store=os.path.join(workspace, 'store.json'))
+        jira_config['categories'] = {'Reports': 'component = Report'}
+        jira_config['until_date'] = '2012-11-13'
+
+        JiraWrapper(config=jira_config).work_items()
+
+        # REPORTS-2 has moved to another component
+        still_matching = [issue for issue in self.dummy_issues['Reports'] if issue.key != 'REPORTS-2']
+
+        resync = JiraWrapper(config=jira_config)
+        resync.jira.search_issues.side_effect = lambda *args, **kwargs: (still_matching
+                                                                         if kwargs.get('fields') == 'key' else [])
+
+        actual = resync.work_items()
+
+        resync.jira.search_issues.assert_any_call('component = Report',
+                                                  startAt=0,
+                                                  maxResults=100,
+                                                  fields='key')
+
+        self.assertEqual([work_item.id for work_item in actual], ['REPORTS-1', 'REPORTS-3'])
+        self.assertEqual([record['key'] for record in resync.store.category_records('Reports')],
+                         ['REPORTS-1', 'REPORTS-3'])
+
+    def testResyncWhenQueryOrFieldsChange(self):
+        """
+        A category synced with a different query, or different fields, is synced again from scratch
+        """
+
+        workspace = tempfile.mkdtemp()
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['source'] = dict(self.jira_config['source'], store=os.path.join(workspace, 'store.json'))
+        jira_config['categories'] = {'Reports': 'component = Report'}
+        jira_config['until_date'] = '2012-11-13'
+
+        JiraWrapper(config=jira_config).work_items()
+
+        moved_issue = MockIssue(key='REPORTS-4',
+                                resolution_date='2012-11-12',
+                                project_name='Portal',
+                                issuetype_name='Improve Feature',
+                                created='2012-01-01',
+                                change_log=mockChangelog([mockHistory(u'2012-11-04T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)])]))
+
+        jira_config['reports'] = [{'metric': 'detail', 'fields': ['customfield_10002']}]
+
+        resync = JiraWrapper(config=jira_config)
+        resync.jira.search_issues.side_effect = lambda *args, **kwargs: [moved_issue]
+
+        actual = resync.work_items()
+
+        resync.jira.search_issues.assert_called_with('component = Report',
+                                                     startAt=0,
+                                                     maxResults=100,
+                                                     fields='summary,status,issuetype,created,customfield_10002',
+                                                     expand='changelog')
+
+        self.assertEqual([work_item.id for work_item in actual], ['REPORTS-4'])
+
+        jira_config['categories'] = {'Reports': 'component = Reports'}
+        self.set_dummy_issues(config=jira_config)
+
+        resync = JiraWrapper(config=jira_config)
+        resync.work_items()
+
+        self.assertEqual(resync.jira.search_issues.call_args[0][0], 'component = Reports')
+
+    def testStreamWorkItems(self):
+        """
+        When streaming we build metrics straight from the source, a page at a time,
+        without holding on to the work items
+        """
+
+        our_jira = Metrics(config=self.jira_config)
+        expected = our_jira.details()
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['streaming'] = True
+
+        our_jira = Metrics(config=jira_config)
+
+        self.assertIsInstance(our_jira.source.iter_work_items(), types.GeneratorType)
+
+        actual = our_jira.details()
+
+        assert_frame_equal(actual, expected)
+        self.assertIsNone(our_jira.work_items)
+        self.assertIsNone(our_jira.source.all_issues)
+
+    def testOnlyFetchFieldsWeUse(self):
+        """
+        Ask Jira for just the fields our WorkItems and detail reports need
+        """
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['categories'] = {'done': 'done'}
+        jira_config['reports'] = [{'metric': 'detail',
+                                   'fields': ['id', 'develop', 'customfield_10002']},
+                                  {'metric': 'cfd'}]
+
+        dummy_issues = {'done': [MockIssue(key='PORTAL-1', resolution_date='2012-11-10', project_name='Portal', issuetype_name='Defect', created='2012-01-01')]}
+        dummy_issues['done'][0].fields.customfield_10002 = 3.0
+
+        self.set_dummy_issues(issues=dummy_issues, queries=jira_config['categories'], config=jira_config)
+
+        our_jira = Metrics(config=jira_config)
+
+        actual_frame = our_jira.details(fields=['id', 'customfield_10002'])
+
+        our_jira.source.jira.search_issues.assert_called_with('done',
+                                                              startAt=0,
+                                                              maxResults=100,
+                                                              fields='summary,status,issuetype,created,customfield_10002',
+                                                              expand='changelog')
+
+        expected_frame = pd.DataFrame([{'id': 'PORTAL-1', 'customfield_10002': 3.0}]).filter(['id', 'customfield_10002'])
+
+        assert_frame_equal(actual_frame, expected_frame)
+
+    def testFetchWholeChangelogWhenTruncated(self):
+        """
+        Jira only embeds some of a long-lived issue's changelog so get the rest from the issue
+        """
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['categories'] = {'Reports': 'component = Report'}
+        jira_config['until_date'] = '2012-11-13'
+
+        histories = [mockHistory(u'2012-01-01T09:54:29.284+0000', [mockItem('status', 'queued', START_STATE)]),
+                     mockHistory(u'2012-01-03T09:54:29.284+0000', [mockItem('status', START_STATE, 'pending')]),
+                     mockHistory(u'2012-01-04T09:54:29.284+0000', [mockItem('status', 'pending', START_STATE)]),
+                     mockHistory(u'2012-01-08T09:54:29.284+0000', [mockItem('status', START_STATE, END_STATE)])]
+
+        complete = MockIssue(key='REPORTS-1',
+                             resolution_date='2012-11-10',
+                             project_name='Portal',
+                             issuetype_name='Defect',
+                             created='2012-01-01',
+                             change_log=mockChangelog(histories))
+
+        truncated_changelog = mockChangelog(histories[-1:])
+        truncated_changelog.total = len(histories)
+
+        truncated = copy.copy(complete)
+        truncated.changelog = truncated_changelog
+
+        self.set_dummy_issues(issues={'Reports': [complete]}, queries={}, config=jira_config)
+        expected = JiraWrapper(config=jira_config).work_items()[0]
+
+        self.set_dummy_issues(issues={'Reports': [truncated]}, queries={}, config=jira_config)
+        our_jira = JiraWrapper(config=jira_config)
+        our_jira.changelog_batch_size = 3
+
+        def serve_changelog(path, params=None):
+            values = [{'created': history.created,
+                       'items': [{'field': item.field,
+                                  'fromString': item.fromString,
+                                  'toString': item.toString} for item in history.items]} for history in histories]
+            return {'startAt': params['startAt'],
+                    'total': len(values),
+                    'values': values[params['startAt']:params['startAt'] + params['maxResults']]}
+
+        our_jira.jira._get_json.side_effect = serve_changelog
+
+        actual = our_jira.work_items()[0]
+
+        self.assertEqual(our_jira.jira._get_json.call_args_list,
+                         [mock.call('issue/REPORTS-1/changelog', params={'startAt': 0, 'maxResults': 3}),
+                          mock.call('issue/REPORTS-1/changelog', params={'startAt': 3, 'maxResults': 3})])
+        self.assertEqual(actual.to_JSON(), expected.to_JSON())
+
+    def testOrderWholeChangelogByTime(self):
+        """
+        Histories from either side of a change of UTC offset go in the order they happened
+        """
+
+        our_jira = JiraWrapper(config=self.jira_config)
+
+        embedded = mockChangelog([mockHistory(u'2012-03-25T00:30:00.000+0000', [mockItem('status', 'queued', START_STATE)])])
+        embedded.total = 3
+
+        issue = MockIssue(key='REPORTS-1',
+                          resolution_date='2012-11-10',
+                          project_name='Portal',
+                          issuetype_name='Defect',
+                          created='2012-01-01',
+                          change_log=embedded)
+
+        # 02:10 in +0100 is 01:10 UTC, before 01:30 UTC
+        values = [{'created': created,
+                   'items': []} for created in [u'2012-03-25T00:30:00.000+0000',
+                                                u'2012-03-25T01:30:00.000+0000',
+                                                u'2012-03-25T02:10:00.000+0100']]
+
+        our_jira._replace_changelogs([issue], [('REPORTS-1', 0)], [{'values': values}])
+
+        self.assertEqual([history.created for history in issue.changelog.histories],
+                         [u'2012-03-25T01:30:00.000+0000',
+                          u'2012-03-25T02:10:00.000+0100',
+                          u'2012-03-25T00:30:00.000+0000'])
+
+    def testRetryWhenThrottled(self):
+        """
+        When Jira tells us we're asking too much we wait and ask again
+        rather than failing the whole run
+        """
+
+        expected = [work_item.to_JSON() for work_item in JiraWrapper(config=self.jira_config).work_items()]
+
+        our_jira = JiraWrapper(config=self.jira_config)
+        our_jira.scheduler.sleep = lambda seconds: None
+
+        responses = [JIRAError(status_code=429, response=mock.Mock(headers={'Retry-After': '1'}))]
+
+        def serve_throttled(*args, **kwargs):
+            if responses:
+                raise responses.pop()
+            return self.serve_dummy_issues(*args, **kwargs)
+
+        our_jira.jira.search_issues.side_effect = serve_throttled
+
+        actual = [work_item.to_JSON() for work_item in our_jira.work_items()]
+
+        self.assertEqual(actual, expected)
+
+    def testParseInProcessPool(self):
+        """
+        Parsing changelogs in a pool of processes gives us the same work items
+        """
+
+        expected = [work_item.to_JSON() for work_item in JiraWrapper(config=self.jira_config).work_items()]
+
+        jira_config = copy.copy(self.jira_config)
+        jira_config['source'] = dict(self.jira_config['source'], parse_processes=2)
+
+        our_jira = JiraWrapper(config=jira_config)
+
+        actual = [work_item.to_JSON() for work_item in our_jira.work_items()]
+
+        self.assertEqual(actual, expected)
@@ -21,6 +21,9 @@ import pandas as pd
 import xlrd
 import zipfile
 import filecmp
+import json
+
+from jlf_stats.sketch import QuantileSketch, save_sketches
 
 
 def serve_dummy_results(*args, **kwargs):
@@ -73,6 +76,23 @@ def serve_dummy_cfd_data(*args, **kwargs):
     return dummy
 
 
+def serve_dummy_cfd_counts_data(*args, **kwargs):
+
+    dummy = pd.DataFrame([[0, 1, 2],
+                          [2, 1, 0]],
+                         columns=['open', 'in progress', 'closed'])
+
+    return dummy
+
+
+def serve_dummy_cycle_time_sketches(*args, **kwargs):
+
+    sketch = QuantileSketch(kwargs['accuracy'])
+    sketch.update([1, 2, 3, 4, 5])
+
+    return {'value-develop': sketch}
+
+
 class TestGetOutput(unittest.TestCase):
 
     def setUp(self):
@@ -81,10 +101,12 @@ class TestGetOutput(unittest.TestCase):
         self.mock_metrics.throughput.side_effect = serve_dummy_throughput
         self.mock_metrics.demand.side_effect = serve_dummy_results
         self.mock_metrics.cycle_time_histogram.side_effect = serve_dummy_results
+        self.mock_metrics.cycle_time_sketches.side_effect = serve_dummy_cycle_time_sketches
         self.mock_metrics.arrival_rate.side_effect = serve_dummy_results
         self.mock_metrics.details.side_effect = serve_dummy_detail
 
         self.mock_metrics.cfd.side_effect = serve_dummy_cfd_data
+        self.mock_metrics.cfd_counts.side_effect = serve_dummy_cfd_counts_data
 
         self.workspace = tempfile.mkdtemp()
 
@@ -267,6 +289,42 @@ class TestGetOutput(unittest.TestCase):
         workbook = xlrd.open_workbook(actual_output)
         self.assertEqual('value-develop-cycle-time', workbook.sheet_names()[0])
 
+    def testOutputCycleTimePercentilesToExcel(self):
+
+        shard = QuantileSketch(0.02)
+        shard.update([6, 7, 8, 9, 10])
+
+        shard_filename = os.path.join(self.workspace, 'shard.json')
+        save_sketches({'value-develop': shard}, shard_filename)
+
+        saved_filename = os.path.join(self.workspace, 'develop.json')
+
+        report_config = {'name':    'reports',
+                         'reports': [{'metric':      'cycle-time-percentiles',
+                                      'types':       ['value'],
+                                      'cycles':      ['develop'],
+                                      'accuracy':    0.02,
+                                      'percentiles': [50, 85],
+                                      'merge':       [shard_filename],
+                                      'save':        saved_filename}],
+                         'format':   'xlsx',
+                         'location': self.workspace}
+
+        publisher.publish(report_config,
+                          self.mock_metrics,
+                          from_date=date(2012, 10, 8),
+                          to_date=date(2012, 11, 12))
+
+        workbook = xlrd.open_workbook(os.path.join(self.workspace, 'reports.xlsx'))
+        self.assertEqual('val-deve-cycl-time-percentiles', workbook.sheet_names()[0])
+
+        sheet = workbook.sheet_by_index(0)
+        self.assertEqual(sheet.col_values(0), ['percentile', 'p50', 'p85'])
+
+        # Just our own, not the shard we merged in
+        with open(saved_filename) as saved_file:
+            self.assertEqual(json.load(saved_file)['value-develop']['count'], 5)
+
     def testOutputCFDToExcel(self):
 
         report_config = {'name':     'reports',
@@ -291,6 +349,23 @@ class TestGetOutput(unittest.TestCase):
         workbook = xlrd.open_workbook(actual_output)
         self.assertEqual('cfd', workbook.sheet_names()[0])
 
+    def testOutputCFDCountsToExcel(self):
+
+        report_config = {'name':     'reports',
+                         'states':   [],
+                         'reports':  [{'metric': 'cfd-counts'}],
+                         'format':   'xlsx',
+                         'counts_towards_throughput': [],
+                         'location': self.workspace}
+
+        publisher.publish(report_config,
+                          self.mock_metrics,
+                          from_date=date(2012, 10, 8),
+                          to_date=date(2012, 11, 12))
+
+        workbook = xlrd.open_workbook(os.path.join(self.workspace, 'reports.xlsx'))
+        self.assertEqual('cfd-counts', workbook.sheet_names()[0])
+
     def testMakeValidSheetTitle(self):
 
         titles = [('failure-value-operational overhead-demand', 'failure-value-operatio-demand'),
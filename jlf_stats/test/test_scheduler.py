@@ -0,0 +1,127 @@
+import unittest
+
+import mock
+
+from jira.exceptions import JIRAError
+
+from jlf_stats.scheduler import RequestScheduler
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def throttled(status_code=429, headers=None):
+
+    return JIRAError(status_code=status_code,
+                     text='Rate limit exceeded',
+                     response=mock.Mock(headers=headers or {}))
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def setUp(self):
+
+        self.clock = FakeClock()
+
+    def scheduler(self, **kwargs):
+
+        return RequestScheduler(clock=self.clock.time, sleep=self.clock.sleep, **kwargs)
+
+    def testRetryAfterWhenThrottled(self):
+
+        scheduler = self.scheduler(concurrency=4, backoff=0.5)
+        request = mock.Mock(side_effect=[throttled(headers={'Retry-After': '7'}), 'page'])
+
+        actual = scheduler.call(request, 'project = Portal', startAt=0)
+
+        self.assertEqual(actual, 'page')
+        self.assertEqual(request.call_count, 2)
+        request.assert_called_with('project = Portal', startAt=0)
+
+        self.assertTrue(7 <= sum(self.clock.slept) <= 7.5)
+        self.assertEqual(scheduler.limit, 2)
+
+    def testBackOffWithoutRetryAfter(self):
+
+        scheduler = self.scheduler(backoff=1.0, max_backoff=3.0)
+        request = mock.Mock(side_effect=[throttled(), throttled(), throttled(), 'page'])
+
+        self.assertEqual(scheduler.call(request), 'page')
+
+        waits = [wait for wait in self.clock.slept if wait > 0]
+        self.assertTrue(all(wait <= 3.0 for wait in waits))
+
+    def testGiveUpAfterMaxRetries(self):
+
+        scheduler = self.scheduler(max_retries=2)
+        request = mock.Mock(side_effect=throttled())
+
+        self.assertRaises(JIRAError, scheduler.call, request)
+        self.assertEqual(request.call_count, 3)
+
+    def testOtherErrorsAreNotRetried(self):
+
+        scheduler = self.scheduler()
+        request = mock.Mock(side_effect=JIRAError(status_code=400, text='Bad JQL'))
+
+        self.assertRaises(JIRAError, scheduler.call, request)
+        self.assertEqual(request.call_count, 1)
+
+    def testSmallerPagesWhenOverloaded(self):
+
+        scheduler = self.scheduler(batch_size=100)
+        request = mock.Mock(side_effect=[throttled(status_code=503), 'page'])
+
+        scheduler.call(request)
+
+        self.assertEqual(scheduler.batch_size, 50)
+        self.assertEqual(scheduler.limit, 1)
+
+    def testRecoverAsRequestsSucceed(self):
+
+        scheduler = self.scheduler(concurrency=4, batch_size=100)
+        scheduler.limit = 1
+        scheduler.batch_size = 25
+
+        for _ in range(40):
+            scheduler.call(lambda: 'page')
+
+        self.assertEqual(scheduler.limit, 4)
+        self.assertEqual(scheduler.batch_size, 100)
+
+    def testTokenBucketPacing(self):
+
+        scheduler = self.scheduler(rate=2.0, burst=1)
+
+        for _ in range(5):
+            scheduler.call(lambda: 'page')
+
+        self.assertAlmostEqual(self.clock.now - 1000.0, 2.0)
+
+    def testPaceToRateLimitHeaders(self):
+
+        scheduler = self.scheduler(concurrency=4)
+
+        scheduler.observe({'X-RateLimit-Limit': '10',
+                           'X-RateLimit-Remaining': '3',
+                           'X-RateLimit-FillRate': '5',
+                           'X-RateLimit-Interval-Seconds': '1'})
+
+        self.assertEqual(scheduler.rate, 5.0)
+        self.assertEqual(scheduler.burst, 10.0)
+        self.assertEqual(scheduler.limit, 4)
+
+        scheduler.observe({'X-RateLimit-NearLimit': 'true'})
+
+        self.assertEqual(scheduler.limit, 2)
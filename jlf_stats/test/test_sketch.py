@@ -0,0 +1,111 @@
+import unittest
+import tempfile
+import os
+
+import numpy as np
+
+from jlf_stats.sketch import QuantileSketch, load_sketches, merge_sketches, percentiles_frame, save_sketches
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def setUp(self):
+
+        self.values = np.random.RandomState(42).lognormal(mean=2, sigma=1, size=5000)
+
+    def testWithinAccuracy(self):
+
+        for accuracy in [0.01, 0.05]:
+
+            sketch = QuantileSketch(accuracy)
+
+            for value in self.values:
+                sketch.add(value)
+
+            for q in [0.5, 0.85, 0.95]:
+                real = np.sort(self.values)[int(q * (len(self.values) - 1))]
+                self.assertTrue(abs(sketch.quantile(q) - real) <= accuracy * real,
+                                (accuracy, q, sketch.quantile(q), real))
+
+    def testMergeAsIfAddedTogether(self):
+
+        whole = QuantileSketch()
+        whole.update(self.values)
+
+        first = QuantileSketch()
+        first.update(self.values[:1000])
+        second = QuantileSketch()
+        for value in self.values[1000:]:
+            second.add(value)
+
+        first.merge(second)
+
+        self.assertEqual(first.to_dict(), whole.to_dict())
+
+    def testZerosAndNothing(self):
+
+        sketch = QuantileSketch()
+
+        self.assertEqual(sketch.quantile(0.5), None)
+
+        sketch.update([0, 0, 0, 10])
+
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertEqual(sketch.quantile(1), 10)
+
+    def testNegativeValues(self):
+
+        values = np.concatenate([-self.values, [0] * 100, self.values])
+
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+
+        in_one_go = QuantileSketch()
+        in_one_go.update(values)
+
+        self.assertEqual(in_one_go.to_dict(), sketch.to_dict())
+
+        for q in [0.05, 0.25, 0.5, 0.75, 0.95]:
+            real = np.sort(values)[int(q * (len(values) - 1))]
+            self.assertTrue(abs(sketch.quantile(q) - real) <= 0.01 * abs(real),
+                            (q, sketch.quantile(q), real))
+
+    def testMergingLeavesTheOtherSketchesAlone(self):
+
+        theirs = QuantileSketch()
+        theirs.update([1, 2, 3])
+
+        merged = merge_sketches({}, {'develop': theirs})
+        merge_sketches(merged, {'develop': theirs})
+
+        self.assertEqual(len(merged['develop']), 6)
+        self.assertEqual(len(theirs), 3)
+
+    def testCannotMergeDifferentAccuracies(self):
+
+        self.assertRaises(ValueError, QuantileSketch(0.01).merge, QuantileSketch(0.02))
+
+    def testSaveMergeAndReport(self):
+
+        ours = {'value-develop': QuantileSketch(), 'failure-develop': QuantileSketch()}
+        ours['value-develop'].update([1, 2, 3, 4])
+        ours['failure-develop'].update([10, 20])
+
+        theirs = {'value-develop': QuantileSketch(), 'oo-develop': QuantileSketch()}
+        theirs['value-develop'].update([5, 6, 7, 8, 9])
+        theirs['oo-develop'].update([1])
+
+        filename = os.path.join(tempfile.mkdtemp(), 'sketches.json')
+        save_sketches(theirs, filename)
+
+        merged = merge_sketches(ours, load_sketches(filename))
+
+        frame = percentiles_frame(merged, [50, 100])
+
+        self.assertEqual(list(frame.columns), ['failure-develop', 'oo-develop', 'value-develop'])
+        self.assertEqual(list(frame.index), ['p50', 'p100'])
+        self.assertEqual(frame.index.name, 'percentile')
+        self.assertEqual(len(merged['value-develop']), 9)
+        self.assertTrue(abs(frame['value-develop']['p50'] - 5) <= 0.05)
+        self.assertEqual(frame['value-develop']['p100'], 9)
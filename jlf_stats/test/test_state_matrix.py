@@ -0,0 +1,188 @@
+import os
+import tempfile
+import unittest
+
+from datetime import date, datetime
+
+import mock
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+from jlf_stats.intervals import StateIntervals
+from jlf_stats.state_matrix import StateMatrix, MISSING
+
+
+class TestStateMatrix(unittest.TestCase):
+
+    def setUp(self):
+
+        self.intervals = {'ONE-1': StateIntervals.from_runs([{'state': 'Open', 'days': 2},
+                                                             {'state': 'Closed', 'days': 1}],
+                                                            datetime(2012, 1, 1)),
+                          'ONE-2': StateIntervals.from_runs([{'state': 'In Progress', 'days': 2}],
+                                                            datetime(2012, 1, 2)),
+                          # Nobody has any history for the days in between
+                          'ONE-3': StateIntervals.from_runs([{'state': 'Closed', 'days': 1}],
+                                                            datetime(2012, 1, 10))}
+
+    def testStateCodesForEveryDay(self):
+
+        matrix = StateMatrix.from_intervals(self.intervals, ['Open', 'In Progress', 'Closed'])
+
+        self.assertEqual(matrix.keys, ['ONE-1', 'ONE-2', 'ONE-3'])
+        self.assertEqual(matrix.states, ['Open', 'In Progress', 'Closed'])
+        self.assertEqual(matrix.codes.dtype, np.int16)
+
+        np.testing.assert_array_equal(matrix.codes, [[0, 0, 2, MISSING],
+                                                     [MISSING, 1, 1, MISSING],
+                                                     [MISSING, MISSING, MISSING, 2]])
+
+        np.testing.assert_array_equal(matrix.days, np.array(['2012-01-01',
+                                                              '2012-01-02',
+                                                              '2012-01-03',
+                                                              '2012-01-10'], dtype='datetime64[D]'))
+
+        np.testing.assert_array_equal(matrix.weekdays(), [6, 0, 1, 1])
+
+    def testSameFrameAsDailyHistories(self):
+
+        expected = pd.DataFrame(dict((key, self.intervals[key].series()) for key in self.intervals))
+
+        matrix = StateMatrix.from_intervals(self.intervals)
+
+        assert_frame_equal(matrix.frame(), expected)
+
+        # We've added the states we weren't told about as we found them
+        self.assertEqual(sorted(matrix.states), ['Closed', 'In Progress', 'Open'])
+
+    def testDaysAsDates(self):
+
+        state_transitions = [{'from': 'Open',
+                              'to': 'Closed',
+                              'timestamp': datetime(2015, 2, 26, 10, 2, 6)}]
+
+        intervals = {'1838': StateIntervals.from_transitions(date(2015, 2, 25), state_transitions, date(2015, 2, 26))}
+
+        expected = pd.DataFrame({'1838': intervals['1838'].series()})
+
+        assert_frame_equal(StateMatrix.from_intervals(intervals).frame(), expected)
+
+    def testSelectRows(self):
+
+        matrix = StateMatrix.from_intervals(self.intervals,
+                                            categories={'ONE-1': 'One', 'ONE-2': 'One', 'ONE-3': 'Two'},
+                                            types={'ONE-1': 'Bug', 'ONE-2': 'Story', 'ONE-3': 'Bug'})
+
+        actual = matrix.select([t == 'Bug' for t in matrix.types])
+
+        self.assertEqual(actual.keys, ['ONE-1', 'ONE-3'])
+        self.assertEqual(actual.categories, ['One', 'Two'])
+
+        expected = pd.DataFrame(dict((key, self.intervals[key].series()) for key in ['ONE-1', 'ONE-3']))
+
+        assert_frame_equal(actual.frame(), expected)
+
+    def testSelectEveryRow(self):
+
+        matrix = StateMatrix.from_intervals(self.intervals)
+
+        self.assertIs(matrix.select([True, True, True]), matrix)
+
+    def testSelectAndCountABlockOfDaysAtATime(self):
+
+        matrix = StateMatrix.from_intervals(self.intervals, ['Open', 'In Progress', 'Closed'])
+
+        expected = matrix.select([True, False, True])
+        expected_counts = matrix.counts_on(['Closed'], 1, ['one', None, 'two'])
+
+        # Two items' codes for one day at a time
+        with mock.patch('jlf_stats.state_matrix.BLOCK_CELLS', 2):
+            actual = matrix.select([True, False, True])
+            actual_counts = matrix.counts_on(['Closed'], 1, ['one', None, 'two'])
+
+        np.testing.assert_array_equal(actual.codes, [[0, 0, 2, MISSING],
+                                                     [MISSING, MISSING, MISSING, 2]])
+        np.testing.assert_array_equal(actual.codes, expected.codes)
+        np.testing.assert_array_equal(actual.days, expected.days)
+
+        assert_frame_equal(actual_counts, expected_counts)
+        self.assertEqual(list(actual_counts.columns), ['one', 'two'])
+
+    def testSaveAndMapBackIn(self):
+
+        filename = os.path.join(tempfile.mkdtemp(), 'states.npy')
+
+        matrix = StateMatrix.from_intervals(self.intervals,
+                                            categories={'ONE-1': 'One', 'ONE-2': 'One', 'ONE-3': 'Two'},
+                                            types={'ONE-1': 'Bug', 'ONE-2': 'Story', 'ONE-3': 'Bug'})
+        matrix.until_date = '2012-01-11'
+        matrix.save(filename)
+
+        actual = StateMatrix.load(filename)
+
+        self.assertIsInstance(actual.codes, np.memmap)
+        np.testing.assert_array_equal(actual.codes, matrix.codes)
+        np.testing.assert_array_equal(actual.days, matrix.days)
+        self.assertEqual(actual.categories, matrix.categories)
+        self.assertEqual(actual.until_date, '2012-01-11')
+
+        assert_frame_equal(actual.frame(), matrix.frame())
+
+    def testFillTheFileAndSaveOverAnOldOne(self):
+
+        filename = os.path.join(tempfile.mkdtemp(), 'states.npy')
+
+        StateMatrix.from_intervals({'ONE-4': self.intervals['ONE-3']}).save(filename)
+        old = StateMatrix.load(filename)
+
+        matrix = StateMatrix.from_intervals(self.intervals, ['Open', 'In Progress', 'Closed'], filename=filename)
+
+        # Filled in alongside the file, not in memory
+        self.assertIsInstance(matrix.codes, np.memmap)
+        np.testing.assert_array_equal(matrix.codes, StateMatrix.from_intervals(self.intervals,
+                                                                               ['Open', 'In Progress',
+                                                                                'Closed']).codes)
+
+        matrix.save(filename)
+
+        actual = StateMatrix.load(filename)
+
+        self.assertEqual(actual.keys, ['ONE-1', 'ONE-2', 'ONE-3'])
+        np.testing.assert_array_equal(actual.codes, matrix.codes)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(filename))), ['states.npy', 'states.npy.json'])
+
+        # Whatever still maps the old file still sees it as it was
+        self.assertEqual(old.keys, ['ONE-4'])
+        np.testing.assert_array_equal(old.codes, [[0]])
+
+    def testCountsOnAWeekday(self):
+
+        intervals = {'ONE-1': StateIntervals.from_runs([{'state': 'Open', 'days': 3},
+                                                        {'state': 'Closed', 'days': 17}],
+                                                       datetime(2012, 1, 2)),
+                     'ONE-2': StateIntervals.from_runs([{'state': 'Open', 'days': 10},
+                                                        {'state': 'Closed', 'days': 10}],
+                                                       datetime(2012, 1, 2)),
+                     'ONE-3': StateIntervals.from_runs([{'state': 'Closed', 'days': 20}],
+                                                       datetime(2012, 1, 2)),
+                     'ONE-4': StateIntervals.from_runs([{'state': 'Closed', 'days': 7}],
+                                                       datetime(2012, 1, 2))}
+
+        matrix = StateMatrix.from_intervals(intervals)
+
+        # Fridays
+        actual = matrix.counts_on(['Closed'], 4, ['one', 'one', 'two', 'two'])
+
+        expected = pd.DataFrame({'one': [1, 2, 2], 'two': [2, 1, 1]},
+                                index=pd.to_datetime(['2012-01-06', '2012-01-13', '2012-01-20']))
+
+        assert_frame_equal(actual, expected)
+
+        # Where a group has none on a day we have NaN, as a pivot table would
+        actual = matrix.counts_on(['Closed'], 4, ['one', 'one', 'two', 'three'])
+
+        expected = pd.DataFrame({'one': [1.0, 2.0, 2.0], 'three': [1.0, np.nan, np.nan], 'two': [1.0, 1.0, 1.0]},
+                                index=pd.to_datetime(['2012-01-06', '2012-01-13', '2012-01-20']))
+
+        assert_frame_equal(actual, expected)
@@ -0,0 +1,43 @@
+import unittest
+
+from datetime import datetime
+
+from jlf_stats.work import WorkItem, WorkItemStore
+
+
+class TestWorkItemStore(unittest.TestCase):
+
+    def setUp(self):
+
+        def work_item(id, category, type, state):
+            return WorkItem(id=id,
+                            title=id,
+                            state=state,
+                            type=type,
+                            history=None,
+                            date_created=datetime(2012, 1, 1),
+                            category=category)
+
+        self.work_items = [work_item('ONE-1', 'one', 'Bug', 'Closed'),
+                           work_item('ONE-2', 'one', 'Story', 'Open'),
+                           work_item('TWO-1', 'two', 'Task', 'Closed'),
+                           # Also in another category
+                           work_item('ONE-1', 'two', 'Bug', 'Closed')]
+
+        self.store = WorkItemStore(self.work_items, {'failure': ['Bug'],
+                                                     'value': ['Story'],
+                                                     'oo': ['Task']})
+
+    def testLookUpById(self):
+
+        self.assertIs(self.store.get('ONE-1'), self.work_items[0])
+        self.assertIs(self.store.get('TWO-1'), self.work_items[2])
+        self.assertRaises(KeyError, self.store.get, 'THREE-1')
+
+    def testFilterInOrder(self):
+
+        self.assertEqual(list(self.store), self.work_items)
+        self.assertEqual(len(self.store), 4)
+
+        self.assertEqual(self.store.of_types(['oo', 'failure']),
+                         [self.work_items[0], self.work_items[2], self.work_items[3]])
@@ -0,0 +1,78 @@
+"""
+Picking state transitions out of FogBugz case events.
+
+Which events are transitions, and how to find the states in their
+sChanges text, is set out in a table of event codes.  Each code maps to
+either the states every such event moves between, e.g.
+
+    {"from": "New", "to": "Open"}
+
+or a list of patterns tried in turn against the event's sChanges, each
+finding the from and to states as its first two groups, or as groups
+named from and to, e.g.
+
+    ["^Status changed from '([^']+)' to '([^']+)'"]
+
+Patterns are compiled once, up front, and events whose codes aren't in
+the table are skipped before we look at any of their text.
+"""
+
+import re
+
+
+class TransitionExtractor(object):
+
+    def __init__(self, table):
+
+        self.rules = {}
+
+        for event_code, rule in table.items():
+
+            if isinstance(rule, dict):
+                self.rules[int(event_code)] = (rule['from'], rule['to'])
+            else:
+                self.rules[int(event_code)] = [re.compile(pattern) for pattern in rule]
+
+        self.event_codes = frozenset(self.rules)
+
+    def extract(self, event_code, changes, timestamp):
+        """
+        The transition an event makes, or None if it doesn't make one
+        """
+
+        rule = self.rules.get(event_code)
+
+        if rule is None:
+            return None
+
+        if isinstance(rule, tuple):
+            from_state, to_state = rule
+        else:
+            states = _states(rule, changes)
+            if states is None:
+                return None
+            from_state, to_state = states
+
+        return {'from': from_state,
+                'to': to_state,
+                'timestamp': timestamp}
+
+
+def _states(patterns, changes):
+
+    if not changes:
+        return None
+
+    for pattern in patterns:
+
+        m = pattern.search(changes)
+
+        if m is None:
+            continue
+
+        if 'from' in pattern.groupindex and 'to' in pattern.groupindex:
+            return m.group('from'), m.group('to')
+
+        return m.group(1), m.group(2)
+
+    return None
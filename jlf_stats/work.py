@@ -1,10 +1,14 @@
 import json
 from datetime import datetime
+import numpy as np
 import pandas as pd
 
 
 class WorkItem(object):
 
+    # What detail() always gives us, before cycles and any other fields
+    detail_fields = ['id', 'title', 'state', 'type', 'date_created']
+
     def __init__(self,
                  id,
                  title,
@@ -14,7 +18,9 @@ class WorkItem(object):
                  date_created,
                  state_transitions=None,
                  category=None,
-                 cycles=None):
+                 cycles=None,
+                 fields=None,
+                 intervals=None):
         self.id = id
         self.title = title
         self.state = state
@@ -24,6 +30,25 @@ class WorkItem(object):
         self.category = category
         self.cycles = cycles
         self.state_transitions = state_transitions
+        self.fields = fields
+        self.intervals = intervals
+
+    @property
+    def history(self):
+        """
+        Day by day history, made from our state intervals, the first time
+        anyone asks, if we have them and nobody gave us one
+        """
+
+        if self._history is None and self.intervals is not None:
+            self._history = self.intervals.series()
+
+        return self._history
+
+    @history.setter
+    def history(self, history):
+
+        self._history = history
 
     def __str__(self):
         return unicode(self).encode('utf-8')
@@ -43,6 +68,10 @@ class WorkItem(object):
             for cycle in self.cycles:
                 detail[cycle] = self.cycles[cycle]
 
+        if self.fields is not None:
+            for field in self.fields:
+                detail[field] = self.fields[field]
+
         return detail
 
     def to_JSON(self):
@@ -57,8 +86,109 @@ class WorkItem(object):
             elif isinstance(obj, pd.Series):
                 return obj.to_json()
 
+            elif isinstance(obj, WorkItem):
+                # Intervals are saved as the history they make
+                fields = dict((name, value) for name, value in obj.__dict__.items()
+                              if name not in ('_history', 'intervals'))
+                fields['history'] = obj.history
+                return fields
+
             else:
                 return obj.__dict__
 
         return json.dumps(self, default=json_serial,
                           sort_keys=True, indent=4)
+
+
+class WorkItemStore(object):
+    """
+    Work items, in the order we got them, indexed by id and type grouping
+    so we can look them up without going through every one of them
+    """
+
+    def __init__(self, work_items, type_groupings=None):
+
+        self.work_items = list(work_items)
+
+        self.ids = {}
+        self.type_groupings = {}
+
+        groupings_by_type = {}
+        if type_groupings is not None:
+            for type_grouping in type_groupings:
+                self.type_groupings[type_grouping] = []
+                for work_type in type_groupings[type_grouping]:
+                    groupings_by_type.setdefault(work_type, []).append(type_grouping)
+
+        # Made when first asked for
+        self._created_dates = None
+
+        for n, work_item in enumerate(self.work_items):
+
+            # The first we got of any with the same id
+            self.ids.setdefault(work_item.id, work_item)
+
+            for type_grouping in groupings_by_type.get(work_item.type, []):
+                self.type_groupings[type_grouping].append(n)
+
+    def __iter__(self):
+
+        return iter(self.work_items)
+
+    def __len__(self):
+
+        return len(self.work_items)
+
+    def get(self, id):
+
+        return self.ids[id]
+
+    def of_types(self, type_groupings):
+        """
+        Work items of any of the types in any of type_groupings
+        """
+
+        return [self.work_items[n] for n in sorted(set(n for type_grouping in type_groupings
+                                                       for n in self.type_groupings[type_grouping]))]
+
+    def positions_of_types(self, type_groupings):
+        """
+        Where the work items of any of the types in any of type_groupings
+        are, in our order
+        """
+
+        return np.array(sorted(set(n for type_grouping in type_groupings
+                                   for n in self.type_groupings[type_grouping])), dtype=np.int64)
+
+    def created_dates(self):
+        """
+        The day each work item was created, in our order, as one
+        datetime64[D] array
+        """
+
+        if self._created_dates is None:
+            self._created_dates = created_dates(self.work_items)
+
+        return self._created_dates
+
+    def column(self, attribute):
+        """
+        An attribute of every work item, in our order, as an array
+        """
+
+        return np.array([getattr(work_item, attribute) for work_item in self.work_items], dtype=object)
+
+
+def created_dates(work_items):
+    """
+    The day each of work_items was created as a datetime64[D] array.  We
+    go by the date on the clock where they were created, as isocalendar()
+    would, even if we know their time zone.
+    """
+
+    return np.array([day_created(work_item) for work_item in work_items], dtype='datetime64[D]')
+
+
+def day_created(work_item):
+
+    return str(work_item.date_created)[:10]
@@ -0,0 +1,68 @@
+"""
+Bounded pool of worker threads for fetching from our sources.
+
+With a size of one everything runs serially on the calling thread, which
+keeps the default behaviour (and the mocks in the tests) exactly as it was.
+"""
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+
+class WorkerPool(object):
+    """
+    Run calls on at most `size` threads, keeping results in order
+    """
+
+    def __init__(self, size=1):
+
+        self.size = max(1, int(size))
+        self._pool = None
+
+    def map(self, func, iterable):
+        """
+        Like the builtin map but with up to `size` calls in flight
+        """
+
+        if self.size == 1:
+            return [func(item) for item in iterable]
+
+        return self._threads().map(func, list(iterable))
+
+    def imap(self, func, iterable):
+        """
+        Like map but hand back each result as soon as it, and all
+        the results before it, are ready.
+
+        We only ever run `size` calls ahead of whoever is consuming the
+        results so we never hold more than that many results at once.
+        """
+
+        if self.size == 1:
+            for item in iterable:
+                yield func(item)
+            return
+
+        pending = deque()
+
+        for item in iterable:
+            pending.append(self._threads().apply_async(func, (item,)))
+            if len(pending) > self.size:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _threads(self):
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.size)
+
+        return self._pool
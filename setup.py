@@ -38,5 +38,8 @@ setup(
         'xlrd==0.9.2',
         'xlwt==0.7.5',
         'XlsxWriter'
-    ]
+    ],
+    extras_require={
+        'async': ['tornado<6']
+    }
 )